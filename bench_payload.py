@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# CPU cost per call of building an event: option parsing, environment
+# lookups, payload generation (with its gethostname) and JSON encoding,
+# for each kind of notification and for a realistic mix of them, and
+# the same events from an EventBuilder reused the way --bulk does.
+# Results can be saved with --output and compared with --baseline, like
+# bench_startup.py's.
+
+from __future__ import absolute_import
+
+import copy
+import itertools
+import json
+from optparse import OptionParser
+import os
+import socket
+import sys
+import timeit
+
+import send_signifai
+from bench_startup import regressions
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+SHORT_OUTPUT = "CRITICAL - load average: 12.41, 10.02, 8.77"
+# a check with a long multi-line output, e.g. a log or process listing
+LARGE_OUTPUT = SHORT_OUTPUT + "\n" + "\n".join(
+    "line {n}: worker {n} stuck in D state for {n}s".format(n=n)
+    for n in range(1500))
+CASES = {
+    "host-down": ["-H", "db01", "-s", "DOWN",
+                  "-o", "PING CRITICAL - Packet loss = 100%"],
+    "host-up": ["-H", "db01", "-s", "UP", "-o", "PING OK - rta 0.31ms"],
+    "service-ok": ["-H", "web01", "-S", "load", "-s", "OK",
+                   "-o", "OK - load average: 0.41, 0.32, 0.30"],
+    "service-critical": ["-H", "web01", "-S", "load", "-s", "CRITICAL",
+                         "-o", SHORT_OUTPUT],
+    "service-unknown": ["-H", "web01", "-S", "load", "-s", "UNKNOWN",
+                        "-o", "UNKNOWN - plugin timed out"],
+    "service-large": ["-H", "web01", "-S", "procs", "-s", "CRITICAL",
+                      "-o", LARGE_OUTPUT],
+    "service-unknown-large": ["-H", "web01", "-S", "procs", "-s",
+                              "UNKNOWN", "-o", LARGE_OUTPUT],
+}
+# Share of each case in a busy master's notifications
+MIX = [("service-ok", 40), ("service-critical", 30),
+       ("service-unknown", 5), ("host-down", 10), ("host-up", 10),
+       ("service-large", 4), ("service-unknown-large", 1)]
+
+
+def notification_argv(case):
+    return CASES[case] + ["-k", "BENCHKEY"]
+
+
+def parsed_options(case):
+    options, _ = send_signifai.parse_opts(notification_argv(case))
+    return options
+
+
+def mixed(values):
+    # An endless cycle through values, weighted by MIX
+    return itertools.cycle([values[case] for case, weight in MIX
+                            for _ in range(weight)])
+
+
+def benchmarks():
+    # [(name, function), ...]; each function does one unit of work
+    os.environ['ICINGA_BENCHMACRO'] = "value"
+    os.environ['NAGIOS_BENCHFALLBACK'] = "value"
+    suite = [
+        ("icingios_get_env/icinga",
+         lambda: send_signifai.icingios_get_env("BENCHMACRO")),
+        ("icingios_get_env/nagios",
+         lambda: send_signifai.icingios_get_env("BENCHFALLBACK")),
+        ("icingios_get_env/missing",
+         lambda: send_signifai.icingios_get_env("BENCHMISSING", "")),
+        ("socket.gethostname", socket.gethostname),
+    ]
+
+    argvs = dict((case, notification_argv(case)) for case in CASES)
+    options = dict((case, parsed_options(case)) for case in CASES)
+    payloads = dict((case, send_signifai.generate_REST_payload(options[case]))
+                    for case in CASES)
+    target = payloads['service-critical']['events'][-1]
+    suite.append(("copy.deepcopy/event", lambda: copy.deepcopy(target)))
+
+    def bind(func, value):
+        return lambda: func(value)
+
+    for case in sorted(CASES):
+        suite.append(("parse_opts/" + case,
+                      bind(send_signifai.parse_opts, argvs[case])))
+        suite.append(("generate_REST_payload/" + case,
+                      bind(send_signifai.generate_REST_payload,
+                           options[case])))
+        suite.append(("json.dumps/" + case, bind(json.dumps,
+                                                 payloads[case])))
+
+    # one builder for many events, as --bulk uses it
+    builder = send_signifai.EventBuilder()
+    for case in sorted(CASES):
+        suite.append(("EventBuilder.events/" + case,
+                      bind(builder.events, options[case])))
+
+    mixed_argvs = mixed(argvs)
+    mixed_options = mixed(options)
+
+    def event(argv):
+        # the whole path of one notification, short of sending it
+        options, _ = send_signifai.parse_opts(argv)
+        return json.dumps(send_signifai.generate_REST_payload(options))
+
+    suite.append(("generate_REST_payload/mix",
+                  lambda: send_signifai.generate_REST_payload(
+                      next(mixed_options))))
+    suite.append(("EventBuilder.events/mix",
+                  lambda: builder.events(next(mixed_options))))
+    suite.append(("event/mix", lambda: event(next(mixed_argvs))))
+    return suite
+
+
+def time_function(func, repeat, min_time):
+    # Seconds per call: the samples of repeat runs of enough calls to
+    # take at least min_time each, and the number of calls per sample
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    samples = [elapsed / number for elapsed in timer.repeat(repeat, number)]
+    return samples, number
+
+
+def run_benchmarks(names=None, repeat=5, min_time=0.05):
+    # Benchmarks whose name contains one of names (all by default)
+    results = {}
+    for name, func in benchmarks():
+        if names and not any(part in name for part in names):
+            continue
+        samples, number = time_function(func, repeat, min_time)
+        samples.sort()
+        results[name] = {
+            "calls": number,
+            "median_us": samples[len(samples) // 2] * 1000000,
+            "min_us": samples[0] * 1000000
+        }
+    return results
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-k", "--filter",
+                      help="Only run benchmarks whose name contains this; "
+                           "repeatable",
+                      action="append", dest="names", type=str, default=None)
+    parser.add_option("-r", "--repeat",
+                      help="Samples per benchmark (default 5)",
+                      action="store", dest="repeat", type=int, default=5)
+    parser.add_option("--min-time",
+                      help="Seconds each sample runs for at least "
+                           "(default 0.05)",
+                      action="store", dest="min_time", type=float,
+                      default=0.05)
+    parser.add_option("--output",
+                      help="Write the results to this JSON file",
+                      action="store", dest="output", type=str,
+                      default=None)
+    parser.add_option("--baseline",
+                      help="Fail if a median is slower than in this "
+                           "JSON file from --output",
+                      action="store", dest="baseline", type=str,
+                      default=None)
+    parser.add_option("--tolerance",
+                      help="Slowdown allowed against --baseline, as a "
+                           "fraction (default 0.25)",
+                      action="store", dest="tolerance", type=float,
+                      default=0.25)
+    (options, args) = parser.parse_args(argv[1:])
+
+    results = run_benchmarks(options.names, options.repeat, options.min_time)
+    for name, result in sorted(results.items()):
+        print("{name:44} median {median_us:9.2f}us  min {min_us:9.2f}us"
+              .format(name=name, **result))
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            slower = regressions(results, json.load(baseline),
+                                 options.tolerance, key="median_us")
+        for name, median, before in slower:
+            print("REGRESSION {name}: {median:.2f}us, baseline {before:.2f}us"
+                  .format(name=name, median=median, before=before))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
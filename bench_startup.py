@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Wall time of a send_signifai.py notification, from exec to exit,
+# against a local fake collector. Each mode runs the real command line
+# the way Icinga/Nagios would:
+#
+#   interpreter  "python -c pass", the floor for everything else
+#   direct       POST straight to the (fake) collector
+#   spool        write the event to a spool directory
+#   socket       hand the event to a running --daemon
+#
+# Results can be saved with --output and compared with --baseline.
+
+from __future__ import absolute_import
+
+import json
+from optparse import OptionParser
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_collector import FakeCollector
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, "send_signifai.py")
+MODES = ("interpreter", "direct", "spool", "socket")
+EVENT_ARGS = ["-H", "benchhost", "-S", "benchservice", "-s", "CRITICAL",
+              "-o", "CRITICAL - startup benchmark", "-k", "BENCHKEY"]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def time_command(command, runs):
+    # Seconds each run took, from exec to exit
+    samples = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(runs):
+            start = time.time()
+            status = subprocess.call(command, stdout=devnull,
+                                     stderr=devnull)
+            samples.append(time.time() - start)
+            if status != 0:
+                raise RuntimeError("{command} exited with {status}"
+                                   .format(command=" ".join(command),
+                                           status=status))
+    return samples
+
+
+def wait_for_socket(path, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                return True
+            except socket.error:
+                pass
+            finally:
+                probe.close()
+        time.sleep(0.05)
+    return False
+
+
+def run_benchmarks(modes, runs, python=sys.executable):
+    collector = FakeCollector()
+    collector.start()
+    workdir = tempfile.mkdtemp(prefix="signifai-bench-")
+    daemon = None
+    results = {}
+    try:
+        sender = [python, SCRIPT, "--collector", collector.url]
+        commands = {
+            "interpreter": [python, "-c", "pass"],
+            "direct": sender + EVENT_ARGS,
+            "spool": sender + EVENT_ARGS +
+            ["--spool", os.path.join(workdir, "spool")],
+        }
+        if "socket" in modes:
+            socket_path = os.path.join(workdir, "signifai.sock")
+            with open(os.devnull, "w") as devnull:
+                daemon = subprocess.Popen(
+                    sender + ["--daemon", "--socket", socket_path],
+                    stdout=devnull, stderr=devnull)
+            if not wait_for_socket(socket_path):
+                raise RuntimeError("daemon didn't come up")
+            commands["socket"] = (sender + EVENT_ARGS +
+                                  ["--socket", socket_path])
+
+        for mode in modes:
+            # one untimed run warms the page cache
+            time_command(commands[mode], 1)
+            samples = time_command(commands[mode], runs)
+            results[mode] = {
+                "runs": runs,
+                "median_ms": percentile(samples, 0.5) * 1000,
+                "p90_ms": percentile(samples, 0.9) * 1000,
+                "min_ms": min(samples) * 1000
+            }
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        collector.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def regressions(results, baseline, tolerance, key="median_ms"):
+    # Modes (or benchmarks) whose median got slower than the baseline
+    # allows
+    slower = []
+    for mode, result in sorted(results.items()):
+        if mode not in baseline:
+            continue
+        allowed = baseline[mode][key] * (1 + tolerance)
+        if result[key] > allowed:
+            slower.append((mode, result[key], baseline[mode][key]))
+    return slower
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--runs",
+                      help="Timed runs per mode",
+                      action="store", dest="runs", type=int, default=20)
+    parser.add_option("-m", "--mode",
+                      help="Mode to run, repeatable (default: all of "
+                           "{modes})".format(modes=", ".join(MODES)),
+                      action="append", dest="modes", type="choice",
+                      choices=list(MODES), default=None)
+    parser.add_option("--output",
+                      help="Write the results to this JSON file",
+                      action="store", dest="output", type=str,
+                      default=None)
+    parser.add_option("--baseline",
+                      help="Fail if a median is slower than in this "
+                           "JSON file from --output",
+                      action="store", dest="baseline", type=str,
+                      default=None)
+    parser.add_option("--tolerance",
+                      help="Slowdown allowed against --baseline, as a "
+                           "fraction (default 0.25)",
+                      action="store", dest="tolerance", type=float,
+                      default=0.25)
+    (options, args) = parser.parse_args(argv[1:])
+    modes = options.modes or list(MODES)
+
+    results = run_benchmarks(modes, options.runs)
+    for mode in modes:
+        result = results[mode]
+        print("{mode:12} median {median_ms:7.1f}ms  p90 {p90_ms:7.1f}ms  "
+              "min {min_ms:7.1f}ms".format(mode=mode, **result))
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            slower = regressions(results, json.load(baseline),
+                                 options.tolerance)
+        for mode, median, before in slower:
+            print("REGRESSION {mode}: {median:.1f}ms, baseline {before:.1f}ms"
+                  .format(mode=mode, median=median, before=before))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Nagios/Icinga check of send_signifai.py itself: the spool backlog and
+# the age of its oldest entry (from the index the drainer keeps), and
+# the send rate, error rate and p95 delivery latency over the last few
+# minutes (from send_signifai.py's --stats-file). Only those two small
+# files are read, never the spooled entries.
+
+from __future__ import absolute_import, division
+
+import json
+from optparse import OptionParser
+import sys
+import time
+
+from send_signifai import PHASE_BUCKETS, RECENT_MINUTES, Spool
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+STATUS_NAMES = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL",
+                UNKNOWN: "UNKNOWN"}
+# Worst first wins: CRITICAL over WARNING over UNKNOWN over OK
+SEVERITY = {OK: 0, UNKNOWN: 1, WARNING: 2, CRITICAL: 3}
+
+
+def parse_opts(argv):
+    parser = OptionParser(usage="%prog [--spool DIR] [--stats-file FILE] "
+                                "[options]")
+    parser.add_option("--spool",
+                      help="send_signifai.py's --spool directory",
+                      action="store", dest="spool_dir", type=str,
+                      default=None)
+    parser.add_option("--stats-file",
+                      help="send_signifai.py's --stats-file",
+                      action="store", dest="stats_file", type=str,
+                      default=None)
+    parser.add_option("--window",
+                      help="Minutes the rates and latency cover "
+                           "(default 5, at most {most})"
+                           .format(most=RECENT_MINUTES),
+                      action="store", dest="window", type=int, default=5)
+    parser.add_option("--backlog-warning", action="store",
+                      dest="backlog_warning", type=int, default=1000,
+                      help="Spooled entries to warn at (default 1000)")
+    parser.add_option("--backlog-critical", action="store",
+                      dest="backlog_critical", type=int, default=10000,
+                      help="Spooled entries to go critical at "
+                           "(default 10000)")
+    parser.add_option("--age-warning", action="store",
+                      dest="age_warning", type=float, default=300,
+                      help="Age in seconds of the oldest spooled entry "
+                           "to warn at (default 300)")
+    parser.add_option("--age-critical", action="store",
+                      dest="age_critical", type=float, default=900,
+                      help="Age in seconds of the oldest spooled entry "
+                           "to go critical at (default 900)")
+    parser.add_option("--index-age", action="store",
+                      dest="index_age", type=float, default=300,
+                      help="Seconds without a spool index update before "
+                           "the drainer is taken for dead (default 300)")
+    parser.add_option("--error-warning", action="store",
+                      dest="error_warning", type=float, default=5,
+                      help="Percentage of failed deliveries to warn at "
+                           "(default 5)")
+    parser.add_option("--error-critical", action="store",
+                      dest="error_critical", type=float, default=20,
+                      help="Percentage of failed deliveries to go "
+                           "critical at (default 20)")
+    parser.add_option("--latency-warning", action="store",
+                      dest="latency_warning", type=float, default=2,
+                      help="p95 delivery time in seconds to warn at "
+                           "(default 2)")
+    parser.add_option("--latency-critical", action="store",
+                      dest="latency_critical", type=float, default=5,
+                      help="p95 delivery time in seconds to go critical "
+                           "at (default 5)")
+    (options, args) = parser.parse_args(argv)
+    if not 1 <= options.window <= RECENT_MINUTES:
+        return None
+    return options
+
+
+def level(value, warning, critical):
+    if value is None:
+        return OK
+    if critical is not None and value >= critical:
+        return CRITICAL
+    if warning is not None and value >= warning:
+        return WARNING
+    return OK
+
+
+def perfdata(label, value, unit="", warning=None, critical=None,
+             minimum=0, maximum=None):
+    # 'label'=value[unit];warn;crit;min;max, "U" for an unknown value
+    fields = ["U" if value is None else "{value:g}{unit}".format(
+        value=value, unit=unit)]
+    for field in (warning, critical, minimum, maximum):
+        fields.append("" if field is None else "{field:g}".format(
+            field=field))
+    return "{label}={fields}".format(label=label,
+                                     fields=";".join(fields).rstrip(";"))
+
+
+def percentile(buckets, fraction):
+    # Upper bound of the PHASE_BUCKETS bucket holding that fraction of
+    # the observations; None without any
+    total = sum(buckets)
+    if not total:
+        return None
+    seen = 0
+    for bound, n in zip(PHASE_BUCKETS + (float("inf"),), buckets):
+        seen += n
+        if seen >= fraction * total:
+            return bound
+
+
+def recent_figures(stats, window, now):
+    # The stats file's per-minute figures added up over the last window
+    # minutes (the current, partial minute included)
+    since = now - window * 60
+    figures = {"deliveries": 0, "deliveries_failed": 0, "events_sent": 0,
+               "buckets": [0] * (len(PHASE_BUCKETS) + 1)}
+    for minute in stats.get('recent', []):
+        if minute['minute'] + 60 <= since:
+            continue
+        for name in ("deliveries", "deliveries_failed", "events_sent"):
+            figures[name] += minute[name]
+        figures['buckets'] = [a + b for a, b in zip(
+            figures['buckets'], minute['delivery']['buckets'])]
+    return figures
+
+
+def check_spool(options, now, results, perf):
+    index = Spool(options.spool_dir).read_index()
+    if index is None:
+        results.append((UNKNOWN, "no spool index in {path} (has a drainer "
+                                 "run?)".format(path=options.spool_dir)))
+        return
+    index_age = now - index['updated']
+    if index_age >= options.index_age:
+        results.append((CRITICAL, "spool index not updated for {age:.0f}s "
+                                  "(is the drainer running?)"
+                                  .format(age=index_age)))
+    oldest_age = None
+    if index['oldest'] is not None:
+        oldest_age = max(0, now - index['oldest'])
+    results.append((level(index['entries'], options.backlog_warning,
+                          options.backlog_critical),
+                    "{n} spooled".format(n=index['entries'])))
+    if oldest_age is not None:
+        results.append((level(oldest_age, options.age_warning,
+                              options.age_critical),
+                        "oldest {age:.0f}s old".format(age=oldest_age)))
+    perf.append(perfdata("backlog", index['entries'], "",
+                         options.backlog_warning, options.backlog_critical))
+    perf.append(perfdata("oldest_age", oldest_age or 0, "s",
+                         options.age_warning, options.age_critical))
+    perf.append(perfdata("rejected", index['rejected']))
+
+
+def check_stats(options, now, results, perf):
+    try:
+        with open(options.stats_file) as stats_file:
+            stats = json.load(stats_file)
+    except (IOError, OSError, ValueError):
+        results.append((UNKNOWN, "can't read {path}"
+                                 .format(path=options.stats_file)))
+        return
+    figures = recent_figures(stats, options.window, now)
+    send_rate = figures['events_sent'] / (options.window * 60)
+    error_rate = None
+    if figures['deliveries']:
+        error_rate = (100.0 * figures['deliveries_failed'] /
+                      figures['deliveries'])
+    p95 = percentile(figures['buckets'], 0.95)
+
+    results.append((OK, "{rate:.2f} events/s".format(rate=send_rate)))
+    if error_rate is not None:
+        results.append((level(error_rate, options.error_warning,
+                              options.error_critical),
+                        "{rate:.1f}% failed deliveries".format(
+                            rate=error_rate)))
+    if p95 is not None:
+        results.append((level(p95, options.latency_warning,
+                              options.latency_critical),
+                        "p95 delivery {p95:g}s".format(p95=p95)))
+    perf.append(perfdata("send_rate", send_rate))
+    perf.append(perfdata("error_rate", error_rate, "%",
+                         options.error_warning, options.error_critical,
+                         0, 100))
+    # the overflow bucket has no upper bound to report
+    perf.append(perfdata("p95_latency",
+                         None if p95 == float("inf") else p95, "s",
+                         options.latency_warning, options.latency_critical))
+
+
+def main(argv=sys.argv):
+    options = parse_opts(argv[1:])
+    if options is None:
+        print("SIGNIFAI UNKNOWN - --window must be 1 to {most} minutes"
+              .format(most=RECENT_MINUTES))
+        return UNKNOWN
+    if not options.spool_dir and not options.stats_file:
+        print("SIGNIFAI UNKNOWN - nothing to check; give --spool and/or "
+              "--stats-file")
+        return UNKNOWN
+
+    now = time.time()
+    results = []
+    perf = []
+    if options.spool_dir:
+        check_spool(options, now, results, perf)
+    if options.stats_file:
+        check_stats(options, now, results, perf)
+
+    status = max((status for status, _ in results),
+                 key=lambda status: SEVERITY[status])
+    # problems first, then the rest for context
+    messages = [message for result, message in results if result != OK]
+    messages += [message for result, message in results if result == OK]
+    line = "SIGNIFAI {status} - {messages}".format(
+        status=STATUS_NAMES[status], messages=", ".join(messages))
+    if perf:
+        line += " | " + " ".join(perf)
+    print(line)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# A local stand-in for the SignifAI collector, for benchmarks and load
+# tests. It speaks plain HTTP, so point send_signifai.py at it with
+# --collector http://127.0.0.1:PORT. It can be made to misbehave like
+# a loaded collector: answer late, fail requests with 503, list some
+# events in failed_events or hang up without answering.
+
+from __future__ import absolute_import
+
+import json
+import logging
+from optparse import OptionParser
+import random
+import sys
+import threading
+import time
+import zlib
+
+try:
+    # python3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = self.read_chunked()
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+        if self.path != "/v1/incidents":
+            self.reply(404, {"success": False})
+            return
+        encoding = self.headers.get("Content-Encoding", "identity").lower()
+        if encoding == "gzip":
+            try:
+                body = zlib.decompress(body, 31)
+            except zlib.error:
+                self.reply(400, {"success": False, "error": "malformed"})
+                return
+        elif encoding != "identity":
+            self.reply(415, {"success": False, "error": "unsupported"})
+            return
+        try:
+            events = json.loads(body.decode("utf-8"))['events']
+        except (ValueError, KeyError, TypeError):
+            self.reply(400, {"success": False, "error": "malformed"})
+            return
+        server = self.server
+        if server.roll(server.drop_rate):
+            # hang up without an answer, like a collector that crashed
+            # or a load balancer that gave up
+            server.count("dropped")
+            self.close_connection = True
+            return
+        delay = server.latency
+        if server.jitter:
+            delay += server.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if server.roll(server.error_rate):
+            server.count("errors")
+            self.reply(503, {"success": False, "error": "unavailable"})
+            return
+        failed = [server.roll(server.failed_rate) for _ in events]
+        server.record([event for event, refused in zip(events, failed)
+                       if not refused])
+        failed_events = [{"event": event, "error": "rejected"}
+                         for event, refused in zip(events, failed)
+                         if refused]
+        server.count("failed", len(failed_events))
+        self.reply(200, {"success": True, "failed_events": failed_events})
+
+    def read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                # trailers, up to the blank line
+                while self.rfile.readline().strip():
+                    pass
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.getLogger("fake_collector").debug(format, *args)
+
+
+class FakeCollector(ThreadingMixIn, HTTPServer):
+    # Each POST is answered after latency seconds (plus up to jitter
+    # more); error_rate of them get a 503, drop_rate get no answer at
+    # all, and failed_rate of the events in the others are listed in
+    # failed_events instead of being accepted
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, jitter=0,
+                 error_rate=0, failed_rate=0, drop_rate=0, seed=None):
+        HTTPServer.__init__(self, (host, port), CollectorHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.failed_rate = failed_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.posts = 0
+        self.events = 0
+        self.errors = 0
+        self.dropped = 0
+        self.failed = 0
+        # every event accepted, in order, and when it arrived
+        self.received = []
+        self.arrivals = []
+
+    @property
+    def url(self):
+        return "http://{host}:{port}".format(host=self.server_address[0],
+                                             port=self.server_address[1])
+
+    def record(self, events):
+        now = time.time()
+        with self.lock:
+            self.posts += 1
+            self.events += len(events)
+            self.received.extend(events)
+            self.arrivals.extend([now] * len(events))
+
+    def count(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def roll(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def uniform(self, low, high):
+        with self.lock:
+            return self.random.uniform(low, high)
+
+    def stats(self):
+        with self.lock:
+            return {"posts": self.posts, "events": self.events,
+                    "errors": self.errors, "dropped": self.dropped,
+                    "failed": self.failed}
+
+    def start(self):
+        # Serve from a background thread; returns the thread
+        thread = threading.Thread(target=self.serve_forever,
+                                  name="fake-collector")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_behaviour_options(parser):
+    # Options for FakeCollector's misbehaviour; see behaviour_kwargs
+    parser.add_option("--latency",
+                      help="Seconds before each answer (default 0)",
+                      action="store", dest="latency", type=float, default=0)
+    parser.add_option("--jitter",
+                      help="Up to this many more seconds, at random",
+                      action="store", dest="jitter", type=float, default=0)
+    parser.add_option("--error-rate",
+                      help="Fraction of POSTs answered with a 503",
+                      action="store", dest="error_rate", type=float,
+                      default=0)
+    parser.add_option("--failed-rate",
+                      help="Fraction of events listed in failed_events",
+                      action="store", dest="failed_rate", type=float,
+                      default=0)
+    parser.add_option("--drop-rate",
+                      help="Fraction of POSTs whose connection is closed "
+                           "without an answer",
+                      action="store", dest="drop_rate", type=float,
+                      default=0)
+    parser.add_option("--seed",
+                      help="Random seed, for repeatable runs",
+                      action="store", dest="seed", type=int, default=None)
+
+
+def behaviour_kwargs(options):
+    return {
+        "latency": options.latency,
+        "jitter": options.jitter,
+        "error_rate": options.error_rate,
+        "failed_rate": options.failed_rate,
+        "drop_rate": options.drop_rate,
+        "seed": options.seed
+    }
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage="%prog [--port PORT]")
+    parser.add_option("--host", action="store", dest="host", type=str,
+                      default="127.0.0.1")
+    parser.add_option("--port", action="store", dest="port", type=int,
+                      default=8080)
+    add_behaviour_options(parser)
+    (options, args) = parser.parse_args(argv[1:])
+
+    collector = FakeCollector(options.host, options.port,
+                              **behaviour_kwargs(options))
+    print("Fake collector listening on {url}".format(url=collector.url))
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.server_close()
+        print("{posts} POSTs, {events} events accepted, {failed} in "
+              "failed_events, {errors} 503s, {dropped} dropped"
+              .format(**collector.stats()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Load test of send_signifai.py against a local fake collector: fires
+# --notifications notifications at --rate per second through the real
+# command line, the way Icinga/Nagios would, and reports how many
+# reached the collector, how fast, and how long each one took from
+# launch to arrival. Modes:
+#
+#   direct   one send_signifai.py per notification, POSTing itself
+#   socket   one per notification, handing it to a running --daemon
+#   spool    one per notification, spooling it for a running --drain
+#   bulk     a single --bulk process fed the notifications on stdin
+#
+# The collector can be made slow or unreliable (see fake_collector.py),
+# and arguments after "--" are passed on to every send_signifai.py.
+
+from __future__ import absolute_import, division
+
+import binascii
+import json
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_startup import SCRIPT, percentile, wait_for_socket
+from fake_collector import (FakeCollector, add_behaviour_options,
+                            behaviour_kwargs)
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+MODES = ("direct", "socket", "spool", "bulk")
+
+
+def notification(run, number):
+    # (-H, -S, output) of one notification; the output marks it
+    return ("loadhost{n}".format(n=number % 100),
+            "loadservice{n}".format(n=number),
+            "loadtest {run} {n}".format(run=run, n=number))
+
+
+def marker(event, run):
+    # The notification number an event carries, or None if it isn't
+    # one of this run's
+    words = event.get('event_description', "").split()
+    if len(words) != 3 or words[:2] != ["loadtest", run]:
+        return None
+    return int(words[2])
+
+
+class LoadTest(object):
+    def __init__(self, mode, notifications, rate, collector_kwargs=None,
+                 extra_args=(), max_procs=64, settle=30,
+                 python=sys.executable):
+        self.mode = mode
+        self.notifications = notifications
+        self.rate = rate
+        self.collector_kwargs = collector_kwargs or {}
+        self.extra_args = list(extra_args)
+        self.max_procs = max_procs
+        self.settle = settle
+        self.python = python
+        self.run_id = binascii.hexlify(os.urandom(4)).decode("ascii")
+        # launch time of each notification
+        self.launched = {}
+        self.exit_codes = []
+
+    def sender(self, collector):
+        return ([self.python, SCRIPT, "--collector", collector.url] +
+                self.extra_args)
+
+    def run(self):
+        collector = FakeCollector(**self.collector_kwargs)
+        collector.start()
+        workdir = tempfile.mkdtemp(prefix="signifai-load-")
+        background = None
+        try:
+            sender = self.sender(collector)
+            mode_args = []
+            with open(os.devnull, "w") as devnull:
+                if self.mode == "socket":
+                    socket_path = os.path.join(workdir, "signifai.sock")
+                    background = subprocess.Popen(
+                        sender + ["--daemon", "--socket", socket_path],
+                        stdout=devnull, stderr=devnull)
+                    if not wait_for_socket(socket_path):
+                        raise RuntimeError("daemon didn't come up")
+                    mode_args = ["--socket", socket_path]
+                elif self.mode == "spool":
+                    spool_dir = os.path.join(workdir, "spool")
+                    background = subprocess.Popen(
+                        sender + ["--drain", "--spool", spool_dir],
+                        stdout=devnull, stderr=devnull)
+                    mode_args = ["--spool", spool_dir]
+
+                start = time.time()
+                if self.mode == "bulk":
+                    self.fire_bulk(sender, devnull)
+                else:
+                    self.fire(sender + mode_args, devnull)
+                fired = time.time()
+                self.wait_for_arrivals(collector)
+        finally:
+            if background is not None:
+                background.terminate()
+                background.wait()
+            collector.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+        return self.report(collector, start, fired)
+
+    def schedule(self):
+        # Yields each notification number at its time to fire
+        start = time.time()
+        for number in range(self.notifications):
+            delay = start + number / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.launched[number] = time.time()
+            yield number
+
+    def fire(self, command, devnull):
+        running = []
+        for number in self.schedule():
+            while len(running) >= self.max_procs:
+                # too many still running; this holds up the schedule,
+                # which shows up as latency
+                running = self.reap(running)
+                time.sleep(0.005)
+            host, service, output = notification(self.run_id, number)
+            running.append(subprocess.Popen(
+                command + ["-H", host, "-S", service, "-s", "CRITICAL",
+                           "-o", output, "-k", "LOADKEY"],
+                stdout=devnull, stderr=devnull))
+            running = self.reap(running)
+        for proc in running:
+            self.exit_codes.append(proc.wait())
+
+    def reap(self, running):
+        still_running = []
+        for proc in running:
+            status = proc.poll()
+            if status is None:
+                still_running.append(proc)
+            else:
+                self.exit_codes.append(status)
+        return still_running
+
+    def fire_bulk(self, sender, devnull):
+        proc = subprocess.Popen(sender + ["--bulk", "-", "-k", "LOADKEY"],
+                                stdin=subprocess.PIPE, stdout=devnull,
+                                stderr=devnull)
+        for number in self.schedule():
+            host, service, output = notification(self.run_id, number)
+            record = json.dumps({"hostname": host, "service": service,
+                                 "state": "CRITICAL", "output": output})
+            proc.stdin.write((record + "\n").encode("utf-8"))
+            proc.stdin.flush()
+        proc.stdin.close()
+        self.exit_codes.append(proc.wait())
+
+    def wait_for_arrivals(self, collector):
+        # Events may still be on their way from the daemon or drainer
+        deadline = time.time() + self.settle
+        while time.time() < deadline:
+            if len(self.arrivals(collector)) >= self.notifications:
+                return
+            time.sleep(0.1)
+
+    def arrivals(self, collector):
+        # notification number -> when it first reached the collector
+        with collector.lock:
+            received = list(zip(collector.received, collector.arrivals))
+        first = {}
+        for event, arrived in received:
+            number = marker(event, self.run_id)
+            if number is not None and number not in first:
+                first[number] = arrived
+        return first
+
+    def report(self, collector, start, fired):
+        arrivals = self.arrivals(collector)
+        ours = sum(1 for event in collector.received
+                   if marker(event, self.run_id) is not None)
+        latencies = [arrived - self.launched[number]
+                     for number, arrived in arrivals.items()]
+        result = {
+            "mode": self.mode,
+            "notifications": self.notifications,
+            "target_rate": self.rate,
+            "fired_rate": self.notifications / max(fired - start, 1e-9),
+            "delivered": len(arrivals),
+            "lost": self.notifications - len(arrivals),
+            "duplicates": ours - len(arrivals),
+            "failed_processes": sum(1 for status in self.exit_codes
+                                    if status != 0),
+            "collector": collector.stats()
+        }
+        if arrivals:
+            elapsed = max(arrivals.values()) - start
+            result['throughput'] = len(arrivals) / max(elapsed, 1e-9)
+            for name, fraction in (("p50", 0.5), ("p90", 0.9),
+                                   ("p99", 0.99), ("max", 1.0)):
+                result[name + "_ms"] = percentile(latencies, fraction) * 1000
+        return result
+
+
+def print_report(result):
+    print("{mode}: {delivered}/{notifications} delivered, {lost} lost, "
+          "{duplicates} duplicates, {failed_processes} failed processes"
+          .format(**result))
+    print("  fired at {fired_rate:.1f}/s (target {target_rate:g}/s)"
+          .format(**result))
+    if 'throughput' in result:
+        print("  throughput {throughput:.1f} notifications/s".format(
+            **result))
+        print("  latency p50 {p50_ms:.0f}ms  p90 {p90_ms:.0f}ms  "
+              "p99 {p99_ms:.0f}ms  max {max_ms:.0f}ms".format(**result))
+    print("  collector: {posts} POSTs, {events} events accepted, {failed} "
+          "in failed_events, {errors} 503s, {dropped} dropped"
+          .format(**result['collector']))
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage="%prog [options] [-- send_signifai.py "
+                                "options]")
+    parser.add_option("-m", "--mode",
+                      help="How notifications are sent: {modes} "
+                           "(default direct)".format(modes=", ".join(MODES)),
+                      action="store", dest="mode", type="choice",
+                      choices=list(MODES), default="direct")
+    parser.add_option("-n", "--notifications",
+                      help="Notifications to send (default 200)",
+                      action="store", dest="notifications", type=int,
+                      default=200)
+    parser.add_option("-r", "--rate",
+                      help="Notifications fired per second (default 50)",
+                      action="store", dest="rate", type=float, default=50)
+    parser.add_option("--max-procs",
+                      help="Notification processes running at once "
+                           "(default 64)",
+                      action="store", dest="max_procs", type=int,
+                      default=64)
+    parser.add_option("--settle",
+                      help="Seconds to wait for stragglers after the last "
+                           "notification (default 30)",
+                      action="store", dest="settle", type=float, default=30)
+    parser.add_option("--output",
+                      help="Write the results to this JSON file",
+                      action="store", dest="output", type=str, default=None)
+    parser.add_option("--max-loss",
+                      help="Exit non-zero if more notifications than this "
+                           "are lost (default 0)",
+                      action="store", dest="max_loss", type=int, default=0)
+    add_behaviour_options(parser)
+    (options, args) = parser.parse_args(argv[1:])
+
+    test = LoadTest(options.mode, options.notifications, options.rate,
+                    collector_kwargs=behaviour_kwargs(options),
+                    extra_args=args, max_procs=options.max_procs,
+                    settle=options.settle)
+    result = test.run()
+    print_report(result)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    if result['lost'] > options.max_loss:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
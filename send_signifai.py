@@ -18,46 +18,128 @@
 
 from __future__ import absolute_import
 
-try:
-    # We want to be able to report to bugsnag if present,
-    # but if it's not we want to handle that gracefully
-    import bugsnag
-except ImportError:
-    bugsnag = None
-from copy import deepcopy
+import binascii
+import errno
 import json
 import logging
-try:
-    # python3
-    import http.client as http_client
-except ImportError:
-    # python2
-    import httplib as http_client
-
-from optparse import OptionParser
+from optparse import OptionParser, Values
 import os
 import socket
 import sys
 import time
 
+# Everything else (http.client and ssl above all, but also bugsnag and
+# the threading and locking modules) is imported where it's used, so
+# that handing an event to the daemon or the spool starts up quickly
+
 __author__ = "SignifAI, Inc."
 __copyright__ = "Copyright (C) 2018, SignifAI, Inc."
 __version__ = "1.0"
 __license__ = "ASLv2"
 
+# python2 has no monotonic clock
+monotonic = getattr(time, "monotonic", time.time)
+
 DEFAULT_POST_URI = "/v1/incidents"
+# Upper bound on a single client -> daemon message
+DAEMON_MAX_MESSAGE = 4 * 1024 * 1024
+# Stable per-event ID, so the collector can recognise retried events
+EVENT_ID_ATTRIBUTE = "alert/event_id"
+# report['error'] kinds after which the POST itself may be retried
+RETRYABLE_ERRORS = frozenset([
+    "request", "request_timeout", "response", "response_timeout"
+])
+# Events a coalesced event replaced, and how many of them changed state
+COALESCED_ATTRIBUTE = "alert/coalesced"
+TRANSITIONS_ATTRIBUTE = "alert/transitions"
+# Service alarms a host DOWN event stands in for: how many, which
+# services and how many of each value
+ROLLUP_ATTRIBUTE = "alert/rolled_up"
+ROLLUP_SERVICES_ATTRIBUTE = "alert/rolled_up_services"
+ROLLUP_VALUES_ATTRIBUTE = "alert/rolled_up_values"
+# Times an event the collector listed in failed_events is resent
+DEFAULT_EVENT_RETRIES = 3
+# Queued messages the prioritising daemon looks at before sending
+PRIORITY_BURST = 1000
+# Batch caps for multi-event POSTs
+DEFAULT_BATCH_EVENTS = 100
+DEFAULT_BATCH_BYTES = 512 * 1024
+DEFAULT_BATCH_LINGER = 1.0
+# Longest wait, in seconds, for a --rate-limit turn (Retry-After included)
+DEFAULT_RATE_MAX_WAIT = 10
+# Bytes per chunk of a streamed (--stream) request body
+STREAM_CHUNK = 64 * 1024
+# Upper bounds, in seconds, of the --stats-file timing histograms
+PHASE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Minutes of per-minute figures the --stats-file keeps
+RECENT_MINUTES = 15
+# POST_attempt phases timed by the connection, and its attributes for them
+CONNECTION_PHASES = (("dns", "dns_time"), ("connect", "connect_time"),
+                     ("tls", "handshake_time"))
+# Default collector; --collector overrides it
+DEFAULT_COLLECTOR = "https://collectors.signifai.io"
 ICINGIOS2PRI = {
     "WARNING": "medium",
     "CRITICAL": "critical",
     "DOWN": "critical",
     "UNKNOWN": "low"
 }
+ICINGIOS_SERVICE_STATES = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
+ICINGIOS_HOST_STATES = ["UP", "DOWN"]
+# UP is akin to OK, DOWN is akin to CRITICAL
+HOST2SVC_STATES = {
+    "UP": "OK",
+    "DOWN": "CRITICAL"
+}
+# OK is akin to UP, everything else is akin to DOWN
+SVC2HOST_STATES = {
+    "OK": "UP",
+    "WARNING": "DOWN",
+    "CRITICAL": "DOWN",
+    "UNKNOWN": "DOWN"
+}
+# Event attributes naming what a monitoring host (UNKNOWN) event is about
+TARGET_HOST_ATTRIBUTE = "application/target/host/name"
+TARGET_APPLICATION_ATTRIBUTE = "application/target/application/name"
+TARGET_SERVICE_ATTRIBUTE = "application/target/service/name"
+MONITORING_HOST_ATTRIBUTE = "alert/monitoring_host"
+
+
+def import_http_client():
+    try:
+        # python3
+        import http.client as http_client
+    except ImportError:
+        # python2
+        import httplib as http_client
+    return http_client
+
+
+def import_queue():
+    try:
+        # python3
+        import queue
+    except ImportError:
+        # python2
+        import Queue as queue
+    return queue
+
+
+def import_bugsnag():
+    try:
+        # We want to be able to report to bugsnag if present,
+        # but if it's not we want to handle that gracefully
+        import bugsnag
+    except ImportError:
+        bugsnag = None
+    return bugsnag
 
 
 def bugsnag_notify(exception, metadata, log=None):
     if not log:
         log = logging.getLogger("bugsnag_unattached_notify")
 
+    bugsnag = import_bugsnag()
     if not bugsnag:
         log.warning("Can't notify bugsnag: module not installed!")
         return True
@@ -69,37 +151,811 @@ def bugsnag_notify(exception, metadata, log=None):
         log.warning("Failed to notify bugsnag anyway", exc_info=True)
 
 
-def POST_data(auth_key, data,
-              signifai_host="collectors.signifai.io",
-              signifai_port=http_client.HTTPS_PORT,
-              signifai_uri=DEFAULT_POST_URI,
-              timeout=5,
-              attempts=5,
-              httpsconn=http_client.HTTPSConnection):
+class ConnectionPool(object):
+    # Idle keep-alive connections to the collector, for callers that
+    # POST more than once (daemon, drainer). Connections are kept per
+    # (connection class, host, port) and at most maxsize of each are
+    # kept idle.
+    def __init__(self, maxsize=4, max_idle=30, clock=monotonic):
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.clock = clock
+        self.idle = {}
+        import threading
+        self.lock = threading.Lock()
+
+    def healthy(self, conn, idle_since):
+        if self.clock() - idle_since > self.max_idle:
+            # the collector has most likely timed it out already
+            return False
+        sock = getattr(conn, "sock", False)
+        if sock is False:
+            # not a socket-backed connection (e.g. a test mock)
+            return True
+        if sock is None:
+            return False
+        import select
+        try:
+            # an idle keep-alive socket must have nothing to read; if
+            # it's readable the server closed it (or sent junk)
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, ValueError, socket.error):
+            return False
+        return not readable
+
+    def acquire(self, key):
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                if not idle:
+                    return None
+                conn, idle_since = idle.pop()
+            if self.healthy(conn, idle_since):
+                return conn
+            conn.close()
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, self.clock()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+
+class TLSSessionCache(object):
+    # Last TLS session per collector, so new connections can resume it
+    # with an abbreviated handshake instead of a full one
+    def __init__(self, ttl=300, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.sessions = {}
+        import threading
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            cached = self.sessions.get(key)
+            if cached is None:
+                return None
+            session, expires = cached
+            if self.clock() >= expires:
+                del self.sessions[key]
+                return None
+            return session
+
+    def put(self, key, session):
+        if session is None:
+            return
+        # never hold on to a session past the server's lifetime for it
+        lifetime = min(self.ttl, getattr(session, "timeout", self.ttl))
+        expires = getattr(session, "time", self.clock()) + lifetime
+        with self.lock:
+            self.sessions[key] = (session, expires)
+
+
+class DNSCache(object):
+    # File-backed cache of collector addresses shared by every
+    # invocation, so notification storms don't each hit the resolver
+    def __init__(self, path, ttl=300, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.log = logging.getLogger("http_post")
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as cache_file:
+                cache = json.loads(cache_file.read().decode("utf-8"))
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def save(self, cache):
+        tmp_path = "{path}.{pid}.tmp".format(path=self.path, pid=os.getpid())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o644)
+            try:
+                os.write(fd, json.dumps(cache).encode("utf-8"))
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # a cache we can't write is just a cache miss next time
+            self.log.warning("Couldn't write DNS cache {path}"
+                             .format(path=self.path), exc_info=True)
+
+    def resolve(self, host, port):
+        return [[family, list(sockaddr)] for family, _, _, _, sockaddr
+                in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+
+    def lookup(self, host, port):
+        # Returns [(family, sockaddr), ...], from the cache if fresh
+        key = "{host}:{port}".format(host=host, port=port)
+        cache = self.load()
+        cached = cache.get(key)
+        now = self.clock()
+        if cached and cached['expires'] > now:
+            addresses = cached['addresses']
+        else:
+            try:
+                addresses = self.resolve(host, port)
+            except socket.gaierror:
+                if not cached:
+                    raise
+                # resolver trouble; stale addresses beat none at all
+                self.log.warning("Couldn't resolve {host}, using stale "
+                                 "cached addresses".format(host=host))
+                addresses = cached['addresses']
+            else:
+                cache[key] = {"expires": now + self.ttl,
+                              "addresses": addresses}
+                self.save(cache)
+        return [(family, tuple(sockaddr)) for family, sockaddr in addresses]
+
+
+class SignifaiHTTPSConnection(object):
+    # Mixed into http.client's HTTPSConnection by connection_class (or
+    # HTTPConnection, for a plain-HTTP collector). Times the TLS
+    # handshake and, given a session_cache, resumes earlier TLS
+    # sessions with the collector. Given a dns_cache, it connects to
+    # the cached addresses. The http.client class is called as base
+    # rather than through super(), which python2's classic
+    # HTTPSConnection doesn't take part in.
+    base = None
+    session_cache = None
+    dns_cache = None
+    dns_time = 0
+    tls = True
+    # the delivery deadline (a monotonic() time), set by
+    # connect_collector; no address may be tried past it
+    expires = None
+
+    def __init__(self, *args, **kwargs):
+        self.base.__init__(self, *args, **kwargs)
+        # http.client looks this up on the instance
+        self._create_connection = self.create_connection
+
+    def create_connection(self, address, timeout, source_address=None):
+        # socket.create_connection, resolving the address separately so
+        # that the lookup can be timed (and cached)
+        host, port = address
+        start = monotonic()
+        if self.dns_cache is None:
+            addresses = [(family, sockaddr) for family, _, _, _, sockaddr
+                         in socket.getaddrinfo(host, port, 0,
+                                               socket.SOCK_STREAM)]
+        else:
+            addresses = self.dns_cache.lookup(host, port)
+        self.dns_time = monotonic() - start
+        error = socket.error("getaddrinfo returned no addresses")
+        for family, sockaddr in addresses:
+            address_timeout = time_left(self.expires, timeout)
+            if address_timeout <= 0:
+                # connect_collector reports the deadline
+                raise socket.timeout("delivery deadline exceeded")
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(address_timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+            except socket.error as exc:
+                # timeouts included: the next address may well answer
+                sock.close()
+                error = exc
+                continue
+            return sock
+        # cached addresses stay until their TTL runs out: a collector
+        # that's down mustn't send every invocation to the resolver
+        raise error
+
+    def connect(self):
+        log = logging.getLogger("http_post")
+        start = monotonic()
+        import_http_client().HTTPConnection.connect(self)
+        self.connect_time = monotonic() - start - self.dns_time
+        if not self.tls:
+            return
+
+        server_hostname = self._tunnel_host or self.host
+        key = (server_hostname, self.port)
+        session = None
+        if self.session_cache is not None:
+            session = self.session_cache.get(key)
+
+        start = monotonic()
+        if session is not None:
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname, session=session)
+        else:
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname)
+        self.handshake_time = monotonic() - start
+        self.session_reused = getattr(self.sock, "session_reused", False)
+        log.debug("TLS handshake with {host} took {ms:.1f}ms ({kind})"
+                  .format(host=server_hostname,
+                          ms=self.handshake_time * 1000,
+                          kind="resumed" if self.session_reused
+                          else "full"))
+
+    def remember_session(self):
+        # TLS 1.3 hands out session tickets after the handshake, so
+        # only keep the session once we've read something
+        if (self.tls and self.session_cache is not None and
+                self.sock is not None):
+            self.session_cache.put((self._tunnel_host or self.host,
+                                    self.port),
+                                   getattr(self.sock, "session", None))
+
+    def getresponse(self):
+        res = self.base.getresponse(self)
+        self.remember_session()
+        return res
+
+    def close(self):
+        # getresponse closes "Connection: close" responses itself
+        self.remember_session()
+        self.base.close(self)
+
+
+def connection_class(session_cache=None, dns_cache=None, tls=True):
+    # A SignifaiHTTPSConnection bound to the given caches, usable as
+    # POST_data's httpsconn
+    http_client = import_http_client()
+    if tls:
+        return type("SignifaiHTTPSConnection",
+                    (SignifaiHTTPSConnection, http_client.HTTPSConnection),
+                    {"base": http_client.HTTPSConnection,
+                     "session_cache": session_cache,
+                     "dns_cache": dns_cache})
+    return type("SignifaiHTTPConnection",
+                (SignifaiHTTPSConnection, http_client.HTTPConnection),
+                {"base": http_client.HTTPConnection, "dns_cache": dns_cache,
+                 "tls": False})
+
+
+_default_connection_class = None
+
+
+def default_connection_class():
+    # Always the same class, so the pool finds connections made with
+    # it again
+    global _default_connection_class
+    if _default_connection_class is None:
+        _default_connection_class = connection_class()
+    return _default_connection_class
+
+
+def parse_collector(url):
+    # "https://host[:port]" -> (tls, host, port); ValueError if it
+    # isn't a collector URL we can use
+    scheme, sep, rest = url.partition("://")
+    if not sep or scheme not in ("http", "https"):
+        raise ValueError("collector URL must be http:// or https://")
+    tls = scheme == "https"
+    host, sep, port = rest.rstrip("/").partition(":")
+    if not host or "/" in host or "/" in port:
+        raise ValueError("collector URL must be scheme://host[:port]")
+    if port:
+        port = int(port)
+    else:
+        port = 443 if tls else 80
+    return (tls, host, port)
+
+
+def time_left(expires, default):
+    # Seconds left before the delivery deadline, or default without one
+    if expires is None:
+        return default
+    return min(default, expires - monotonic())
+
+
+class CircuitBreaker(object):
+    # Collector circuit shared by every invocation through a small
+    # locked state file. After threshold consecutive failures it opens
+    # and nobody sends for reset_timeout seconds; then a single caller
+    # gets to probe (half-open) while the rest keep failing fast.
+    def __init__(self, path, threshold=5, reset_timeout=30,
+                 clock=time.time):
+        self.path = path
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.log = logging.getLogger("http_post")
+
+    def update(self, change):
+        # Run change(state) under the lock, saving the state afterwards;
+        # returns whatever change returns
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            # no shared state; behave like a closed circuit
+            self.log.warning("Couldn't open circuit breaker state {path}"
+                             .format(path=self.path), exc_info=True)
+            return True
+        import fcntl
+        state_file = os.fdopen(fd, "r+")
+        try:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state = json.loads(state_file.read())
+            except ValueError:
+                state = {}
+            state.setdefault('failures', 0)
+            state.setdefault('opened_at', None)
+            state.setdefault('probe_until', None)
+            result = change(state)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            state_file.flush()
+            return result
+        finally:
+            state_file.close()
+
+    def allow(self):
+        def change(state):
+            if state['opened_at'] is None:
+                return True
+            now = self.clock()
+            if now - state['opened_at'] < self.reset_timeout:
+                return False
+            if (state['probe_until'] is not None and
+                    now < state['probe_until']):
+                # somebody else is probing already
+                return False
+            state['probe_until'] = now + self.reset_timeout
+            self.log.info("Collector circuit half-open, probing")
+            return True
+        return self.update(change)
+
+    def record_success(self):
+        def change(state):
+            if state['opened_at'] is not None:
+                self.log.info("Collector circuit closed")
+            state['failures'] = 0
+            state['opened_at'] = None
+            state['probe_until'] = None
+        self.update(change)
+
+    def record_failure(self):
+        def change(state):
+            state['failures'] += 1
+            probing = state['probe_until'] is not None
+            if probing or (state['opened_at'] is None and
+                           state['failures'] >= self.threshold):
+                self.log.warning("Collector circuit open after {n} "
+                                 "consecutive failures"
+                                 .format(n=state['failures']))
+                state['opened_at'] = self.clock()
+                state['probe_until'] = None
+        self.update(change)
+
+
+class RateLimiter(object):
+    # Token bucket per auth key: rate POSTs per second, bursts of up to
+    # burst. Given a path, the buckets live in a locked state file so
+    # every invocation shares them. When the collector is overloaded
+    # (429/5xx) the key's rate halves (down to a sixteenth) and nobody
+    # sends until its Retry-After has passed; each success then wins
+    # back a tenth of the rate. Senders wait at most max_wait seconds
+    # for their turn.
+    def __init__(self, path=None, rate=10, burst=None,
+                 max_wait=DEFAULT_RATE_MAX_WAIT, clock=time.time):
+        import threading
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.max_wait = max_wait
+        self.clock = clock
+        self.state = {}
+        self.lock = threading.Lock()
+        self.log = logging.getLogger("http_post")
+
+    def update(self, change):
+        # Run change(state) under the lock, saving the state afterwards;
+        # returns whatever change returns
+        if self.path is None:
+            with self.lock:
+                return change(self.state)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            self.log.warning("Couldn't open rate limit state {path}"
+                             .format(path=self.path), exc_info=True)
+            with self.lock:
+                return change(self.state)
+        import fcntl
+        state_file = os.fdopen(fd, "r+")
+        try:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state = json.loads(state_file.read())
+            except ValueError:
+                state = {}
+            result = change(state)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            state_file.flush()
+            return result
+        finally:
+            state_file.close()
+
+    def bucket(self, state, auth_key):
+        # The key's bucket, refilled up to now; keys are stored hashed
+        import hashlib
+        key = hashlib.sha1(auth_key.encode("utf-8")).hexdigest()[:16]
+        now = self.clock()
+        bucket = state.setdefault(key, {
+            "tokens": self.burst, "updated": now, "rate": self.rate,
+            "blocked_until": 0
+        })
+        elapsed = max(0, now - bucket['updated'])
+        bucket['tokens'] = min(self.burst,
+                               bucket['tokens'] + elapsed * bucket['rate'])
+        bucket['updated'] = now
+        return bucket
+
+    def acquire(self, auth_key):
+        # Takes a token; returns 0, or the seconds to wait before
+        # there is one
+        def change(state):
+            bucket = self.bucket(state, auth_key)
+            if bucket['blocked_until'] > bucket['updated']:
+                return bucket['blocked_until'] - bucket['updated']
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return 0
+            return (1 - bucket['tokens']) / bucket['rate']
+        return self.update(change)
+
+    def record_overload(self, auth_key, retry_after=None):
+        def change(state):
+            bucket = self.bucket(state, auth_key)
+            bucket['rate'] = max(self.rate / 16, bucket['rate'] / 2)
+            bucket['tokens'] = 0
+            if retry_after is None:
+                pause = 1 / bucket['rate']
+            else:
+                pause = retry_after
+            bucket['blocked_until'] = max(bucket['blocked_until'],
+                                          bucket['updated'] + pause)
+            self.log.warning("Collector overloaded, sending at most "
+                             "{rate:.2f} POSTs/s, next in {pause:.1f}s"
+                             .format(rate=bucket['rate'], pause=pause))
+        self.update(change)
+
+    def record_success(self, auth_key):
+        def change(state):
+            bucket = self.bucket(state, auth_key)
+            if bucket['rate'] < self.rate:
+                bucket['rate'] = min(self.rate,
+                                     bucket['rate'] + self.rate / 10)
+        self.update(change)
+
+
+def overloaded(report):
+    # True if the collector asked us to slow down
+    status = report.get('status')
+    return status is not None and (status == 429 or status >= 500)
+
+
+def parse_retry_after(value):
+    # Seconds to wait from a Retry-After header (delay or HTTP date),
+    # None if there's no usable one
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    from email.utils import mktime_tz, parsedate_tz
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, mktime_tz(parsed) - time.time())
+
+
+def throttled(limiter, wait, expires, report):
+    # True (and report['error'] "throttled") if a wait for the rate
+    # limiter would be past the deadline or longer than it allows
+    if wait > limiter.max_wait:
+        reason = "for {wait:.0f}s".format(wait=wait)
+    elif expires is not None and monotonic() + wait >= expires:
+        reason = "until past the delivery deadline"
+    else:
+        return False
+    logging.getLogger("http_post").warning(
+        "Rate limited {reason}, not sending".format(reason=reason))
+    report['error'] = "throttled"
+    report.setdefault('status', None)
+    return True
+
+
+def wait_for_token(limiter, auth_key, expires, report):
+    # Waits until the rate limiter lets a POST through; False if it
+    # won't in time (see throttled)
     log = logging.getLogger("http_post")
+    while True:
+        wait = limiter.acquire(auth_key)
+        if wait <= 0:
+            return True
+        if throttled(limiter, wait, expires, report):
+            return False
+        log.info("Rate limited, waiting {wait:.2f}s".format(wait=wait))
+        time.sleep(wait)
+
+
+class Metrics(object):
+    # How long each phase of a POST took (histograms over PHASE_BUCKETS)
+    # and counts of deliveries, attempts, retries, events and failures
+    # by report['error'] kind. Recording only touches memory; flush()
+    # adds it all to a locked JSON stats file shared by every
+    # invocation and, given prometheus_path, rewrites a Prometheus
+    # textfile (for node_exporter's textfile collector) from the totals.
+    def __init__(self, path, prometheus_path=None, clock=time.time):
+        import threading
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = self.empty()
+        self.stopping = None
+        self.log = logging.getLogger("http_post")
+
+    def empty(self):
+        return {"counters": {}, "failures": {}, "phases": {}}
+
+    def count(self, name, n=1):
+        with self.lock:
+            counters = self.pending['counters']
+            counters[name] = counters.get(name, 0) + n
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            self.add_timing(self.pending, phase, seconds)
+
+    def add_timing(self, state, phase, seconds):
+        timing = state['phases'].get(phase)
+        if timing is None:
+            timing = state['phases'][phase] = empty_timing()
+        timing['count'] += 1
+        timing['sum'] += seconds
+        bucket = 0
+        while bucket < len(PHASE_BUCKETS) and seconds > PHASE_BUCKETS[bucket]:
+            bucket += 1
+        timing['buckets'][bucket] += 1
+
+    def record_attempt(self, report):
+        # One POST_attempt, from its report
+        with self.lock:
+            state = self.pending
+            for phase, seconds in report.get('timings', {}).items():
+                self.add_timing(state, phase, seconds)
+            counters = state['counters']
+            counters['attempts'] = counters.get('attempts', 0) + 1
+            retries = report.get('connect_retries', 0)
+            counters['connect_retries'] = (
+                counters.get('connect_retries', 0) + retries)
+            error = report.get('error')
+            if error is not None:
+                failures = state['failures']
+                failures[error] = failures.get(error, 0) + 1
+
+    def record_delivery(self, data, result, report, seconds, tries):
+        # One POST_data: events delivered or not, and how long it took
+        events = len(data['events'])
+        if result:
+            failed = 0
+        elif result is None:
+            failed = len(report.get('failed_events') or [])
+        else:
+            failed = events
+        counts = {
+            "deliveries": 1,
+            "deliveries_failed": 1 if result is False else 0,
+            "retries": max(0, tries - 1),
+            "events_sent": events - failed,
+            "events_failed": failed
+        }
+        with self.lock:
+            state = self.pending
+            self.add_timing(state, "delivery", seconds)
+            counters = state['counters']
+            for name, n in counts.items():
+                counters[name] = counters.get(name, 0) + n
+            if not tries and report.get('error') is not None:
+                # never got as far as an attempt (circuit open, throttled)
+                failures = state['failures']
+                failures[report['error']] = (
+                    failures.get(report['error'], 0) + 1)
+
+    def update(self, change):
+        # Run change(state) on the stats file under its lock, saving the
+        # state afterwards; returns the new state
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self.log.warning("Couldn't open stats file {path}"
+                             .format(path=self.path), exc_info=True)
+            return None
+        import fcntl
+        state_file = os.fdopen(fd, "r+")
+        try:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state = json.loads(state_file.read())
+            except ValueError:
+                state = {}
+            for key, value in self.empty().items():
+                state.setdefault(key, value)
+            change(state)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state, sort_keys=True))
+            state_file.flush()
+            return state
+        finally:
+            state_file.close()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, self.empty()
+        if not pending['counters'] and not pending['phases']:
+            return
+
+        def change(state):
+            now = self.clock()
+            state.setdefault('started', now)
+            state['updated'] = now
+            for section in ("counters", "failures"):
+                totals = state[section]
+                for name, n in pending[section].items():
+                    totals[name] = totals.get(name, 0) + n
+            for phase, timing in pending['phases'].items():
+                add_timings(state['phases'].setdefault(phase, empty_timing()),
+                            timing)
+            self.add_recent(state, pending, now)
+        state = self.update(change)
+        if state is not None and self.prometheus_path:
+            self.write_prometheus(state)
+
+    def add_recent(self, state, pending, now):
+        # Per-minute deliveries, failures, events and delivery timings
+        # for the last RECENT_MINUTES minutes, so check_signifai.py can
+        # tell rates without keeping state of its own
+        minute = int(now // 60) * 60
+        recent = [window for window in state.get('recent', [])
+                  if window['minute'] > minute - RECENT_MINUTES * 60]
+        if not recent or recent[-1]['minute'] != minute:
+            recent.append({"minute": minute, "deliveries": 0,
+                           "deliveries_failed": 0, "events_sent": 0,
+                           "events_failed": 0, "delivery": empty_timing()})
+        window = recent[-1]
+        for name in ("deliveries", "deliveries_failed", "events_sent",
+                     "events_failed"):
+            window[name] += pending['counters'].get(name, 0)
+        if "delivery" in pending['phases']:
+            add_timings(window['delivery'], pending['phases']['delivery'])
+        state['recent'] = recent
+
+    def write_prometheus(self, state):
+        tmp_path = "{path}.{pid}.tmp".format(path=self.prometheus_path,
+                                             pid=os.getpid())
+        try:
+            with open(tmp_path, "w") as prom_file:
+                prom_file.write(prometheus_text(state))
+            os.rename(tmp_path, self.prometheus_path)
+        except (IOError, OSError):
+            self.log.warning("Couldn't write {path}"
+                             .format(path=self.prometheus_path),
+                             exc_info=True)
+
+    def start(self, interval):
+        # Flushes every interval seconds from a background thread, for
+        # long-running senders, until stop()
+        import threading
+        self.stopping = threading.Event()
+
+        def run(stopping):
+            while not stopping.wait(interval):
+                try:
+                    self.flush()
+                except Exception:
+                    self.log.error("Couldn't flush metrics", exc_info=True)
+
+        thread = threading.Thread(target=run, args=(self.stopping,),
+                                  name="metrics")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+        self.flush()
+
+
+def empty_timing():
+    return {"count": 0, "sum": 0, "buckets": [0] * (len(PHASE_BUCKETS) + 1)}
+
+
+def add_timings(total, timing):
+    total['count'] += timing['count']
+    total['sum'] += timing['sum']
+    total['buckets'] = [a + b for a, b in zip(total['buckets'],
+                                              timing['buckets'])]
+
+
+def prometheus_text(state):
+    # A stats file's totals in the Prometheus text exposition format
+    lines = []
+    for name, n in sorted(state['counters'].items()):
+        metric = "signifai_{name}_total".format(name=name)
+        lines.append("# TYPE {metric} counter".format(metric=metric))
+        lines.append("{metric} {n}".format(metric=metric, n=n))
+    lines.append("# TYPE signifai_post_failures_total counter")
+    for error, n in sorted(state['failures'].items()):
+        lines.append('signifai_post_failures_total{{error="{error}"}} {n}'
+                     .format(error=error, n=n))
+    lines.append("# TYPE signifai_phase_seconds histogram")
+    for phase, timing in sorted(state['phases'].items()):
+        cumulative = 0
+        for bound, n in zip(PHASE_BUCKETS + ("+Inf",), timing['buckets']):
+            cumulative += n
+            lines.append('signifai_phase_seconds_bucket{{phase="{phase}",'
+                         'le="{bound}"}} {n}'.format(phase=phase, bound=bound,
+                                                     n=cumulative))
+        lines.append('signifai_phase_seconds_sum{{phase="{phase}"}} {sum}'
+                     .format(phase=phase, sum=timing['sum']))
+        lines.append('signifai_phase_seconds_count{{phase="{phase}"}} '
+                     '{count}'.format(phase=phase, count=timing['count']))
+    if 'updated' in state:
+        lines.append("# TYPE signifai_stats_updated_seconds gauge")
+        lines.append("signifai_stats_updated_seconds {updated}"
+                     .format(updated=state['updated']))
+    return "\n".join(lines) + "\n"
+
+
+def connect_collector(log, bmd, signifai_host, signifai_port, timeout,
+                      attempts, httpsconn, expires=None, report=None):
+    # Returns a connected client, or None once we've given up
+    http_client = import_http_client()
+    if report is None:
+        report = {}
     client = None
     retries = 0
-    bmd = {
-        "data": data,
-        "signifai_host": signifai_host,
-        "signifai_port": signifai_port,
-        "signifai_uri": signifai_uri,
-        "timeout": timeout,
-        "retries": retries,
-        "attempts": attempts,
-        "httpsconn_class": httpsconn.__name__
-    }
     while client is None and retries < attempts:
         bmd['retries'] = retries
+        report['connect_retries'] = retries
+        attempt_timeout = time_left(expires, timeout)
+        if attempt_timeout <= 0:
+            log.fatal("Delivery deadline exceeded while connecting")
+            bugsnag_notify(socket.timeout, bmd)
+            report['error'] = "deadline"
+            return None
         try:
             client = httpsconn(host=signifai_host,
                                port=signifai_port,
-                               timeout=timeout)
+                               timeout=attempt_timeout)
         except http_client.HTTPException as http_exc:
             # uh, if we can't even create the object, we're toast
             log.fatal("Couldn't create HTTP connection object", exc_info=True)
             bugsnag_notify(http_exc, bmd)
-            return False
+            report['error'] = "connect"
+            return None
+        client.expires = expires
 
         try:
             client.connect()
@@ -114,169 +970,890 @@ def POST_data(auth_key, data,
         except (http_client.HTTPException, socket.error) as http_exc:
             log.fatal("Couldn't connect to SignifAi collector", exc_info=True)
             bugsnag_notify(http_exc, bmd)
-            return False
+            client.close()
+            report['error'] = "connect"
+            return None
 
     if client is None and retries == attempts:
         # we expired
         log.fatal("Could not connect successfully after {attempts} attempts"
                   .format(attempts=attempts))
         bugsnag_notify(socket.timeout, bmd)
-        return False
-    else:
-        headers = {
-            "Authorization": "Bearer {auth_key}".format(auth_key=auth_key),
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-        bmd['headers'] = headers
-        res = None
-        try:
-            client.request("POST", signifai_uri, body=json.dumps(data),
-                           headers=headers)
-        except socket.timeout as exc:
-            # ... don't think we should retry the POST
-            log.fatal("POST timed out...?")
-            bugsnag_notify(exc, bmd)
-            return False
-        except (http_client.HTTPException, socket.error) as http_exc:
-            # nope
-            log.fatal("Couldn't POST to SignifAi Collector", exc_info=True)
-            bugsnag_notify(http_exc, bmd)
-            return False
+        report['error'] = "connect_timeout"
+    return client
 
-        try:
-            res = client.getresponse()
-        except socket.timeout as exc:
-            # ... don't think we should retry here
-            log.fatal("Response from server timed out...?")
-            bugsnag_notify(exc, bmd)
-            return False
-        except (http_client.HTTPException, socket.error) as http_exc:
-            log.fatal("Couldn't get server response")
-            bugsnag_notify(http_exc, bmd)
-            return False
 
-        if 200 <= res.status < 300:
-            response_text = None
+def set_phase_timeout(client, timeout):
+    # http.client only applies its timeout when connecting; later
+    # phases run on whatever the socket has
+    client.timeout = timeout
+    sock = getattr(client, "sock", None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+def POST_attempt(auth_key, data, signifai_host, signifai_port, signifai_uri,
+                 timeout, attempts, httpsconn, pool, expires, report,
+                 gzip_min=None, stream=False):
+    # One delivery over one connection; see POST_data
+    log = logging.getLogger("http_post")
+    http_client = import_http_client()
+    report['error'] = None
+    report['status'] = None
+    report['failed_events'] = None
+    report['retry_after'] = None
+    report['connect_retries'] = 0
+    timings = report['timings'] = {}
+    client = None
+    reused = False
+    reusable = False
+    pool_key = (httpsconn, signifai_host, signifai_port)
+    bmd = {
+        "data": data,
+        "signifai_host": signifai_host,
+        "signifai_port": signifai_port,
+        "signifai_uri": signifai_uri,
+        "timeout": timeout,
+        "retries": 0,
+        "attempts": attempts,
+        "httpsconn_class": httpsconn.__name__
+    }
+    headers = request_headers(auth_key, data)
+    encode = stream_body if stream else request_body
+
+    if pool is not None:
+        client = pool.acquire(pool_key)
+        reused = client is not None
+        if reused:
+            # in case http.client reconnects it itself
+            client.expires = expires
+
+    try:
+        while True:
+            if client is None:
+                client = connect_collector(log, bmd, signifai_host,
+                                           signifai_port, timeout, attempts,
+                                           httpsconn, expires, report)
+                if client is None:
+                    return False
+                for phase, attribute in CONNECTION_PHASES:
+                    seconds = getattr(client, attribute, None)
+                    if seconds is not None:
+                        timings[phase] = seconds
+
+            # a streamed body can only be sent once, so each connection
+            # gets its own
+            body = encode(data, headers, gzip_min)
+            report['compressed'] = "Content-Encoding" in headers
+            report['streamed'] = "Transfer-Encoding" in headers
+            bmd['headers'] = headers
+            res = None
+            phase_timeout = time_left(expires, timeout)
+            if phase_timeout <= 0:
+                log.fatal("Delivery deadline exceeded before POST")
+                bugsnag_notify(socket.timeout, bmd)
+                report['error'] = "deadline"
+                return False
+            set_phase_timeout(client, phase_timeout)
+            start = monotonic()
             try:
-                response_text = res.read()
-                bmd['collector_response'] = response_text
-                collector_response = json.loads(response_text)
-            except ValueError as exc:
-                log.fatal("Didn't receive valid JSON response from collector")
+                if report['streamed']:
+                    send_chunked(client, signifai_uri, headers, body)
+                else:
+                    client.request("POST", signifai_uri, body=body,
+                                   headers=headers)
+            except socket.timeout as exc:
+                # POST_data decides whether the POST is retried
+                log.fatal("POST timed out...?")
+                bugsnag_notify(exc, bmd)
+                report['error'] = "request_timeout"
+                return False
+            except (http_client.HTTPException, socket.error) as http_exc:
+                if reused:
+                    # the pooled connection went stale while idle
+                    log.info("Pooled connection went stale, reconnecting")
+                    client.close()
+                    client = None
+                    reused = False
+                    continue
+                # nope
+                log.fatal("Couldn't POST to SignifAi Collector",
+                          exc_info=True)
+                bugsnag_notify(http_exc, bmd)
+                report['error'] = "request"
+                return False
+            timings['request'] = monotonic() - start
+
+            phase_timeout = time_left(expires, timeout)
+            if phase_timeout <= 0:
+                log.fatal("Delivery deadline exceeded waiting for response")
+                bugsnag_notify(socket.timeout, bmd)
+                report['error'] = "deadline"
+                return False
+            set_phase_timeout(client, phase_timeout)
+            start = monotonic()
+            try:
+                res = client.getresponse()
+            except socket.timeout as exc:
+                # as above, POST_data retries if attempts are left
+                log.fatal("Response from server timed out...?")
                 bugsnag_notify(exc, bmd)
+                report['error'] = "response_timeout"
                 return False
+            except (http_client.HTTPException, socket.error) as http_exc:
+                if reused:
+                    # closed by the server before it read our request
+                    log.info("Pooled connection went stale, reconnecting")
+                    client.close()
+                    client = None
+                    reused = False
+                    continue
+                log.fatal("Couldn't get server response")
+                bugsnag_notify(http_exc, bmd)
+                report['error'] = "response"
+                return False
+            timings['response'] = monotonic() - start
+            break
+
+        report['status'] = res.status
+        start = monotonic()
+        if 200 <= res.status < 300:
+            try:
+                response_text = res.read()
             except IOError as exc:
                 log.fatal("Couldn't read response from collector",
                           exc_info=True)
                 bugsnag_notify(exc, bmd)
-            else:
-                if (not collector_response['success'] or
-                        collector_response['failed_events']):
-                    errs = collector_response['failed_events']
-                    log.fatal("Errors submitting events: {errs}"
-                              .format(errs=errs))
-                    # Treat it like a ValueError for bugsnag
-                    bmd['failed_events'] = collector_response['failed_events']
-                    bugsnag_notify(ValueError("errors submitting events"), bmd)
-                    # not really False but not really True
-                    return None
-                else:
-                    return True
+                report['error'] = "read"
+                return None
         else:
-            log.fatal("Received error from SignifAi Collector, body follows: ")
+            report['retry_after'] = parse_retry_after(
+                res.getheader("Retry-After"))
             response_text = res.read()
-            bmd['collector_response'] = response_text
-            log.fatal(response_text)
-
-            bugsnag_notify(ValueError("Error from SignifAi collector"), bmd)
+        timings['read'] = monotonic() - start
+        reusable = not getattr(res, "will_close", False)
+        if gzip_refused(report) or stream_refused(report):
+            # POST_data sends it again the plain way
+            report['error'] = "status"
             return False
+        if not 200 <= res.status < 300:
+            log.fatal("Received error from SignifAi Collector, body "
+                      "follows: ")
+        return collector_reply(res.status, response_text, report, bmd)
+    finally:
+        if client is not None:
+            if pool is not None and reusable:
+                pool.release(pool_key, client)
+            else:
+                client.close()
 
 
-def try_get_env(*possibilities):
-    value = None
-    for which in possibilities:
-        try:
-            value = os.environ[which].strip()
-        except KeyError:
-            pass
-        else:
-            break
-    return value
+def request_headers(auth_key, data):
+    headers = {
+        "Authorization": "Bearer {auth_key}".format(auth_key=auth_key),
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    key = idempotency_key(data)
+    if key is not None:
+        headers['Idempotency-Key'] = key
+    return headers
 
 
-def icingios_get_env(macro_name, default=None):
-    macro = macro_name.upper()
-    icinga_env_var = "ICINGA_{macro}".format(macro=macro)
-    nagios_env_var = "NAGIOS_{macro}".format(macro=macro)
-    ret = try_get_env(icinga_env_var, nagios_env_var, macro)
-    if ret is None:
-        return default
-    return ret
+# (host, port) of collectors that answered a gzip body with 415
+# Unsupported Media Type; this process sends them plain JSON from then on
+GZIP_REFUSED = set()
+# ... and those that answered a chunked body with 411 Length Required
+STREAM_REFUSED = set()
 
 
-def parse_opts(argv=None):
-    parser = OptionParser()
-    log = logging.getLogger("option_parser")
+def gzip_compressor():
+    import zlib
+    # wbits 31: a gzip header and trailer around the deflate stream
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
 
-    parser.add_option("-H", "--host",
-                      help="Hostname of machine with issue",
-                      action="store", dest="hostname", type=str,
-                      default=icingios_get_env("HOSTNAME"))
 
-    parser.add_option("-S", "--service",
-                      help="Service name of service with issue",
-                      action="store", dest="service_name", type=str,
-                      default=icingios_get_env("SERVICEDESC"))
+def request_body(data, headers, gzip_min=None):
+    # The JSON body of a POST; gzip-compressed, with a Content-Encoding
+    # header added to headers, once it's at least gzip_min bytes
+    return compress_body(json.dumps(data), headers, gzip_min)
 
-    parser.add_option("-s", "--state",
-                      help="The host or service's current state",
-                      action="store", dest="target_state", type=str,
-                      default=None)
 
-    parser.add_option("-o", "--output",
-                      help="The check output (preferably $*OUTPUT$ + "
-                           "$*LONGOUTPUT$)",
-                      action="store", dest="check_output", type=str,
-                      default=None)
+def compress_body(body, headers, gzip_min):
+    if gzip_min is None or len(body) < gzip_min:
+        return body
+    compressor = gzip_compressor()
+    headers['Content-Encoding'] = "gzip"
+    return compressor.compress(body.encode("utf-8")) + compressor.flush()
 
-    parser.add_option("-k", "--auth-key",
-                      help="The SignifAi auth key for the collector API",
-                      action="store", dest="auth_key", type=str,
-                      default=None)
 
-    parser.add_option("-U", "--unknown-is-critical",
-                      help="Treat UNKNOWN as CRITICAL/DOWN",
-                      action="store_true", dest="critical_unknowns",
-                      default=False)
+def json_pieces(data):
+    # json.dumps(data) a piece at a time: one piece per event of the
+    # "events" list, and one per other top-level value
+    separator = "{"
+    for key, value in data.items():
+        yield separator + json.dumps(key) + ": "
+        separator = ", "
+        if key == "events":
+            yield "["
+            event_separator = ""
+            for event in value:
+                yield event_separator + json.dumps(event)
+                event_separator = ", "
+            yield "]"
+        else:
+            yield json.dumps(value)
+    yield "}" if separator == ", " else "{}"
 
-    parser.add_option("-b", "--bugsnag-key",
-                      help="Report errors to bugsnag with notification key",
-                      action="store", dest="bugsnag_key", type=str,
-                      default=None)
 
-    if argv is None:
-        argv = sys.argv
+def stream_body(data, headers, gzip_min=None, chunk_size=STREAM_CHUNK):
+    # request_body for big batches: an iterator of chunks of about
+    # chunk_size bytes, encoded (and compressed) as they're sent, with
+    # Transfer-Encoding: chunked in headers. Bodies that turn out to be
+    # smaller than a chunk (or than gzip_min, which has to be known
+    # before the headers go out) come back whole, as from request_body.
+    pieces = json_pieces(data)
+    threshold = max(chunk_size, gzip_min or 0)
+    head = []
+    size = 0
+    for piece in pieces:
+        head.append(piece)
+        size += len(piece)
+        if size >= threshold:
+            break
+    else:
+        return compress_body("".join(head), headers, gzip_min)
 
-    (options, args) = parser.parse_args(argv)
+    headers['Transfer-Encoding'] = "chunked"
+    compressor = None
+    if gzip_min is not None:
+        headers['Content-Encoding'] = "gzip"
+        compressor = gzip_compressor()
+    import itertools
+    return body_chunks(itertools.chain(head, pieces), chunk_size, compressor)
 
-    ICINGIOS_SERVICE_STATES = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
-    ICINGIOS_HOST_STATES = ["UP", "DOWN"]
-    if options.auth_key is None:
-        log.fatal("No auth key specified")
+
+def body_chunks(pieces, chunk_size, compressor=None):
+    # Joins (and compresses) text pieces into byte chunks of at least
+    # chunk_size bytes, so each one isn't a write of its own
+    chunk = []
+    size = 0
+    for piece in pieces:
+        piece = piece.encode("utf-8")
+        if compressor is not None:
+            piece = compressor.compress(piece)
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if compressor is not None:
+        chunk.append(compressor.flush())
+    chunk = b"".join(chunk)
+    if chunk:
+        yield chunk
+
+
+def chunk_frame(chunk):
+    # One chunk of a chunked HTTP/1.1 body; an empty one ends the body
+    size = "{size:x}\r\n".format(size=len(chunk)).encode("ascii")
+    return size + chunk + b"\r\n"
+
+
+def send_chunked(client, uri, headers, chunks):
+    # client.request() for an iterator of body chunks; works the same
+    # with python2's httplib
+    client.putrequest("POST", uri)
+    for name, value in headers.items():
+        client.putheader(name, value)
+    client.endheaders()
+    for chunk in chunks:
+        client.send(chunk_frame(chunk))
+    client.send(chunk_frame(b""))
+
+
+def gzip_refused(report):
+    # True if the collector turned down a compressed body as such
+    return report.get('compressed') and report.get('status') == 415
+
+
+def stream_refused(report):
+    # True if the collector wants a Content-Length, not a chunked body
+    return report.get('streamed') and report.get('status') == 411
+
+
+def collector_reply(status, response_text, report, bmd):
+    # What the collector's reply to a POST means: True, None (some
+    # failed_events) or False. Shared with the asyncio engine.
+    log = logging.getLogger("http_post")
+    bmd['collector_response'] = response_text
+    if not 200 <= status < 300:
+        log.fatal(response_text)
+        bugsnag_notify(ValueError("Error from SignifAi collector"), bmd)
+        report['error'] = "status"
+        return False
+
+    start = monotonic()
+    try:
+        collector_response = json.loads(response_text)
+    except ValueError as exc:
+        log.fatal("Didn't receive valid JSON response from collector")
+        bugsnag_notify(exc, bmd)
+        report['error'] = "invalid_response"
+        return False
+    report.setdefault('timings', {})['parse'] = monotonic() - start
+
+    if (not collector_response['success'] or
+            collector_response['failed_events']):
+        errs = collector_response['failed_events']
+        log.fatal("Errors submitting events: {errs}".format(errs=errs))
+        # Treat it like a ValueError for bugsnag
+        bmd['failed_events'] = collector_response['failed_events']
+        report['failed_events'] = errs
+        bugsnag_notify(ValueError("errors submitting events"), bmd)
+        report['error'] = "failed_events"
+        # not really False but not really True
+        return None
+    return True
+
+
+def POST_data(auth_key, data,
+              signifai_host="collectors.signifai.io",
+              signifai_port=443,
+              signifai_uri=DEFAULT_POST_URI,
+              timeout=5,
+              attempts=5,
+              httpsconn=None,
+              pool=None,
+              deadline=None,
+              breaker=None,
+              post_attempts=1,
+              backoff=0.5,
+              limiter=None,
+              gzip_min=None,
+              stream=False,
+              metrics=None,
+              report=None):
+    # deadline bounds the whole delivery (connect retries, request and
+    # response) in seconds. With a breaker, nothing is sent while the
+    # collector's circuit is open. A POST whose request or response
+    # failed is retried up to post_attempts times in all, with
+    # exponential backoff and jitter; the events' IDs and the
+    # Idempotency-Key header stay the same, so the collector can drop
+    # duplicates. With a limiter (a RateLimiter), POSTs wait for its
+    # tokens, and a 429/5xx from the collector slows it down and is
+    # retried once it allows. Bodies of gzip_min bytes or more are sent
+    # gzip-compressed, and plain if the collector won't take that.
+    # With stream, big bodies are encoded as they're sent, with chunked
+    # transfer encoding, unless the collector wants a Content-Length.
+    # metrics (a Metrics) gets the timings and outcome of each attempt.
+    # report, if given, is filled in with the "error" kind and response
+    # "status" for callers that need more than True/None/False.
+    log = logging.getLogger("http_post")
+    if report is None:
+        report = {}
+    if httpsconn is None:
+        httpsconn = default_connection_class()
+    start = monotonic()
+    expires = None
+    if deadline is not None:
+        expires = start + deadline
+    tries = 0
+
+    def done(result):
+        if metrics is not None:
+            metrics.record_delivery(data, result, report,
+                                    monotonic() - start, tries)
+        return result
+
+    if breaker is not None and not breaker.allow():
+        log.warning("Collector circuit is open, not sending")
+        report['error'] = "circuit_open"
+        report['status'] = None
+        return done(False)
+
+    while True:
+        if limiter is not None and not wait_for_token(limiter, auth_key,
+                                                      expires, report):
+            if not tries:
+                # nothing was sent, so nothing to tell the breaker
+                return done(False)
+            result = False
+            break
+        tries += 1
+        collector = (signifai_host, signifai_port)
+        compress = None if collector in GZIP_REFUSED else gzip_min
+        streaming = stream and collector not in STREAM_REFUSED
+        result = POST_attempt(auth_key, data, signifai_host, signifai_port,
+                              signifai_uri, timeout, attempts, httpsconn,
+                              pool, expires, report, compress, streaming)
+        if metrics is not None:
+            metrics.record_attempt(report)
+        if gzip_refused(report) or stream_refused(report):
+            if gzip_refused(report):
+                log.warning("Collector refused a gzip body, resending it "
+                            "uncompressed")
+                GZIP_REFUSED.add(collector)
+            else:
+                log.warning("Collector refused a chunked body, resending "
+                            "it whole")
+                STREAM_REFUSED.add(collector)
+            # not the collector's fault, so it doesn't count as a try
+            tries -= 1
+            continue
+        if limiter is not None:
+            if overloaded(report):
+                limiter.record_overload(auth_key, report['retry_after'])
+                if tries < post_attempts:
+                    # the limiter holds the retry back
+                    continue
+            elif not collector_failed(report):
+                limiter.record_success(auth_key)
+        if report['error'] not in RETRYABLE_ERRORS or tries >= post_attempts:
+            break
+        import random
+        # full jitter keeps concurrent senders from retrying in lockstep
+        delay = random.uniform(0, backoff * 2 ** (tries - 1))
+        if expires is not None and monotonic() + delay >= expires:
+            break
+        log.info("Retrying POST in {delay:.2f}s ({tries} of {attempts})"
+                 .format(delay=delay, tries=tries, attempts=post_attempts))
+        time.sleep(delay)
+
+    if breaker is not None:
+        if collector_failed(report):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return done(result)
+
+
+# report['error'] kinds meaning we never got an answer from the collector
+TRANSPORT_ERRORS = frozenset([
+    "connect", "connect_timeout", "deadline", "request", "request_timeout",
+    "response", "response_timeout"
+])
+
+
+def collector_failed(report):
+    # True if the collector is unreachable or failing, as opposed to
+    # answering (even if it refused what we sent)
+    status = report.get('status')
+    return (report.get('error') in TRANSPORT_ERRORS or
+            (status is not None and status >= 500))
+
+
+def rejected(report):
+    # True if the collector refused the request itself; sending the
+    # same events again won't help
+    status = report.get('status')
+    return (report.get('error') == "status" and
+            400 <= status < 500 and status not in (408, 429))
+
+
+def try_get_env(*possibilities):
+    value = None
+    for which in possibilities:
+        try:
+            value = os.environ[which].strip()
+        except KeyError:
+            pass
+        else:
+            break
+    return value
+
+
+def icingios_get_env(macro_name, default=None):
+    macro = macro_name.upper()
+    icinga_env_var = "ICINGA_{macro}".format(macro=macro)
+    nagios_env_var = "NAGIOS_{macro}".format(macro=macro)
+    ret = try_get_env(icinga_env_var, nagios_env_var, macro)
+    if ret is None:
+        return default
+    return ret
+
+
+def parse_opts(argv=None):
+    parser = OptionParser()
+    log = logging.getLogger("option_parser")
+
+    parser.add_option("-H", "--host",
+                      help="Hostname of machine with issue",
+                      action="store", dest="hostname", type=str,
+                      default=icingios_get_env("HOSTNAME"))
+
+    parser.add_option("-S", "--service",
+                      help="Service name of service with issue",
+                      action="store", dest="service_name", type=str,
+                      default=icingios_get_env("SERVICEDESC"))
+
+    parser.add_option("-s", "--state",
+                      help="The host or service's current state",
+                      action="store", dest="target_state", type=str,
+                      default=None)
+
+    parser.add_option("-o", "--output",
+                      help="The check output (preferably $*OUTPUT$ + "
+                           "$*LONGOUTPUT$)",
+                      action="store", dest="check_output", type=str,
+                      default=None)
+
+    parser.add_option("-k", "--auth-key",
+                      help="The SignifAi auth key for the collector API",
+                      action="store", dest="auth_key", type=str,
+                      default=None)
+
+    parser.add_option("-U", "--unknown-is-critical",
+                      help="Treat UNKNOWN as CRITICAL/DOWN",
+                      action="store_true", dest="critical_unknowns",
+                      default=False)
+
+    parser.add_option("-b", "--bugsnag-key",
+                      help="Report errors to bugsnag with notification key",
+                      action="store", dest="bugsnag_key", type=str,
+                      default=None)
+
+    parser.add_option("--socket",
+                      help="Hand events to the send_signifai daemon "
+                           "listening on this Unix socket (falls back to "
+                           "sending directly if the daemon is unreachable)",
+                      action="store", dest="socket_path", type=str,
+                      default=None)
+
+    parser.add_option("--daemon",
+                      help="Run as a resident sender daemon accepting "
+                           "events on the --socket path",
+                      action="store_true", dest="daemon", default=False)
+
+    parser.add_option("--bulk",
+                      help="Read notifications as JSON lines from this file "
+                           "('-' for stdin) and send them in batches",
+                      action="store", dest="bulk", type=str, default=None)
+
+    parser.add_option("--batch-events",
+                      help="Maximum number of events per batched POST",
+                      action="store", dest="batch_events", type=int,
+                      default=DEFAULT_BATCH_EVENTS)
+
+    parser.add_option("--batch-bytes",
+                      help="Maximum encoded size of a batched POST",
+                      action="store", dest="batch_bytes", type=int,
+                      default=DEFAULT_BATCH_BYTES)
+
+    parser.add_option("--batch-linger",
+                      help="Maximum seconds an event waits for its batch "
+                           "to fill up before it is sent",
+                      action="store", dest="batch_linger", type=float,
+                      default=DEFAULT_BATCH_LINGER)
+
+    parser.add_option("--prioritise",
+                      help="Have the daemon send critical events first "
+                           "and batch recoveries (OK/UP) separately",
+                      action="store_true", dest="prioritise",
+                      default=False)
+
+    parser.add_option("--recovery-events",
+                      help="Most recoveries per POST with --prioritise",
+                      action="store", dest="recovery_events", type=int,
+                      default=500)
+
+    parser.add_option("--recovery-linger",
+                      help="Most seconds a recovery waits to be batched "
+                           "with --prioritise",
+                      action="store", dest="recovery_linger", type=float,
+                      default=10)
+
+    parser.add_option("--coalesce-window",
+                      help="Seconds the daemon holds each host/service's "
+                           "events, sending only the latest (default 0: "
+                           "don't coalesce)",
+                      action="store", dest="coalesce_window", type=float,
+                      default=0)
+
+    parser.add_option("--coalesce-keys",
+                      help="Most hosts/services held by --coalesce-window "
+                           "at once",
+                      action="store", dest="coalesce_keys", type=int,
+                      default=10000)
+
+    parser.add_option("--rollup-window",
+                      help="Seconds the daemon holds each host's events; "
+                           "if the host is DOWN by then, its service "
+                           "alarms are summarised in the host's event "
+                           "(default 0: don't roll up)",
+                      action="store", dest="rollup_window", type=float,
+                      default=0)
+
+    parser.add_option("--rollup-hosts",
+                      help="Most hosts held by --rollup-window at once",
+                      action="store", dest="rollup_hosts", type=int,
+                      default=10000)
+
+    parser.add_option("--spool",
+                      help="Write the event to this spool directory and "
+                           "exit; a drainer delivers it from there",
+                      action="store", dest="spool_dir", type=str,
+                      default=None)
+
+    parser.add_option("--drain",
+                      help="Run as a drainer delivering events from the "
+                           "--spool directory",
+                      action="store_true", dest="drain", default=False)
+
+    parser.add_option("--pool-size",
+                      help="Idle keep-alive connections to the collector "
+                           "kept by the daemon/drainer",
+                      action="store", dest="pool_size", type=int,
+                      default=4)
+
+    parser.add_option("--tls-session-ttl",
+                      help="Seconds the daemon/drainer may resume a TLS "
+                           "session with the collector (0 disables)",
+                      action="store", dest="tls_session_ttl", type=int,
+                      default=300)
+
+    parser.add_option("--dns-cache",
+                      help="File caching the collector's addresses "
+                           "across invocations",
+                      action="store", dest="dns_cache", type=str,
+                      default=None)
+
+    parser.add_option("--dns-ttl",
+                      help="Seconds the --dns-cache addresses are used "
+                           "before resolving again",
+                      action="store", dest="dns_ttl", type=int,
+                      default=300)
+
+    parser.add_option("--deadline",
+                      help="Seconds the whole delivery (connect retries, "
+                           "request and response) may take",
+                      action="store", dest="deadline", type=float,
+                      default=None)
+
+    parser.add_option("--deadline-policy",
+                      help="What to do with events that couldn't be "
+                           "delivered in time: 'drop' them or 'spool' them "
+                           "to the --spool directory",
+                      action="store", dest="deadline_policy",
+                      type="choice", choices=["drop", "spool"],
+                      default="drop")
+
+    parser.add_option("--post-attempts",
+                      help="Times to try the POST itself when sending the "
+                           "request or reading the response fails",
+                      action="store", dest="post_attempts", type=int,
+                      default=3)
+
+    parser.add_option("--backoff",
+                      help="Seconds of backoff before the first POST "
+                           "retry, doubling after each",
+                      action="store", dest="backoff", type=float,
+                      default=0.5)
+
+    parser.add_option("--event-retries",
+                      help="Times the daemon/drainer resend an event the "
+                           "collector reported as failed",
+                      action="store", dest="event_retries", type=int,
+                      default=DEFAULT_EVENT_RETRIES)
+
+    parser.add_option("--breaker",
+                      help="Circuit breaker state file shared by all "
+                           "invocations; stops sending while the "
+                           "collector keeps failing",
+                      action="store", dest="breaker", type=str,
+                      default=None)
+
+    parser.add_option("--breaker-threshold",
+                      help="Consecutive failures that open the circuit",
+                      action="store", dest="breaker_threshold", type=int,
+                      default=5)
+
+    parser.add_option("--breaker-reset",
+                      help="Seconds the circuit stays open before a "
+                           "single probe is let through",
+                      action="store", dest="breaker_reset", type=float,
+                      default=30)
+
+    parser.add_option("--concurrency",
+                      help="POSTs the daemon or --bulk keep in flight at "
+                           "once, using the asyncio engine (Python 3) "
+                           "above 1",
+                      action="store", dest="concurrency", type=int,
+                      default=1)
+
+    parser.add_option("--workers",
+                      help="Daemon sender processes; each host/service "
+                           "always goes to the same one, keeping its "
+                           "events in order (default: send from the "
+                           "daemon itself)",
+                      action="store", dest="workers", type=int,
+                      default=0)
+
+    parser.add_option("--stats-interval",
+                      help="Seconds between the --workers' throughput "
+                           "and queue depth log lines (0: never)",
+                      action="store", dest="stats_interval", type=float,
+                      default=60)
+
+    parser.add_option("--collector",
+                      help="Collector to send to, as http[s]://host[:port] "
+                           "(default: {default})"
+                      .format(default=DEFAULT_COLLECTOR),
+                      action="store", dest="collector", type=str,
+                      default=DEFAULT_COLLECTOR)
+
+    parser.add_option("--rate-limit",
+                      help="Most POSTs per second for each auth key "
+                           "(default 0: unlimited); slows down further "
+                           "while the collector is overloaded",
+                      action="store", dest="rate_limit", type=float,
+                      default=0)
+
+    parser.add_option("--rate-burst",
+                      help="POSTs that may go at once within "
+                           "--rate-limit (default: one second's worth)",
+                      action="store", dest="rate_burst", type=float,
+                      default=None)
+
+    parser.add_option("--rate-max-wait",
+                      help="Longest wait in seconds for a --rate-limit "
+                           "turn, a collector's Retry-After included; "
+                           "longer and the delivery fails (default "
+                           "{default})".format(default=DEFAULT_RATE_MAX_WAIT),
+                      action="store", dest="rate_max_wait", type=float,
+                      default=DEFAULT_RATE_MAX_WAIT)
+
+    parser.add_option("--rate-limit-state",
+                      help="File sharing the --rate-limit between all "
+                           "invocations",
+                      action="store", dest="rate_limit_state", type=str,
+                      default=None)
+
+    parser.add_option("--gzip-min",
+                      help="Gzip request bodies of at least this many "
+                           "bytes (default: never)",
+                      action="store", dest="gzip_min", type=int,
+                      default=None)
+
+    parser.add_option("--stream",
+                      help="Encode request bodies bigger than {size}KB "
+                           "while sending them, with chunked transfer "
+                           "encoding".format(size=STREAM_CHUNK // 1024),
+                      action="store_true", dest="stream", default=False)
+
+    parser.add_option("--stats-file",
+                      help="JSON file adding up delivery counters and "
+                           "phase timings over all invocations",
+                      action="store", dest="stats_file", type=str,
+                      default=None)
+
+    parser.add_option("--prometheus-file",
+                      help="Also write the --stats-file totals to this "
+                           "Prometheus textfile",
+                      action="store", dest="prometheus_file", type=str,
+                      default=None)
+
+    parser.add_option("--stats-flush",
+                      help="Seconds between the daemon's and drainer's "
+                           "--stats-file updates (default 10)",
+                      action="store", dest="stats_flush", type=float,
+                      default=10)
+
+    parser.add_option("-v", "--verbose",
+                      help="Log connection timings and other details",
+                      action="store_true", dest="verbose", default=False)
+
+    if argv is None:
+        argv = sys.argv
+
+    (options, args) = parser.parse_args(argv)
+
+    try:
+        parse_collector(options.collector)
+    except ValueError as exc:
+        log.fatal("Invalid --collector: {error}".format(error=exc))
+        return (None, None)
+
+    if options.rate_limit < 0:
+        log.fatal("--rate-limit can't be negative")
+        return (None, None)
+    if options.rate_max_wait < 0:
+        log.fatal("--rate-max-wait can't be negative")
+        return (None, None)
+    if options.prometheus_file and not options.stats_file:
+        log.fatal("--prometheus-file requires --stats-file")
+        return (None, None)
+
+    if options.gzip_min is not None and options.gzip_min < 0:
+        log.fatal("--gzip-min can't be negative")
+        return (None, None)
+
+    if options.concurrency < 1:
+        log.fatal("--concurrency must be at least 1")
+        return (None, None)
+    if options.workers < 0:
+        log.fatal("--workers can't be negative")
+        return (None, None)
+    if options.workers and options.concurrency > 1:
+        # concurrent POSTs could overtake each other
+        log.fatal("--workers can't be combined with --concurrency")
+        return (None, None)
+    if options.concurrency > 1 and sys.version_info < (3, 5):
+        log.fatal("--concurrency above 1 requires Python 3.5 or later")
+        return (None, None)
+
+    if options.deadline_policy == "spool" and not options.spool_dir:
+        log.fatal("--deadline-policy spool requires --spool")
         return (None, None)
 
+    if options.daemon or options.drain:
+        # The daemon/drainer only relay events; the auth key, host and
+        # state come with each event
+        if options.daemon and not options.socket_path:
+            log.fatal("Daemon mode requires --socket")
+            return (None, None)
+        if options.drain and not options.spool_dir:
+            log.fatal("Drain mode requires --spool")
+            return (None, None)
+        configure_bugsnag(options, log)
+        return (options, args)
+
+    if options.bulk:
+        # host, service, state and output come with each record
+        if options.auth_key is None:
+            log.fatal("No auth key specified")
+            return (None, None)
+        configure_bugsnag(options, log)
+        return (options, args)
+
+    if validate_opts(options, log) is None:
+        return (None, None)
+
+    configure_bugsnag(options, log)
+
+    return (options, args)
+
+
+def validate_opts(options, log, use_env=True):
+    # Checks and normalizes one notification's options in place;
+    # returns None if they're unusable. Without use_env, the check
+    # output isn't filled in from the environment.
+    if options.auth_key is None:
+        log.fatal("No auth key specified")
+        return None
+
     try:
         options.target_state = int(options.target_state)
     except (TypeError, ValueError):
         if options.target_state is None:
             log.fatal("No state specified")
-            return (None, None)
+            return None
 
         if (options.target_state.upper() not in ICINGIOS_SERVICE_STATES and
                 options.target_state.upper() not in ICINGIOS_HOST_STATES):
             log.fatal("Invalid state specified")
-            return (None, None)
+            return None
         else:
             options.target_state = options.target_state.upper()
     else:
@@ -293,28 +1870,18 @@ def parse_opts(argv=None):
         # Make states agree with check type
         if (options.target_state in ICINGIOS_HOST_STATES and
                 options.service_name):
-            # UP is akin to OK, DOWN is akin to CRITICAL
-            host2svcmap = {
-                "UP": "OK",
-                "DOWN": "CRITICAL"
-            }
-            options.target_state = host2svcmap[options.target_state]
+            options.target_state = HOST2SVC_STATES[options.target_state]
         elif (options.target_state in ICINGIOS_SERVICE_STATES and
                 not options.service_name):
-            # OK is akin to UP, everything else is akin to DOWN
-            svc2hostmap = {
-                "OK": "UP",
-                "WARNING": "DOWN",
-                "CRITICAL": "DOWN",
-                "UNKNOWN": "DOWN"
-            }
-            options.target_state = svc2hostmap[options.target_state]
+            options.target_state = SVC2HOST_STATES[options.target_state]
 
     if not options.hostname:
         log.fatal("No/invalid hostname specified")
-        return (None, None)
+        return None
 
-    if not options.check_output:
+    if not options.check_output and not use_env:
+        options.check_output = ""
+    elif not options.check_output:
         # Fill out the output from environment variables then if we can
         if options.service_name is None:
             # host output
@@ -328,7 +1895,12 @@ def parse_opts(argv=None):
                                     icingios_get_env("LONGSERVICEOUTPUT", ""))
         options.check_output = options.check_output.strip()
 
+    return options
+
+
+def configure_bugsnag(options, log):
     if options.bugsnag_key:
+        bugsnag = import_bugsnag()
         if bugsnag:
             project_root = os.path.abspath(
                 os.path.join(
@@ -342,72 +1914,1684 @@ def parse_opts(argv=None):
         else:
             log.warning("Couldn't initialize bugsnag: bugsnag not present")
 
-    return (options, args)
 
+class EventBuilder(object):
+    # Builds the events of a notification. What's the same for every
+    # notification (the monitoring host, each state's value) is worked
+    # out once, so a builder kept for a whole --bulk run does only the
+    # per-event work.
+    def __init__(self, monitoring_host=None, clock=time.time):
+        if monitoring_host is None:
+            monitoring_host = socket.gethostname()
+        self.monitoring_host = monitoring_host
+        self.clock = clock
+        # state -> (value, state attribute)
+        self.states = {"OK": ("low", "ok"), "UP": ("low", "ok")}
+        for state, value in ICINGIOS2PRI.items():
+            self.states[state] = (value, "alarm")
 
-def generate_REST_payload(options):
-    REST_target = {
-        "event_source": "icinga",
-        "timestamp": int(time.time()),
-        "host": options.hostname,
-        "event_description": options.check_output,
-        "attributes": {}
-    }
-    if options.service_name:
-        REST_target['application'] = options.service_name
-
-    REST_events = {"events": []}
-    monitoring_host = socket.gethostname()
-
-    if options.target_state in ("OK", "UP"):
-        REST_target['value'] = "low"
-        REST_target['attributes']['state'] = "ok"
-    elif options.target_state == "UNKNOWN" and not options.critical_unknowns:
-        # Create and append
-        REST_host = deepcopy(REST_target)
-        REST_host['host'] = monitoring_host
-        REST_host['application'] = "icinga"
-        REST_host['attributes'] = {
-            "application/target/host/name": options.hostname,
-            "state": "alarm"
+    def payload(self, options):
+        return {"events": self.events(options)}
+
+    def events(self, options):
+        value, state = self.states[options.target_state]
+        timestamp = int(self.clock())
+        events = []
+        if options.target_state == "UNKNOWN" and not options.critical_unknowns:
+            # UNKNOWN usually means the check itself failed, so the
+            # monitoring host gets an event of its own
+            attributes = {TARGET_HOST_ATTRIBUTE: options.hostname,
+                          "state": "alarm"}
+            if options.service_name:
+                attributes[TARGET_APPLICATION_ATTRIBUTE] = options.service_name
+                attributes[TARGET_SERVICE_ATTRIBUTE] = options.service_name
+            attributes[EVENT_ID_ATTRIBUTE] = new_event_id()
+            events.append({
+                "event_source": "icinga",
+                "timestamp": timestamp,
+                "host": self.monitoring_host,
+                "event_description": options.check_output,
+                "attributes": attributes,
+                "application": "icinga",
+                "value": value
+            })
+
+        target = {
+            "event_source": "icinga",
+            "timestamp": timestamp,
+            "host": options.hostname,
+            "event_description": options.check_output,
+            "attributes": {
+                "state": state,
+                MONITORING_HOST_ATTRIBUTE: self.monitoring_host,
+                EVENT_ID_ATTRIBUTE: new_event_id()
+            }
         }
         if options.service_name:
-            APPLICATION_NAME = "application/target/application/name"
-            SERVICE_NAME = "application/target/service/name"
-            REST_host['attributes'][APPLICATION_NAME] = options.service_name
-            REST_host['attributes'][SERVICE_NAME] = options.service_name
+            target['application'] = options.service_name
+        target['value'] = value
+        events.append(target)
+        return events
+
+
+def generate_REST_payload(options, builder=None):
+    if builder is None:
+        builder = EventBuilder()
+    return builder.payload(options)
+
+
+def failed_indexes(events, failed_events):
+    # Positions in events of the collector's failed_events, matched by
+    # event ID (or, failing that, by content). If none of them can be
+    # matched we can't tell what was accepted, so they all count.
+    by_id = {}
+    for index, event in enumerate(events):
+        event_id = event.get('attributes', {}).get(EVENT_ID_ATTRIBUTE)
+        if event_id is not None:
+            by_id[event_id] = index
+
+    failed = set()
+    for item in failed_events or []:
+        # {"event": {...}, "error": "..."}, or just the event
+        event = item.get('event', item) if isinstance(item, dict) else None
+        if not isinstance(event, dict):
+            continue
+        attributes = event.get('attributes')
+        if (isinstance(attributes, dict) and
+                attributes.get(EVENT_ID_ATTRIBUTE) in by_id):
+            failed.add(by_id[attributes[EVENT_ID_ATTRIBUTE]])
+            continue
+        for index, candidate in enumerate(events):
+            if index not in failed and candidate == event:
+                failed.add(index)
+                break
+
+    if not failed:
+        return set(range(len(events)))
+    return failed
+
+
+def new_event_id():
+    return binascii.hexlify(os.urandom(16)).decode("ascii")
+
+
+def idempotency_key(data):
+    # Same events, same key; None unless every event carries an ID
+    event_ids = []
+    for event in data['events']:
+        event_id = event.get('attributes', {}).get(EVENT_ID_ATTRIBUTE)
+        if event_id is None:
+            return None
+        event_ids.append(event_id)
+    import hashlib
+    return hashlib.sha1(",".join(event_ids).encode("ascii")).hexdigest()
+
+
+class EventBatcher(object):
+    # Collects events from many notifications and sends them as one
+    # {"events": [...]} document, capped by event count, encoded size
+    # and how long the oldest event may wait
+    def __init__(self, send, max_events=DEFAULT_BATCH_EVENTS,
+                 max_bytes=DEFAULT_BATCH_BYTES,
+                 max_linger=DEFAULT_BATCH_LINGER, clock=monotonic):
+        self.send = send
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.clock = clock
+        self.events = []
+        self.size = 0
+        self.started = None
 
-        REST_host['value'] = ICINGIOS2PRI[options.target_state]
-        REST_events['events'].append(REST_host)
+    def __len__(self):
+        return len(self.events)
 
-        REST_target['value'] = ICINGIOS2PRI[options.target_state]
-        REST_target['attributes']['state'] = "alarm"
+    def add(self, events):
+        results = []
+        for event in events:
+            # +2 for the ", " separator json.dumps puts between events
+            event_size = len(json.dumps(event)) + 2
+            if self.events and self.size + event_size > self.max_bytes:
+                results.append(self.flush())
+            if not self.events:
+                self.started = self.clock()
+            self.events.append(event)
+            self.size += event_size
+            if len(self.events) >= self.max_events:
+                results.append(self.flush())
+        return results
+
+    def time_left(self):
+        # seconds until the current batch is due, None if empty
+        if not self.events:
+            return None
+        return max(0, self.started + self.max_linger - self.clock())
+
+    def poll(self):
+        if self.events and self.time_left() <= 0:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.events:
+            return True
+        batch = self.events
+        self.events = []
+        self.size = 0
+        self.started = None
+        return self.send({"events": batch})
+
+
+class PriorityBatcher(object):
+    # Batches events per auth key and priority lane, and sends the
+    # batches that are due most urgent first: critical, medium, low,
+    # then recoveries (OK/UP). Recoveries are batched with
+    # recovery_kwargs, typically bigger batches and a longer linger;
+    # the linger also caps how long a recovery can wait. An event for a
+    # host/service whose earlier event is waiting in another lane sends
+    # that one first, so the collector still sees them in order.
+    LANES = ("critical", "medium", "low", "recovery")
+
+    def __init__(self, send, batch_kwargs=None, recovery_kwargs=None,
+                 clock=monotonic):
+        self.send = send
+        self.batch_kwargs = batch_kwargs or {}
+        self.recovery_kwargs = recovery_kwargs or {}
+        self.clock = clock
+        # (auth_key, lane) -> EventBatcher
+        self.batchers = {}
+        # (auth_key, coalesce_key) -> lane of its waiting events
+        self.waiting = {}
+        # (lane rank, auth_key, data) for batches to send
+        self.ready = []
+
+    def __len__(self):
+        return sum(len(batcher) for batcher in self.batchers.values())
+
+    def lane(self, event):
+        if event.get('attributes', {}).get('state') == "ok":
+            return "recovery"
+        if event.get('value') in self.LANES:
+            return event['value']
+        return "medium"
+
+    def batcher(self, auth_key, lane):
+        if (auth_key, lane) not in self.batchers:
+            rank = self.LANES.index(lane)
+
+            def ready(data):
+                self.ready.append((rank, auth_key, data))
+                return True
+            kwargs = self.batch_kwargs
+            if lane == "recovery":
+                kwargs = self.recovery_kwargs
+            self.batchers[(auth_key, lane)] = EventBatcher(
+                ready, clock=self.clock, **kwargs)
+        return self.batchers[(auth_key, lane)]
+
+    def add(self, auth_key, events):
+        for event in events:
+            lane = self.lane(event)
+            key = (auth_key,) + coalesce_key(event)
+            earlier = self.waiting.get(key)
+            if earlier is not None and earlier != lane:
+                self.batcher(auth_key, earlier).flush()
+                self.dispatch()
+            self.waiting[key] = lane
+            self.batcher(auth_key, lane).add([event])
+
+    def time_left(self):
+        if self.ready:
+            return 0
+        left = [batcher.time_left() for batcher in self.batchers.values()]
+        left = [seconds for seconds in left if seconds is not None]
+        return min(left) if left else None
+
+    def poll(self):
+        for batcher in self.batchers.values():
+            batcher.poll()
+        self.dispatch()
+
+    def flush(self):
+        for batcher in self.batchers.values():
+            batcher.flush()
+        self.dispatch()
+
+    def dispatch(self):
+        # Sends the batches ready, most urgent first
+        ready = sorted(self.ready, key=lambda batch: batch[0])
+        self.ready = []
+        for rank, auth_key, data in ready:
+            self.send(auth_key, data)
+        for key, lane in list(self.waiting.items()):
+            if not len(self.batcher(key[0], lane)):
+                del self.waiting[key]
+
+
+def coalesce_key(event):
+    # What an event is about: its host and service, or for the
+    # monitoring host's UNKNOWN events, the host and service they're for
+    attributes = event.get('attributes', {})
+    return (event.get('host'), event.get('application'),
+            attributes.get(TARGET_HOST_ATTRIBUTE),
+            attributes.get(TARGET_APPLICATION_ATTRIBUTE))
+
+
+class EventHold(object):
+    # Holds events for window seconds under a key, in the order they're
+    # due. Subclasses decide what to hold and must define
+    # release(key, held), which sends on what was held with
+    # send(auth_key, events). At most max_keys keys are held; beyond
+    # that the least recently hit is released early. Events replaced or
+    # folded into others, and so never sent, are passed to discard.
+    def __init__(self, send, window, max_keys=10000, clock=monotonic,
+                 discard=None):
+        from collections import deque, OrderedDict
+        self.send = send
+        self.discard = discard
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> [due, ...], least recently hit first
+        self.held = OrderedDict()
+        # (due, key) in the order they're due; keys since released are
+        # skipped
+        self.due = deque()
+
+    def __len__(self):
+        return len(self.held)
+
+    def hold(self, key, *state):
+        # Starts holding key (state after the due time); returns what's
+        # held for it
+        held = self.held.pop(key, None)
+        if held is None:
+            while self.held and len(self.held) >= self.max_keys:
+                self.release(*self.held.popitem(last=False))
+            held = [self.clock() + self.window] + list(state)
+            self.due.append((held[0], key))
+        # (re)inserted last: python 2's OrderedDict has no move_to_end
+        self.held[key] = held
+        return held
+
+    def next_due(self):
+        # (due, key) of the next held key, None if none are held
+        while self.due:
+            due, key = self.due[0]
+            held = self.held.get(key)
+            if held is not None and held[0] == due:
+                return due, key
+            self.due.popleft()
+        return None
+
+    def time_left(self):
+        # seconds until the next held key is due, None if none are
+        next_due = self.next_due()
+        if next_due is None:
+            return None
+        return max(0, next_due[0] - self.clock())
+
+    def poll(self):
+        now = self.clock()
+        while True:
+            next_due = self.next_due()
+            if next_due is None or next_due[0] > now:
+                break
+            self.due.popleft()
+            self.release(next_due[1], self.held.pop(next_due[1]))
+
+    def flush(self):
+        while self.held:
+            self.release(*self.held.popitem(last=False))
+        self.due.clear()
+
+    def discarded(self, events):
+        if events and self.discard is not None:
+            self.discard(events)
+
+
+class EventCoalescer(EventHold):
+    # Holds each host/service's latest event for window seconds. A
+    # newer event for the same host and service replaces the one held,
+    # so a storm or a flapping service yields one event per window with
+    # the latest state; the events it replaced, and how many of those
+    # changed state, are counted in its attributes.
+    def __init__(self, send, window=5.0, max_keys=10000, clock=monotonic,
+                 discard=None):
+        EventHold.__init__(self, send, window, max_keys, clock, discard)
+
+    def add(self, auth_key, events):
+        for event in events:
+            # [due, event, coalesced, transitions]
+            held = self.hold((auth_key,) + coalesce_key(event), None, 0, 0)
+            if held[1] is None:
+                held[1] = event
+                continue
+
+            newer, older = event, held[1]
+            if event.get('timestamp', 0) < older.get('timestamp', 0):
+                # resent after failed_events; the held one is newer
+                newer, older = older, event
+            older_attributes = older.get('attributes', {})
+            held[2] += 1 + older_attributes.get(COALESCED_ATTRIBUTE, 0)
+            held[3] += older_attributes.get(TRANSITIONS_ATTRIBUTE, 0)
+            newer_state = (newer.get('value'),
+                           newer.get('attributes', {}).get('state'))
+            if newer_state != (older.get('value'),
+                               older_attributes.get('state')):
+                held[3] += 1
+            held[1] = newer
+            self.discarded([older])
+
+    def release(self, key, held):
+        due, event, coalesced, transitions = held
+        if coalesced:
+            attributes = event.setdefault('attributes', {})
+            attributes[COALESCED_ATTRIBUTE] = coalesced
+            attributes[TRANSITIONS_ATTRIBUTE] = transitions
+        self.send(key[0], [event])
+
+
+def is_alarm(event):
+    return event.get('attributes', {}).get('state') == "alarm"
+
+
+class HostRollup(EventHold):
+    # Holds each host's events for window seconds. If by then the
+    # host's own latest event is a DOWN, its service alarms are folded
+    # into that event as a summary (ROLLUP_* attributes) instead of
+    # being sent one by one; otherwise the events go on unchanged.
+    def __init__(self, send, window=10.0, max_keys=10000, max_names=50,
+                 clock=monotonic, discard=None):
+        EventHold.__init__(self, send, window, max_keys, clock, discard)
+        self.max_names = max_names
+
+    def add(self, auth_key, events):
+        for event in events:
+            # [due, events]
+            self.hold((auth_key, event.get('host')), [])[1].append(event)
+
+    def release(self, key, held):
+        events = held[1]
+        host_events = [event for event in events if not event.get(
+            'application')]
+        if not host_events or not is_alarm(host_events[-1]):
+            self.send(key[0], events)
+            return
+
+        host_event = host_events[-1]
+        rolled_up = [event for event in events
+                     if event.get('application') and is_alarm(event)]
+        rolled_up_ids = set(id(event) for event in rolled_up)
+        if rolled_up:
+            services = sorted(set(event['application']
+                                  for event in rolled_up))
+            names = ",".join(services[:self.max_names])
+            if len(services) > self.max_names:
+                names += ",...(+{more})".format(
+                    more=len(services) - self.max_names)
+            values = {}
+            for event in rolled_up:
+                value = event.get('value')
+                values[value] = values.get(value, 0) + 1
+            attributes = host_event.setdefault('attributes', {})
+            attributes[ROLLUP_ATTRIBUTE] = len(rolled_up)
+            attributes[ROLLUP_SERVICES_ATTRIBUTE] = names
+            attributes[ROLLUP_VALUES_ATTRIBUTE] = ",".join(
+                "{value}:{count}".format(value=value, count=count)
+                for value, count in sorted(values.items()))
+        self.discarded(rolled_up)
+        self.send(key[0], [event for event in events
+                           if id(event) not in rolled_up_ids])
+
+
+class Spool(object):
+    # Durable queue of undelivered notifications: one file per
+    # notification, written to a dot-file, fsync'd and renamed into
+    # place so a crash never leaves a half-written entry behind.
+    # Entry names sort in enqueue order. The drainer keeps a small
+    # index of the queue, so it can be watched without listing it.
+    SUFFIX = ".json"
+    INDEX = ".index"
+    # Seconds an unchanged index is left alone
+    INDEX_REFRESH = 60
+
+    def __init__(self, directory, clock=time.time):
+        self.directory = directory
+        self.clock = clock
+        self.counter = 0
+        self.indexed = None
+        self.log = logging.getLogger("spool")
+
+    def ensure_dir(self):
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def _fsync_dir(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, name, entry):
+        tmp_path = os.path.join(self.directory, "." + name + ".tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, json.dumps(entry).encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, os.path.join(self.directory, name))
+        self._fsync_dir()
+
+    def enqueue(self, auth_key, events):
+        self.ensure_dir()
+        self.counter += 1
+        name = "{usec:020d}-{pid:010d}-{counter:06d}{suffix}".format(
+            usec=int(time.time() * 1000000), pid=os.getpid(),
+            counter=self.counter, suffix=self.SUFFIX)
+        self._write(name, {"auth_key": auth_key, "events": events,
+                           "attempts": 0})
+        return name
+
+    def names(self):
+        try:
+            return os.listdir(self.directory)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return []
+            raise
+
+    def entries(self, names=None):
+        if names is None:
+            names = self.names()
+        return sorted(name for name in names
+                      if name.endswith(self.SUFFIX) and
+                      not name.startswith("."))
+
+    def enqueued_at(self, name):
+        # Entry names start with their enqueue time in microseconds
+        return int(name.split("-", 1)[0]) / 1000000.0
+
+    def write_index(self):
+        # Records how many entries are queued, the oldest's enqueue
+        # time and how many were set aside; rewritten only when that
+        # changes or every INDEX_REFRESH seconds, so that a stale index
+        # means nobody is draining the spool
+        names = self.names()
+        entries = self.entries(names)
+        index = {
+            "entries": len(entries),
+            "oldest": self.enqueued_at(entries[0]) if entries else None,
+            "rejected": sum(1 for name in names
+                            if name.endswith((".rejected", ".bad")))
+        }
+        now = self.clock()
+        if self.indexed is not None:
+            last_index, written = self.indexed
+            if last_index == index and now - written < self.INDEX_REFRESH:
+                return index
+        self.ensure_dir()
+        index['updated'] = now
+        tmp_path = os.path.join(self.directory, self.INDEX + ".tmp")
+        with open(tmp_path, "w") as index_file:
+            index_file.write(json.dumps(index))
+        os.rename(tmp_path, os.path.join(self.directory, self.INDEX))
+        del index['updated']
+        self.indexed = (index, now)
+        return index
+
+    def read_index(self):
+        # The drainer's last index, or None if there isn't one
+        try:
+            with open(os.path.join(self.directory, self.INDEX)) as index:
+                return json.loads(index.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as entry_file:
+                entry = json.loads(entry_file.read().decode("utf-8"))
+            if 'auth_key' not in entry or 'events' not in entry:
+                raise KeyError("incomplete entry")
+        except (ValueError, KeyError, TypeError):
+            # park it so it doesn't block the queue forever
+            self.log.error("Corrupt spool entry {name}, moving aside"
+                           .format(name=name))
+            os.rename(path, path + ".bad")
+            return None
+        except (IOError, OSError):
+            self.log.error("Couldn't read spool entry {name}"
+                           .format(name=name), exc_info=True)
+            return None
+        return entry
+
+    def rewrite(self, name, entry):
+        self._write(name, entry)
+
+    def remove(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def reject(self, name):
+        self.log.error("Collector refused spool entry {name}, moving aside"
+                       .format(name=name))
+        path = os.path.join(self.directory, name)
+        os.rename(path, path + ".rejected")
+
+    def lock(self):
+        # Only one drainer at a time; returns None if someone else has it
+        import fcntl
+        self.ensure_dir()
+        lock_file = open(os.path.join(self.directory, ".lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return None
+        return lock_file
+
+
+class SpoolDrainer(object):
+    # Delivers spooled notifications oldest first, batching consecutive
+    # entries for the same auth key into single POSTs
+    def __init__(self, spool, post_kwargs=None,
+                 max_events=DEFAULT_BATCH_EVENTS,
+                 max_bytes=DEFAULT_BATCH_BYTES, interval=1.0,
+                 event_retries=DEFAULT_EVENT_RETRIES):
+        self.spool = spool
+        self.event_retries = event_retries
+        self.post_kwargs = post_kwargs or {}
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.log = logging.getLogger("spool")
+
+    def batches(self, names):
+        # Yields (auth_key, [(name, entry), ...]) per batch
+        batch = []
+        auth_key = None
+        count = 0
+        size = 0
+        for name in names:
+            entry = self.spool.read(name)
+            if entry is None:
+                continue
+            entry_size = sum(len(json.dumps(event)) + 2
+                             for event in entry['events'])
+            if batch and (entry['auth_key'] != auth_key or
+                          count + len(entry['events']) > self.max_events or
+                          size + entry_size > self.max_bytes):
+                yield auth_key, batch
+                batch, count, size = [], 0, 0
+            auth_key = entry['auth_key']
+            batch.append((name, entry))
+            count += len(entry['events'])
+            size += entry_size
+        if batch:
+            yield auth_key, batch
+
+    def settle_partial(self, batch, failed):
+        # Drop what the collector accepted; keep only the failed events
+        # of each entry for another try, up to event_retries
+        offset = 0
+        for name, entry in batch:
+            events = entry['events']
+            left = [event for index, event in enumerate(events)
+                    if offset + index in failed]
+            offset += len(events)
+            if not left:
+                self.spool.remove(name)
+            elif entry.get('attempts', 0) >= self.event_retries:
+                self.spool.reject(name)
+            else:
+                entry['events'] = left
+                entry['attempts'] = entry.get('attempts', 0) + 1
+                self.spool.rewrite(name, entry)
+
+    def drain_once(self):
+        # Returns the number of notifications delivered, None if another
+        # drainer holds the spool
+        lock = self.spool.lock()
+        if lock is None:
+            return None
+        delivered = 0
+        try:
+            for auth_key, batch in self.batches(self.spool.entries()):
+                sent, reachable = self.send(auth_key, batch)
+                delivered += sent
+                if not reachable:
+                    # keep order, try again later
+                    break
+            self.spool.write_index()
+        finally:
+            lock.close()
+        return delivered
+
+    def send(self, auth_key, batch):
+        # POSTs batch's entries and settles them; returns how many were
+        # delivered, and False if the collector couldn't be reached
+        events = [event for _, entry in batch for event in entry['events']]
+        report = {}
+        result = POST_data(auth_key, {"events": events}, report=report,
+                           **self.post_kwargs)
+        if result is False and rejected(report):
+            if len(batch) == 1:
+                # would be refused forever; don't block the queue
+                self.spool.reject(batch[0][0])
+                return 0, True
+            # one bad entry mustn't take the others with it, so find
+            # out which are refused on their own
+            delivered = 0
+            for entry in batch:
+                sent, reachable = self.send(auth_key, [entry])
+                delivered += sent
+                if not reachable:
+                    return delivered, False
+            return delivered, True
+        if result is False:
+            return 0, False
+        if result is None:
+            # resend only what the collector didn't take
+            self.settle_partial(batch, failed_indexes(
+                events, report['failed_events']))
+        else:
+            for name, _ in batch:
+                self.spool.remove(name)
+        return len(batch), True
+
+    def run(self, stopping):
+        while not stopping.is_set():
+            try:
+                self.drain_once()
+            except Exception:
+                self.log.error("Unexpected error draining spool",
+                               exc_info=True)
+            stopping.wait(self.interval)
+
+
+def spool_events(spool, auth_key, events):
+    try:
+        spool.enqueue(auth_key, events)
+    except (IOError, OSError):
+        logging.getLogger("spool").error("Couldn't spool event",
+                                         exc_info=True)
+        return False
+    return True
+
+
+# JSON-lines record field -> option it stands in for
+BULK_FIELDS = {
+    "hostname": "hostname",
+    "service": "service_name",
+    "state": "target_state",
+    "output": "check_output",
+    "unknown_is_critical": "critical_unknowns",
+    "unknown-is-critical": "critical_unknowns"
+}
+
+
+def bulk_record_options(options, line, log):
+    # Options for one JSON-lines record, validated like the command
+    # line; None if the record is unusable
+    try:
+        record = json.loads(line)
+    except ValueError:
+        log.fatal("Record isn't valid JSON")
+        return None
+    if not isinstance(record, dict):
+        log.fatal("Record isn't a JSON object")
+        return None
+
+    record_options = Values(vars(options))
+    record_options.hostname = None
+    record_options.service_name = None
+    record_options.target_state = None
+    record_options.check_output = None
+    for field, value in record.items():
+        if field not in BULK_FIELDS:
+            log.warning("Ignoring unknown field {field}".format(field=field))
+            continue
+        if isinstance(value, (dict, list)):
+            log.fatal("Invalid {field}".format(field=field))
+            return None
+        if (field in ("hostname", "service", "output") and
+                isinstance(value, (int, float))):
+            value = str(value)
+        setattr(record_options, BULK_FIELDS[field], value)
+    record_options.critical_unknowns = bool(record_options.critical_unknowns)
+    return validate_opts(record_options, log, use_env=False)
+
+
+def run_bulk(options, records, engine=None, **kwargs):
+    # Sends every record in records (an iterable of JSON lines) in
+    # batched POSTs; returns 0 if all were valid and delivered. With an
+    # asyncio engine (see async_engine), up to engine.concurrency
+    # batches are sent at once.
+    log = logging.getLogger("option_parser")
+    results = []
+    pending = []
+
+    def send(data):
+        if engine is None:
+            result = deliver(options, data, **kwargs)
+            results.append(result)
+            return result
+        pending.append(data)
+        if len(pending) >= engine.concurrency:
+            send_pending()
+        return True
+
+    def send_pending():
+        delivered = engine.post_many([(options.auth_key, data)
+                                      for data in pending])
+        for data, (result, report) in zip(pending, delivered):
+            if spool_undelivered(options, data, result, report):
+                result = True
+            results.append(result)
+        del pending[:]
+
+    batcher = EventBatcher(send, max_events=options.batch_events,
+                           max_bytes=options.batch_bytes,
+                           max_linger=float("inf"))
+    builder = EventBuilder()
+    invalid = 0
+    for number, line in enumerate(records, 1):
+        if not line.strip():
+            continue
+        record_options = bulk_record_options(options, line, log)
+        if record_options is None:
+            log.fatal("Skipping record on line {number}"
+                      .format(number=number))
+            invalid += 1
+            continue
+        batcher.add(builder.events(record_options))
+    batcher.flush()
+    if pending:
+        send_pending()
+
+    if invalid or not all(results):
+        return 1
+    return 0
+
+
+def deliver(options, data, **kwargs):
+    # Sends data the way the command line asks for: spooled right away,
+    # or sent directly with the spool as a fallback. POST_data's
+    # arguments default to post_kwargs(options), made only once we
+    # send, since spooling needs no http.client.
+    spool_fallback = options.deadline_policy == "spool"
+    if options.spool_dir and not spool_fallback:
+        if spool_events(Spool(options.spool_dir), options.auth_key,
+                        data['events']):
+            return True
+        # sending directly instead
+
+    report = {}
+    if not kwargs:
+        kwargs = post_kwargs(options)
+    result = POST_data(options.auth_key, data, report=report, **kwargs)
+    if spool_undelivered(options, data, result, report):
+        return True
+    return result
+
+
+def spool_undelivered(options, data, result, report):
+    # With --deadline-policy spool, leaves events we couldn't deliver
+    # (out of time, or collector down) to the drainer, as it does
+    # events the rate limiter held back given any --spool; True if
+    # spooled
+    if result is not False or rejected(report):
+        return False
+    if (options.deadline_policy == "spool" or
+            (options.spool_dir and report.get('error') == "throttled")):
+        return spool_events(Spool(options.spool_dir), options.auth_key,
+                            data['events'])
+    log_throttled_drop(report, data['events'])
+    return False
+
+
+def log_throttled_drop(report, events):
+    if report.get('error') == "throttled":
+        logging.getLogger("http_post").error(
+            "Dropping {n} rate-limited events; give --spool to keep them"
+            .format(n=len(events)))
+
+
+def send_to_daemon(socket_path, auth_key, data, timeout=2):
+    log = logging.getLogger("daemon_client")
+    message = json.dumps({"auth_key": auth_key, "events": data['events']})
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    reply = b""
+    try:
+        client.connect(socket_path)
+        client.sendall(message.encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    except (socket.error, socket.timeout):
+        log.warning("Couldn't hand events to daemon at {path}"
+                    .format(path=socket_path), exc_info=True)
+        return False
+    finally:
+        client.close()
+
+    if reply.strip() != b"OK":
+        log.warning("Daemon refused events: {reply}".format(reply=reply))
+        return False
+    return True
+
+
+class SignifaiDaemon(object):
+    # Accepts events from send_to_daemon on a Unix socket and delivers
+    # them from a single resident process, so notifications don't each
+    # pay for interpreter startup and imports
+    def __init__(self, socket_path, post_kwargs=None, queue_size=10000,
+                 poll_interval=0.5, client_timeout=1, batch_kwargs=None,
+                 spool=None, spool_failures=False,
+                 event_retries=DEFAULT_EVENT_RETRIES, engine=None,
+                 shards=None, queue=None, sent=None, coalesce_kwargs=None,
+                 rollup_kwargs=None, recovery_kwargs=None):
+        import threading
+        self.socket_path = socket_path
+        self.event_retries = event_retries
+        # event ID -> times resent after the collector listed it in
+        # failed_events; cleared once an event is delivered, given up
+        # on, or replaced by another
+        self.event_tries = {}
+        self.spool = spool
+        self.spool_failures = spool is not None and spool_failures
+        self.drainer = None
+        self.post_kwargs = post_kwargs or {}
+        self.batch_kwargs = batch_kwargs or {}
+        self.batchers = {}
+        # Events go through an EventCoalescer (with coalesce_kwargs)
+        # and a HostRollup (with rollup_kwargs), in that order, before
+        # they're batched, by priority given recovery_kwargs (see
+        # PriorityBatcher)
+        self.stages = []
+        self.accept = self.batch
+        # messages taken off the queue at once, so the most urgent of
+        # them can be sent first
+        self.burst = 1
+        if recovery_kwargs:
+            # prioritising replaces the plain per-auth-key batchers
+            self.burst = PRIORITY_BURST
+            self.stages.insert(0, PriorityBatcher(
+                self.send_batch, batch_kwargs=self.batch_kwargs,
+                recovery_kwargs=recovery_kwargs))
+            self.accept = self.stages[0].add
+        if rollup_kwargs:
+            self.stages.insert(0, HostRollup(self.accept,
+                                             discard=self.settle,
+                                             **rollup_kwargs))
+            self.accept = self.stages[0].add
+        if coalesce_kwargs:
+            self.stages.insert(0, EventCoalescer(self.accept,
+                                                 discard=self.settle,
+                                                 **coalesce_kwargs))
+            self.accept = self.stages[0].add
+        # with an asyncio engine, batches due are collected here and
+        # sent concurrently
+        self.engine = engine
+        self.pending = []
+        # with shards (a ShardedSender), worker processes send instead
+        # of our sender thread
+        self.shards = shards
+        # events delivered, shared with the parent in sharded workers
+        self.sent = sent
+        if queue is None:
+            queue = import_queue().Queue(maxsize=queue_size)
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.client_timeout = client_timeout
+        self.log = logging.getLogger("daemon")
+        self.listener = None
+        self.sender = None
+        self._stopping = threading.Event()
+
+    def bind(self):
+        if os.path.exists(self.socket_path):
+            # stale socket from a previous run
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        # Notification commands run as the monitoring user/group
+        os.chmod(self.socket_path, 0o660)
+        self.listener.listen(128)
+        self.listener.settimeout(self.poll_interval)
+
+    def serve_forever(self):
+        import threading
+        if self.listener is None:
+            self.bind()
+        if self.shards is not None:
+            self.shards.start()
+        else:
+            self.sender = threading.Thread(target=self._sender_loop,
+                                           name="signifai-sender")
+            self.sender.daemon = True
+            self.sender.start()
+        if self.spool is not None:
+            # batch linger doesn't apply, spooled events waited already
+            drainer = SpoolDrainer(
+                self.spool, post_kwargs=self.post_kwargs,
+                max_events=self.batch_kwargs.get('max_events',
+                                                 DEFAULT_BATCH_EVENTS),
+                max_bytes=self.batch_kwargs.get('max_bytes',
+                                                DEFAULT_BATCH_BYTES),
+                event_retries=self.event_retries)
+            self.drainer = threading.Thread(target=drainer.run,
+                                            args=(self._stopping,),
+                                            name="signifai-drainer")
+            self.drainer.daemon = True
+            self.drainer.start()
+        self.log.info("Listening on {path}".format(path=self.socket_path))
+        try:
+            while not self._stopping.is_set():
+                if self.shards is not None:
+                    self.shards.supervise()
+                try:
+                    conn, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                except socket.error:
+                    if self._stopping.is_set():
+                        break
+                    raise
+                try:
+                    self._handle_client(conn)
+                finally:
+                    conn.close()
+        finally:
+            self._stopping.set()
+            self.listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            if self.shards is not None:
+                self.shards.stop()
+            else:
+                self.sender.join()
+            if self.drainer is not None:
+                self.drainer.join()
+
+    def shutdown(self):
+        self._stopping.set()
+
+    def _handle_client(self, conn):
+        queue = import_queue()
+        conn.settimeout(self.client_timeout)
+        message = b""
+        try:
+            while len(message) <= DAEMON_MAX_MESSAGE:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                message += chunk
+            else:
+                conn.sendall(b"ERR message too large\n")
+                return
+
+            try:
+                event = json.loads(message.decode("utf-8"))
+                auth_key = event['auth_key']
+                events = event['events']
+                # the sender loop takes every event for a dict
+                if (not isinstance(events, list) or
+                        not all(isinstance(item, dict) for item in events)):
+                    raise TypeError("events must be a list of objects")
+            except (ValueError, KeyError, TypeError):
+                self.log.warning("Discarding malformed message from client")
+                conn.sendall(b"ERR malformed message\n")
+                return
+
+            if self.shards is not None:
+                queued = self.shards.put(auth_key, events)
+            else:
+                try:
+                    self.queue.put_nowait((auth_key, events))
+                    queued = True
+                except queue.Full:
+                    queued = False
+            if not queued:
+                self.log.warning("Queue full; client will send directly")
+                conn.sendall(b"ERR queue full\n")
+                return
+            conn.sendall(b"OK\n")
+        except (socket.error, socket.timeout):
+            self.log.warning("Lost client connection", exc_info=True)
+
+    def _sender_loop(self):
+        queue = import_queue()
+        # Keep going after a stop request until the queue is drained
+        while not (self._stopping.is_set() and self.queue.empty()):
+            wait = self.poll_interval
+            for stage in self.stages + list(self.batchers.values()):
+                left = stage.time_left()
+                if left is not None:
+                    wait = min(wait, left)
+            try:
+                auth_key, events = self.queue.get(timeout=wait)
+            except queue.Empty:
+                events = None
+            try:
+                if events is not None:
+                    self.accept(auth_key, events)
+                    if self.engine is not None:
+                        self.fill_pending()
+                    self.take_queued(self.burst - 1)
+                for stage in self.stages:
+                    stage.poll()
+                for batcher in self.batchers.values():
+                    batcher.poll()
+                self.send_pending()
+            except Exception:
+                # one bad message mustn't stop delivery for good
+                self.log.exception("Error in sender loop")
+
+        for stage in self.stages:
+            stage.flush()
+        for batcher in self.batchers.values():
+            batcher.flush()
+        self.send_pending()
+
+    def batch(self, auth_key, events):
+        self.batcher(auth_key).add(events)
+
+    def fill_pending(self):
+        # Take whatever else is queued, up to a full round of
+        # concurrent POSTs
+        queue = import_queue()
+        while len(self.pending) < self.engine.concurrency:
+            try:
+                auth_key, events = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.accept(auth_key, events)
+
+    def take_queued(self, limit):
+        queue = import_queue()
+        for _ in range(limit):
+            try:
+                auth_key, events = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.accept(auth_key, events)
+
+    def send_pending(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            delivered = self.engine.post_many(pending)
+        except Exception:
+            self.log.error("Unexpected error delivering events",
+                           exc_info=True)
+            delivered = [(False, {})] * len(pending)
+        for (auth_key, data), (result, report) in zip(pending, delivered):
+            self.handle_result(auth_key, data, result, report)
+
+    def batcher(self, auth_key):
+        # Events are batched per auth key; one POST can only carry one
+        if auth_key not in self.batchers:
+            def send(data):
+                return self.send_batch(auth_key, data)
+            self.batchers[auth_key] = EventBatcher(send, **self.batch_kwargs)
+        return self.batchers[auth_key]
+
+    def send_batch(self, auth_key, data):
+        if self.engine is not None:
+            self.pending.append((auth_key, data))
+            return True
+        return self.deliver(auth_key, data)
+
+    def deliver(self, auth_key, data):
+        report = {}
+        try:
+            result = POST_data(auth_key, data, report=report,
+                               **self.post_kwargs)
+        except Exception:
+            # never let one bad event take the daemon down
+            self.log.error("Unexpected error delivering events",
+                           exc_info=True)
+            return False
+        return self.handle_result(auth_key, data, result, report)
+
+    def handle_result(self, auth_key, data, result, report):
+        if result is False and not rejected(report):
+            if self.spool_failures or (self.spool is not None and
+                                       report.get('error') == "throttled"):
+                # let the drainer retry it once the collector is back
+                # (or lets us send again)
+                spool_events(self.spool, auth_key, data['events'])
+            else:
+                log_throttled_drop(report, data['events'])
+        delivered = 0
+        if result is not None:
+            # delivered, or spooled (the drainer counts its own
+            # retries) or dropped
+            self.settle(data['events'])
+        if result is True:
+            delivered = len(data['events'])
+        elif result is None:
+            failed = failed_indexes(data['events'], report['failed_events'])
+            self.settle([event for index, event in enumerate(data['events'])
+                         if index not in failed])
+            delivered = len(data['events']) - len(failed)
+            self.requeue(auth_key, [event for index, event
+                                    in enumerate(data['events'])
+                                    if index in failed])
+        if self.sent is not None and delivered:
+            with self.sent.get_lock():
+                self.sent.value += delivered
+        return result
+
+    def requeue(self, auth_key, events):
+        # Resend the events the collector didn't take, a few times;
+        # they go back through the queue rather than straight into
+        # the batch being flushed
+        retry = []
+        for event in events:
+            event_id = event.get('attributes', {}).get(EVENT_ID_ATTRIBUTE)
+            if event_id is None:
+                continue
+            tries = self.event_tries.get(event_id, 0)
+            if tries >= self.event_retries:
+                self.log.error("Giving up on event {event_id}"
+                               .format(event_id=event_id))
+                self.event_tries.pop(event_id, None)
+                continue
+            self.event_tries[event_id] = tries + 1
+            retry.append(event)
+        if not retry:
+            return
+        queue = import_queue()
+        try:
+            self.queue.put_nowait((auth_key, retry))
+        except queue.Full:
+            self.log.error("Queue full, dropping {n} failed events"
+                           .format(n=len(retry)))
+            for event in retry:
+                self.event_tries.pop(
+                    event['attributes'][EVENT_ID_ATTRIBUTE], None)
+
+    def settle(self, events):
+        # Forget the retry count of events that are done with
+        for event in events:
+            event_id = event.get('attributes', {}).get(EVENT_ID_ATTRIBUTE)
+            self.event_tries.pop(event_id, None)
+
+
+def shard_index(event, shards, by_host=False):
+    # The same host and service always map to the same shard; by_host,
+    # every event of a host does
+    service = "" if by_host else event.get('application') or ""
+    key = u"{host}\0{service}".format(host=event.get('host') or "",
+                                      service=service)
+    return (binascii.crc32(key.encode("utf-8")) & 0xffffffff) % shards
+
+
+class ShardedSender(object):
+    # Spreads the daemon's events over worker processes, each calling
+    # target(*args, index, queue, sent) to send what arrives on its
+    # queue. Events for one host and service always go to the same
+    # worker, so the collector sees their transitions in order; by_host,
+    # all of a host's events do (as its HostRollup needs). Workers that
+    # die are restarted on a new queue holding what was left in theirs.
+    def __init__(self, workers, target, args=(), queue_size=10000,
+                 stats_interval=60, by_host=False, clock=monotonic):
+        import multiprocessing
+        import threading
+        self.target = target
+        self.args = tuple(args)
+        self.by_host = by_host
+        self.queue_size = queue_size
+        self.queues = [multiprocessing.Queue(maxsize=queue_size)
+                       for _ in range(workers)]
+        # events each worker delivered
+        self.sent = [multiprocessing.Value("L", 0) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self.stats_interval = stats_interval
+        self.clock = clock
+        self.reported_at = clock()
+        self.reported_sent = [0] * workers
+        # only put() fills the queues, so under this lock a queue
+        # found to have room keeps it (and a queue being replaced
+        # gets nothing more)
+        self.put_lock = threading.Lock()
+        self.log = logging.getLogger("daemon")
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self.spawn(index)
+
+    def spawn(self, index):
+        import multiprocessing
+        process = multiprocessing.Process(
+            target=self.target,
+            args=self.args + (index, self.queues[index], self.sent[index]),
+            name="signifai-shard-{index}".format(index=index))
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+
+    def put(self, auth_key, events):
+        # False, with nothing queued, if a worker's queue is full: the
+        # client then sends all of the events itself
+        shards = {}
+        for event in events:
+            shards.setdefault(shard_index(event, len(self.queues),
+                                          self.by_host), []).append(event)
+        with self.put_lock:
+            if any(self.queues[index].full() for index in shards):
+                return False
+            for index, shard_events in sorted(shards.items()):
+                self.queues[index].put_nowait((auth_key, shard_events))
+        return True
+
+    def supervise(self):
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                self.log.error("Sender worker {index} died (exit code "
+                               "{code}), restarting"
+                               .format(index=index, code=process.exitcode))
+                self.restarts[index] += 1
+                self.replace_queue(index)
+                self.spawn(index)
+        if (self.stats_interval and
+                self.clock() - self.reported_at >= self.stats_interval):
+            self.report()
+
+    def replace_queue(self, index):
+        # A worker killed while waiting in get() dies holding its
+        # queue's read lock, so its successor could never read from
+        # that queue; it gets a new one with the messages left over
+        import multiprocessing
+        with self.put_lock:
+            old = self.queues[index]
+            new = multiprocessing.Queue(maxsize=self.queue_size)
+            left = self.salvage(old)
+            for message in left:
+                new.put_nowait(message)
+            self.queues[index] = new
+        old.close()
+        # everything in it was read, don't wait on it at exit
+        old.cancel_join_thread()
+        if left:
+            self.log.info("Moved {n} queued messages to the new worker "
+                          "{index}'s queue".format(n=len(left), index=index))
+
+    def salvage(self, old):
+        # The messages in a dead worker's queue, read from its pipe
+        # directly since its lock may be held for good
+        try:
+            expected = old.qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue(); read until nothing comes
+            expected = None
+        left = []
+        try:
+            while expected is None or len(left) < expected:
+                # our feeder thread may still be writing to the pipe
+                if not old._reader.poll(1):
+                    break
+                left.append(old._reader.recv())
+        except Exception:
+            # the worker died halfway through reading a message
+            self.log.error("Lost the rest of a dead worker's queue",
+                           exc_info=True)
+        return left
+
+    def stats(self):
+        stats = []
+        for index, process in enumerate(self.processes):
+            try:
+                queued = self.queues[index].qsize()
+            except NotImplementedError:
+                # macOS has no sem_getvalue()
+                queued = None
+            stats.append({
+                "worker": index,
+                "pid": process.pid if process is not None else None,
+                "sent": self.sent[index].value,
+                "queued": queued,
+                "restarts": self.restarts[index]
+            })
+        return stats
+
+    def report(self):
+        now = self.clock()
+        elapsed = max(now - self.reported_at, 1e-9)
+        for worker in self.stats():
+            sent = worker['sent'] - self.reported_sent[worker['worker']]
+            self.log.info("Sender worker {worker}: {sent} events sent "
+                          "({rate:.1f}/s), {queued} queued, {restarts} "
+                          "restarts".format(rate=sent / elapsed, **worker))
+            self.reported_sent[worker['worker']] = worker['sent']
+        self.reported_at = now
+
+    def stop(self, timeout=30):
+        # Workers send what's queued before exiting on SIGTERM
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+        self.report()
+
+
+def run_shard(options, index, queue, sent):
+    # One worker process of a --workers daemon
+    import signal
+    level = 10 if options.verbose else 20
+    setup_log("http_post", level)
+    setup_log("spool", level)
+    setup_log("daemon", level)
+    spool = Spool(options.spool_dir) if options.spool_dir else None
+    kwargs = post_kwargs(options, resident=True)
+    metrics = kwargs.get('metrics')
+    if metrics is not None:
+        metrics.start(options.stats_flush)
+    sender = SignifaiDaemon(None, post_kwargs=kwargs,
+                            batch_kwargs=batch_kwargs(options),
+                            spool=spool,
+                            spool_failures=(options.deadline_policy ==
+                                            "spool"),
+                            event_retries=options.event_retries,
+                            queue=queue, sent=sent,
+                            coalesce_kwargs=coalesce_kwargs(options),
+                            rollup_kwargs=rollup_kwargs(options),
+                            recovery_kwargs=recovery_kwargs(options))
+
+    def stop(signum, frame):
+        sender.shutdown()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        sender._sender_loop()
+    finally:
+        kwargs['pool'].close()
+        if metrics is not None:
+            metrics.stop()
+
+
+_metrics = {}
+
+
+def process_metrics(options):
+    # This process's Metrics for --stats-file, or None; one per process,
+    # so forked workers don't flush their parent's figures again
+    if not options.stats_file:
+        return None
+    key = (os.getpid(), options.stats_file, options.prometheus_file)
+    if key not in _metrics:
+        _metrics[key] = Metrics(options.stats_file, options.prometheus_file)
+    return _metrics[key]
+
+
+def flush_metrics():
+    # Flushes the Metrics this process made, if any
+    pid = os.getpid()
+    for key, metrics in list(_metrics.items()):
+        if key[0] == pid:
+            metrics.stop()
+
+
+def rate_limiter(options):
+    return RateLimiter(options.rate_limit_state, rate=options.rate_limit,
+                       burst=options.rate_burst,
+                       max_wait=options.rate_max_wait)
+
+
+def post_kwargs(options, resident=False):
+    # POST_data arguments from the command line; long-lived (resident)
+    # senders also get to reuse connections and TLS sessions
+    session_cache = None
+    if resident and options.tls_session_ttl > 0:
+        session_cache = TLSSessionCache(ttl=options.tls_session_ttl)
+    dns_cache = None
+    if options.dns_cache:
+        dns_cache = DNSCache(options.dns_cache, ttl=options.dns_ttl)
+    tls, host, port = parse_collector(options.collector)
+    if tls and session_cache is None and dns_cache is None:
+        httpsconn = default_connection_class()
     else:
-        REST_target['value'] = ICINGIOS2PRI[options.target_state]
-        REST_target['attributes']['state'] = "alarm"
-    REST_target['attributes']['alert/monitoring_host'] = monitoring_host
+        httpsconn = connection_class(session_cache=session_cache,
+                                     dns_cache=dns_cache, tls=tls)
+    kwargs = {
+        "signifai_host": host,
+        "signifai_port": port,
+        "httpsconn": httpsconn,
+        "deadline": options.deadline,
+        "post_attempts": options.post_attempts,
+        "backoff": options.backoff,
+        "gzip_min": options.gzip_min,
+        "stream": options.stream
+    }
+    if options.breaker:
+        kwargs['breaker'] = CircuitBreaker(
+            options.breaker, threshold=options.breaker_threshold,
+            reset_timeout=options.breaker_reset)
+    if options.rate_limit:
+        kwargs['limiter'] = rate_limiter(options)
+    if options.stats_file:
+        kwargs['metrics'] = process_metrics(options)
+    if resident:
+        kwargs['pool'] = ConnectionPool(maxsize=options.pool_size)
+    return kwargs
+
+
+def async_engine(options):
+    # The asyncio engine for --concurrency above 1, or None to send
+    # with POST_data one request at a time
+    if options.concurrency <= 1:
+        return None
+    import signifai_async
+    tls, host, port = parse_collector(options.collector)
+    kwargs = {
+        "signifai_host": host,
+        "signifai_port": port,
+        "tls": tls,
+        "max_connections": options.concurrency,
+        "deadline": options.deadline,
+        "post_attempts": options.post_attempts,
+        "backoff": options.backoff,
+        "gzip_min": options.gzip_min,
+        "stream": options.stream
+    }
+    if options.breaker:
+        kwargs['breaker'] = CircuitBreaker(
+            options.breaker, threshold=options.breaker_threshold,
+            reset_timeout=options.breaker_reset)
+    if options.rate_limit:
+        kwargs['limiter'] = rate_limiter(options)
+    if options.stats_file:
+        kwargs['metrics'] = process_metrics(options)
+    return signifai_async.AsyncEngine(**kwargs)
+
 
-    REST_events['events'].append(REST_target)
-    return REST_events
+def run_daemon(options):
+    spool = Spool(options.spool_dir) if options.spool_dir else None
+    kwargs = post_kwargs(options, resident=True)
+    engine = async_engine(options)
+    metrics = process_metrics(options)
+    if metrics is not None:
+        metrics.start(options.stats_flush)
+    shards = None
+    if options.workers:
+        # a host's DOWN event and its service alarms must meet in one
+        # worker's HostRollup
+        shards = ShardedSender(options.workers, run_shard, args=(options,),
+                               stats_interval=options.stats_interval,
+                               by_host=bool(options.rollup_window))
+    daemon = SignifaiDaemon(options.socket_path,
+                            post_kwargs=kwargs,
+                            batch_kwargs=batch_kwargs(options),
+                            spool=spool,
+                            spool_failures=(options.deadline_policy ==
+                                            "spool"),
+                            event_retries=options.event_retries,
+                            engine=engine, shards=shards,
+                            coalesce_kwargs=coalesce_kwargs(options),
+                            rollup_kwargs=rollup_kwargs(options),
+                            recovery_kwargs=recovery_kwargs(options))
+
+    def stop(signum, frame):
+        daemon.shutdown()
+
+    import signal
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        daemon.serve_forever()
+    finally:
+        kwargs['pool'].close()
+        if engine is not None:
+            engine.close()
+        if metrics is not None:
+            metrics.stop()
+    return 0
+
+
+def run_drainer(options):
+    kwargs = post_kwargs(options, resident=True)
+    metrics = kwargs.get('metrics')
+    if metrics is not None:
+        metrics.start(options.stats_flush)
+    drainer = SpoolDrainer(Spool(options.spool_dir),
+                           post_kwargs=kwargs,
+                           max_events=options.batch_events,
+                           max_bytes=options.batch_bytes,
+                           event_retries=options.event_retries)
+    import signal
+    import threading
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        drainer.run(stopping)
+    finally:
+        kwargs['pool'].close()
+        if metrics is not None:
+            metrics.stop()
+    return 0
+
+
+def coalesce_kwargs(options):
+    if not options.coalesce_window:
+        return None
+    return {
+        "window": options.coalesce_window,
+        "max_keys": options.coalesce_keys
+    }
+
+
+def rollup_kwargs(options):
+    if not options.rollup_window:
+        return None
+    return {
+        "window": options.rollup_window,
+        "max_keys": options.rollup_hosts
+    }
+
+
+def recovery_kwargs(options):
+    if not options.prioritise:
+        return None
+    return {
+        "max_events": options.recovery_events,
+        "max_bytes": options.batch_bytes,
+        "max_linger": options.recovery_linger
+    }
+
+
+def batch_kwargs(options):
+    return {
+        "max_events": options.batch_events,
+        "max_bytes": options.batch_bytes,
+        "max_linger": options.batch_linger
+    }
+
+
+def setup_log(name, level=20):
+    log = logging.getLogger(name)
+    log.setLevel(level)
+    if not log.handlers:
+        log.addHandler(logging.StreamHandler(sys.stdout))
+    return log
 
 
 def main(argv=sys.argv):
     argv.pop(0)
 
-    oplog = logging.getLogger("option_parser")
-    oplog.setLevel(20)
-    oplog.addHandler(logging.StreamHandler(sys.stdout))
+    setup_log("option_parser")
     (options, args) = parse_opts(argv)
 
     if options is None:
         return 1
 
+    level = 10 if options.verbose else 20
+    setup_log("http_post", level)
+    setup_log("spool", level)
+    if options.daemon:
+        setup_log("daemon", level)
+        return run_daemon(options)
+    if options.drain:
+        return run_drainer(options)
+    if options.bulk:
+        kwargs = post_kwargs(options, resident=True)
+        engine = None
+        if not options.spool_dir or options.deadline_policy == "spool":
+            engine = async_engine(options)
+        try:
+            if options.bulk == "-":
+                return run_bulk(options, sys.stdin, engine, **kwargs)
+            with open(options.bulk) as records:
+                return run_bulk(options, records, engine, **kwargs)
+        except (IOError, OSError):
+            logging.getLogger("option_parser").fatal(
+                "Couldn't read {path}".format(path=options.bulk),
+                exc_info=True)
+            return 1
+        finally:
+            kwargs['pool'].close()
+            if engine is not None:
+                engine.close()
+            flush_metrics()
+
     REST_events = generate_REST_payload(options)
 
-    postlog = logging.getLogger("http_post")
-    postlog.setLevel(20)
-    postlog.addHandler(logging.StreamHandler(sys.stdout))
-    try_post = POST_data(options.auth_key, REST_events)
+    if options.socket_path:
+        setup_log("daemon_client", level)
+        if send_to_daemon(options.socket_path, options.auth_key,
+                          REST_events):
+            return 0
+        # daemon down or overloaded: deliver it ourselves
+
+    try_post = deliver(options, REST_events)
+    flush_metrics()
     if not try_post:
         return 1
     else:
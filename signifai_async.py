@@ -0,0 +1,415 @@
+#
+# Copyright 2018 SignifAI, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# asyncio delivery engine for send_signifai.py: keeps many POSTs to
+# the collector in flight at once over a bounded number of keep-alive
+# connections. Python 3 only, so send_signifai.py imports it only when
+# asked for --concurrency above 1.
+
+import asyncio
+import logging
+import random
+import socket
+import ssl
+
+from send_signifai import (DEFAULT_POST_URI, RETRYABLE_ERRORS,
+                           bugsnag_notify, chunk_frame, collector_failed,
+                           collector_reply, gzip_refused, monotonic,
+                           overloaded, parse_retry_after, request_body,
+                           request_headers, stream_body, stream_refused,
+                           throttled, time_left)
+
+__author__ = "SignifAI, Inc."
+__copyright__ = "Copyright (C) 2018, SignifAI, Inc."
+__version__ = "1.0"
+__license__ = "ASLv2"
+
+
+class AsyncSender(object):
+    # The asyncio counterpart of POST_data: post() takes the same
+    # arguments (minus the connection class and pool) and returns the
+    # same True/None/False, filling in report the same way. At most
+    # max_connections POSTs are in flight; the rest wait for a
+    # connection. timeout applies to each phase (connect, request,
+    # response) of each POST, deadline to a whole delivery. Once the
+    # collector refuses a gzip or chunked (stream) body, the rest are
+    # sent the plain way. metrics, like POST_data's, gets the timings
+    # and outcome of each attempt.
+    def __init__(self, signifai_host="collectors.signifai.io",
+                 signifai_port=443, signifai_uri=DEFAULT_POST_URI,
+                 tls=True, timeout=5, max_connections=8, deadline=None,
+                 breaker=None, post_attempts=1, backoff=0.5,
+                 limiter=None, gzip_min=None, stream=False,
+                 metrics=None, ssl_context=None):
+        self.host = signifai_host
+        self.port = signifai_port
+        self.uri = signifai_uri
+        self.tls = tls
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.deadline = deadline
+        self.breaker = breaker
+        self.post_attempts = post_attempts
+        self.backoff = backoff
+        self.limiter = limiter
+        self.gzip_min = gzip_min
+        self.gzip_refused = False
+        self.stream = stream
+        self.metrics = metrics
+        self.ssl_context = ssl_context
+        if tls and ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        # idle keep-alive (reader, writer) pairs
+        self.idle = []
+        # made on first use, inside the loop that uses it
+        self.slots = None
+        self.log = logging.getLogger("http_post")
+
+    async def post(self, auth_key, data, report=None):
+        if report is None:
+            report = {}
+        start = monotonic()
+        expires = None
+        if self.deadline is not None:
+            expires = start + self.deadline
+        tries = 0
+
+        def done(result):
+            if self.metrics is not None:
+                self.metrics.record_delivery(data, result, report,
+                                             monotonic() - start, tries)
+            return result
+
+        if self.breaker is not None and not self.breaker.allow():
+            self.log.warning("Collector circuit is open, not sending")
+            report['error'] = "circuit_open"
+            report['status'] = None
+            return done(False)
+
+        while True:
+            if (self.limiter is not None and
+                    not await self.wait_for_token(auth_key, expires, report)):
+                if not tries:
+                    return done(False)
+                result = False
+                break
+            tries += 1
+            result = await self.attempt(auth_key, data, expires, report)
+            if self.metrics is not None:
+                self.metrics.record_attempt(report)
+            if gzip_refused(report):
+                self.log.warning("Collector refused a gzip body, resending "
+                                 "it uncompressed")
+                self.gzip_refused = True
+                tries -= 1
+                continue
+            if stream_refused(report):
+                self.log.warning("Collector refused a chunked body, "
+                                 "resending it whole")
+                self.stream = False
+                tries -= 1
+                continue
+            if self.limiter is not None:
+                if overloaded(report):
+                    self.limiter.record_overload(auth_key,
+                                                 report['retry_after'])
+                    if tries < self.post_attempts:
+                        continue
+                elif not collector_failed(report):
+                    self.limiter.record_success(auth_key)
+            if (report['error'] not in RETRYABLE_ERRORS or
+                    tries >= self.post_attempts):
+                break
+            # full jitter keeps concurrent senders from retrying in lockstep
+            delay = random.uniform(0, self.backoff * 2 ** (tries - 1))
+            if expires is not None and monotonic() + delay >= expires:
+                break
+            self.log.info("Retrying POST in {delay:.2f}s ({tries} of "
+                          "{attempts})".format(delay=delay, tries=tries,
+                                               attempts=self.post_attempts))
+            await asyncio.sleep(delay)
+
+        if self.breaker is not None:
+            if collector_failed(report):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return done(result)
+
+    async def wait_for_token(self, auth_key, expires, report):
+        # send_signifai.wait_for_token, without blocking the loop
+        while True:
+            wait = self.limiter.acquire(auth_key)
+            if wait <= 0:
+                return True
+            if throttled(self.limiter, wait, expires, report):
+                return False
+            await asyncio.sleep(wait)
+
+    async def post_many(self, requests):
+        # [(auth_key, data), ...] -> [(result, report), ...] in the same
+        # order, all sent concurrently
+        reports = [{} for _ in requests]
+        results = await asyncio.gather(
+            *[self.post(auth_key, data, report) for (auth_key, data), report
+              in zip(requests, reports)], return_exceptions=True)
+        delivered = []
+        for result, report in zip(results, reports):
+            if isinstance(result, Exception):
+                # one bad request mustn't sink the others
+                self.log.error("Unexpected error delivering events",
+                               exc_info=result)
+                report['error'] = "exception"
+                result = False
+            delivered.append((result, report))
+        return delivered
+
+    async def attempt(self, auth_key, data, expires, report):
+        # One delivery over one connection; see POST_attempt
+        report['error'] = None
+        report['status'] = None
+        report['failed_events'] = None
+        report['retry_after'] = None
+        report['connect_retries'] = 0
+        timings = report['timings'] = {}
+        bmd = {
+            "data": data,
+            "signifai_host": self.host,
+            "signifai_port": self.port,
+            "signifai_uri": self.uri,
+            "timeout": self.timeout,
+            "engine": "asyncio"
+        }
+        bmd['headers'] = headers = request_headers(auth_key, data)
+        encode = stream_body if self.stream else request_body
+        gzip_min = None if self.gzip_refused else self.gzip_min
+
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        async with self.slots:
+            conn = self.idle.pop() if self.idle else None
+            reused = conn is not None
+            while True:
+                if conn is None:
+                    start = monotonic()
+                    conn = await self.connect(expires, report, bmd)
+                    if conn is None:
+                        return False
+                    # name resolution and TLS handshake included
+                    timings['connect'] = monotonic() - start
+                reader, writer = conn
+                # a streamed body can only be sent once
+                body = encode(data, headers, gzip_min)
+                report['compressed'] = "Content-Encoding" in headers
+                report['streamed'] = "Transfer-Encoding" in headers
+
+                timeout = time_left(expires, self.timeout)
+                if timeout <= 0:
+                    return self.expired(conn, report, bmd)
+                start = monotonic()
+                try:
+                    await asyncio.wait_for(
+                        self.write_request(writer, headers, body), timeout)
+                except asyncio.TimeoutError:
+                    writer.close()
+                    self.log.fatal("POST timed out...?")
+                    bugsnag_notify(socket.timeout(), bmd)
+                    report['error'] = "request_timeout"
+                    return False
+                except OSError as exc:
+                    writer.close()
+                    if reused:
+                        # the idle connection went stale
+                        self.log.info("Pooled connection went stale, "
+                                      "reconnecting")
+                        conn = None
+                        reused = False
+                        continue
+                    self.log.fatal("Couldn't POST to SignifAi Collector",
+                                   exc_info=True)
+                    bugsnag_notify(exc, bmd)
+                    report['error'] = "request"
+                    return False
+                timings['request'] = monotonic() - start
+
+                timeout = time_left(expires, self.timeout)
+                if timeout <= 0:
+                    return self.expired(conn, report, bmd)
+                start = monotonic()
+                try:
+                    status, response_headers, body, reusable = (
+                        await asyncio.wait_for(self.read_response(reader),
+                                               timeout))
+                except asyncio.TimeoutError:
+                    writer.close()
+                    self.log.fatal("Response from server timed out...?")
+                    bugsnag_notify(socket.timeout(), bmd)
+                    report['error'] = "response_timeout"
+                    return False
+                except (OSError, EOFError, ValueError) as exc:
+                    writer.close()
+                    if reused:
+                        # closed by the server before it read our request
+                        self.log.info("Pooled connection went stale, "
+                                      "reconnecting")
+                        conn = None
+                        reused = False
+                        continue
+                    self.log.fatal("Couldn't get server response")
+                    bugsnag_notify(exc, bmd)
+                    report['error'] = "response"
+                    return False
+                # the body is read along with the rest of the response
+                timings['response'] = monotonic() - start
+                break
+
+            if reusable:
+                self.idle.append(conn)
+            else:
+                writer.close()
+
+        report['status'] = status
+        if not 200 <= status < 300:
+            report['retry_after'] = parse_retry_after(
+                response_headers.get("retry-after"))
+            if gzip_refused(report) or stream_refused(report):
+                report['error'] = "status"
+                return False
+            self.log.fatal("Received error from SignifAi Collector, body "
+                           "follows: ")
+        return collector_reply(status, body, report, bmd)
+
+    async def connect(self, expires, report, bmd):
+        timeout = time_left(expires, self.timeout)
+        if timeout <= 0:
+            return self.expired(None, report, bmd)
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(
+                self.host, self.port,
+                ssl=self.ssl_context if self.tls else None), timeout)
+        except asyncio.TimeoutError:
+            self.log.fatal("Connection to SignifAi collector timed out")
+            bugsnag_notify(socket.timeout(), bmd)
+            report['error'] = "connect_timeout"
+        except OSError as exc:
+            self.log.fatal("Couldn't connect to SignifAi collector",
+                           exc_info=True)
+            bugsnag_notify(exc, bmd)
+            report['error'] = "connect"
+        return None
+
+    def expired(self, conn, report, bmd):
+        if conn is not None:
+            conn[1].close()
+        self.log.fatal("Delivery deadline exceeded")
+        bugsnag_notify(socket.timeout(), bmd)
+        report['error'] = "deadline"
+        return False
+
+    async def write_request(self, writer, headers, body):
+        if "Transfer-Encoding" not in headers:
+            writer.write(self.encode_request(headers, body))
+            await writer.drain()
+            return
+        writer.write(self.encode_head(headers))
+        for chunk in body:
+            writer.write(chunk_frame(chunk))
+            await writer.drain()
+        writer.write(chunk_frame(b""))
+        await writer.drain()
+
+    def encode_request(self, headers, body):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        return self.encode_head(headers, len(body)) + body
+
+    def encode_head(self, headers, length=None):
+        lines = ["POST {uri} HTTP/1.1".format(uri=self.uri),
+                 "Host: {host}".format(host=self.host)]
+        if length is not None:
+            lines.append("Content-Length: {length}".format(length=length))
+        for name, value in sorted(headers.items()):
+            lines.append("{name}: {value}".format(name=name, value=value))
+        head = "\r\n".join(lines) + "\r\n\r\n"
+        return head.encode("latin-1")
+
+    async def read_response(self, reader):
+        # (status, headers, body, reusable) for one HTTP/1.x response;
+        # header names are lowercased
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("connection closed by collector")
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if status >= 200:
+                break
+            # skip "100 Continue" and friends
+
+        reusable = (version == b"HTTP/1.1" and
+                    headers.get("connection", "").lower() != "close")
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # trailers, up to the blank line
+                    while (await reader.readline()).strip():
+                        pass
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            reusable = False
+        return status, headers, body, reusable
+
+    async def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+class AsyncEngine(object):
+    # Blocking front end for threaded callers (the daemon's sender, the
+    # bulk CLI): runs an AsyncSender on a private event loop. Only one
+    # thread may use it at a time.
+    def __init__(self, **sender_kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.sender = AsyncSender(**sender_kwargs)
+
+    @property
+    def concurrency(self):
+        return self.sender.max_connections
+
+    def post_many(self, requests):
+        if not requests:
+            return []
+        return self.loop.run_until_complete(self.sender.post_many(requests))
+
+    def close(self):
+        self.loop.run_until_complete(self.sender.close())
+        self.loop.close()
+
@@ -23,14 +23,32 @@ try:
 except ImportError:
     import httplib as http_client
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import functools
 import json
 import logging
 import os
 import send_signifai
+import shutil
 import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
+
+try:
+    import signifai_async
+except SyntaxError:
+    # python2
+    signifai_async = None
 
 
 __author__ = "SignifAI, Inc."
@@ -40,9 +58,13 @@ __license__ = "ASLv2"
 
 
 class BaseHTTPSRespMock(object):
-    def __init__(self, data, status=200):
+    def __init__(self, data, status=200, headers=None):
         self.readData = data
         self.status = status
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
 
     def read(self, *args, **kwargs):
         # e.g. throw IOError or socket.timeout
@@ -361,6 +383,2637 @@ class TestHTTPPost(unittest.TestCase):
         self.assertTrue(result)
 
 
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEventBatcher(unittest.TestCase):
+    event = TestHTTPPost.corpus
+
+    def setUp(self):
+        self.sent = []
+        self.clock = FakeClock()
+
+    def send(self, data):
+        self.sent.append(data)
+        return True
+
+    def test_event_cap(self):
+        batcher = send_signifai.EventBatcher(self.send, max_events=3,
+                                             clock=self.clock)
+        batcher.add([self.event] * 7)
+        self.assertEqual([len(d['events']) for d in self.sent], [3, 3])
+        self.assertEqual(len(batcher), 1)
+
+    def test_byte_cap(self):
+        size = len(json.dumps(self.event)) + 2
+        batcher = send_signifai.EventBatcher(self.send, max_bytes=size * 2,
+                                             clock=self.clock)
+        batcher.add([self.event] * 5)
+        self.assertEqual([len(d['events']) for d in self.sent], [2, 2])
+        # the whole batch still fits the cap once encoded
+        for data in self.sent:
+            self.assertLessEqual(len(json.dumps(data)), size * 2 + 12)
+
+    def test_oversized_event_still_sent(self):
+        batcher = send_signifai.EventBatcher(self.send, max_bytes=1,
+                                             clock=self.clock)
+        batcher.add([self.event, self.event])
+        self.assertEqual(len(self.sent), 1)
+        batcher.flush()
+        self.assertEqual(len(self.sent), 2)
+
+    def test_linger(self):
+        batcher = send_signifai.EventBatcher(self.send, max_linger=2,
+                                             clock=self.clock)
+        self.assertIsNone(batcher.time_left())
+        batcher.add([self.event])
+        self.assertIsNone(batcher.poll())
+        self.clock.now += 1
+        batcher.add([self.event])
+        self.assertEqual(batcher.time_left(), 1)
+        self.clock.now += 1
+        self.assertTrue(batcher.poll())
+        self.assertEqual(len(self.sent[0]['events']), 2)
+        self.assertEqual(len(batcher), 0)
+
+    def test_batch_is_one_post(self):
+        # The collector response covers the batch as a whole
+        posts = []
+
+        class PartialFailure(BaseHTTPSConnMock):
+            def request(self, *args, **kwargs):
+                posts.append(json.loads(kwargs['body']))
+
+            def getresponse(self):
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": [{"event": posts[0]['events'][0],
+                                       "error": "bad"}]
+                }))
+
+        logging.getLogger("http_post").setLevel(100)
+        logging.getLogger("bugsnag_unattached_notify").setLevel(100)
+
+        def send(data):
+            return send_signifai.POST_data("", data,
+                                           httpsconn=PartialFailure)
+
+        batcher = send_signifai.EventBatcher(send, clock=self.clock)
+        batcher.add([self.event] * 4)
+        self.assertIsNone(batcher.flush())
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(len(posts[0]['events']), 4)
+
+
+class TestPriorityBatcher(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.clock = FakeClock()
+
+    def send(self, auth_key, data):
+        self.sent.append((auth_key, [event['host']
+                                     for event in data['events']]))
+        return True
+
+    def _event(self, host, value, state="alarm"):
+        return {"host": host, "value": value, "attributes": {"state": state}}
+
+    def _batcher(self):
+        return send_signifai.PriorityBatcher(
+            self.send, batch_kwargs={"max_linger": 1},
+            recovery_kwargs={"max_linger": 10, "max_events": 3},
+            clock=self.clock)
+
+    def test_critical_first(self):
+        batcher = self._batcher()
+        batcher.add("KEY", [self._event("ok1", "low", "ok"),
+                            self._event("unknown1", "low"),
+                            self._event("warn1", "medium"),
+                            self._event("down1", "critical")])
+        self.clock.now += 10
+        batcher.poll()
+        self.assertEqual(self.sent, [("KEY", ["down1"]), ("KEY", ["warn1"]),
+                                     ("KEY", ["unknown1"]), ("KEY", ["ok1"])])
+
+    def test_recoveries_linger_longer(self):
+        batcher = self._batcher()
+        batcher.add("KEY", [self._event("down1", "critical"),
+                            self._event("ok1", "low", "ok"),
+                            self._event("ok2", "low", "ok")])
+        self.clock.now += 1
+        batcher.poll()
+        self.assertEqual(self.sent, [("KEY", ["down1"])])
+        self.assertAlmostEqual(batcher.time_left(), 9)
+        # ... but never longer than their linger
+        self.clock.now += 9
+        batcher.poll()
+        self.assertEqual(self.sent[1:], [("KEY", ["ok1", "ok2"])])
+        # recoveries are batched by their own cap
+        batcher.add("KEY", [self._event("ok{n}".format(n=n), "low", "ok")
+                            for n in range(3)])
+        batcher.poll()
+        self.assertEqual(len(self.sent[2][1]), 3)
+
+    def test_same_object_kept_in_order(self):
+        batcher = self._batcher()
+        batcher.add("KEY", [self._event("web1", "low", "ok"),
+                            self._event("web2", "low", "ok"),
+                            self._event("web1", "critical")])
+        # the waiting recovery went out before the new alarm
+        self.assertEqual(self.sent, [("KEY", ["web1", "web2"])])
+        batcher.flush()
+        self.assertEqual(self.sent[1:], [("KEY", ["web1"])])
+        self.assertEqual(len(batcher), 0)
+
+    def test_daemon_prioritises_backlog(self):
+        posts = []
+        daemon = send_signifai.SignifaiDaemon(
+            "unused.sock", post_kwargs={"httpsconn":
+                                        collector_accepts(posts)},
+            batch_kwargs={"max_events": 2},
+            recovery_kwargs={"max_events": 2})
+        for n in range(4):
+            daemon.queue.put(("KEY", [self._event("ok{n}".format(n=n),
+                                                  "low", "ok")]))
+        for n in range(2):
+            daemon.queue.put(("KEY", [self._event("down{n}".format(n=n),
+                                                  "critical")]))
+        daemon.shutdown()
+        daemon._sender_loop()
+        self.assertEqual([[event['host'] for event in events]
+                          for _, events in posts],
+                         [["down0", "down1"], ["ok0", "ok1"], ["ok2", "ok3"]])
+
+
+class TestEventCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.clock = FakeClock()
+
+    def send(self, auth_key, events):
+        self.sent.extend((auth_key, event) for event in events)
+
+    def _event(self, host, state, service="svc", timestamp=1000):
+        value = "low" if state == "ok" else "critical"
+        return {"host": host, "application": service, "value": value,
+                "timestamp": timestamp, "attributes": {"state": state}}
+
+    def _coalescer(self, **kwargs):
+        return send_signifai.EventCoalescer(self.send, window=5,
+                                            clock=self.clock, **kwargs)
+
+    def test_latest_state_sent(self):
+        coalescer = self._coalescer()
+        for state in ("alarm", "ok", "alarm", "ok"):
+            coalescer.add("KEY", [self._event("web1", state)])
+        coalescer.add("KEY", [self._event("web1", "ok")])
+        self.clock.now += 4.9
+        coalescer.poll()
+        self.assertEqual(self.sent, [])
+        self.assertAlmostEqual(coalescer.time_left(), 0.1)
+        self.clock.now += 0.1
+        coalescer.poll()
+        [(auth_key, event)] = self.sent
+        self.assertEqual(auth_key, "KEY")
+        self.assertEqual(event['attributes']['state'], "ok")
+        self.assertEqual(event['attributes']['alert/coalesced'], 4)
+        # the last repeat wasn't a transition
+        self.assertEqual(event['attributes']['alert/transitions'], 3)
+        self.assertEqual(len(coalescer), 0)
+
+    def test_keys_kept_apart(self):
+        coalescer = self._coalescer()
+        coalescer.add("KEY", [self._event("web1", "alarm"),
+                              self._event("web1", "alarm", service="db"),
+                              self._event("web2", "alarm")])
+        coalescer.add("OTHER", [self._event("web1", "alarm")])
+        # UNKNOWN's monitoring host events are about different hosts
+        for target in ("web1", "web2"):
+            coalescer.add("KEY", [{
+                "host": "monitor", "application": "icinga",
+                "attributes": {"application/target/host/name": target}}])
+        coalescer.flush()
+        self.assertEqual(len(self.sent), 6)
+        for _, event in self.sent:
+            self.assertNotIn("alert/coalesced", event['attributes'])
+
+    def test_stale_event_doesnt_replace_newer(self):
+        # an event resent after failed_events arrives late
+        coalescer = self._coalescer()
+        coalescer.add("KEY", [self._event("web1", "ok", timestamp=1001)])
+        coalescer.add("KEY", [self._event("web1", "alarm", timestamp=1000)])
+        coalescer.flush()
+        [(_, event)] = self.sent
+        self.assertEqual(event['attributes']['state'], "ok")
+        self.assertEqual(event['attributes']['alert/coalesced'], 1)
+
+    def test_bounded(self):
+        coalescer = self._coalescer(max_keys=3)
+        for host in range(5):
+            coalescer.add("KEY", [self._event("host{n}".format(n=host),
+                                              "alarm")])
+        # the oldest are sent early to make room
+        self.assertEqual([event['host'] for _, event in self.sent],
+                         ["host0", "host1"])
+        self.assertEqual(len(coalescer), 3)
+
+    def test_evicts_least_recently_hit(self):
+        coalescer = self._coalescer(max_keys=2)
+        coalescer.add("KEY", [self._event("web1", "alarm")])
+        self.clock.now += 1
+        coalescer.add("KEY", [self._event("web2", "alarm")])
+        # a flapping web1 stays held; web2 makes room for web3
+        coalescer.add("KEY", [self._event("web1", "ok")])
+        coalescer.add("KEY", [self._event("web3", "alarm")])
+        self.assertEqual([event['host'] for _, event in self.sent],
+                         ["web2"])
+        # web1 is still due first
+        self.assertAlmostEqual(coalescer.time_left(), 4)
+        self.clock.now += 4
+        coalescer.poll()
+        self.assertEqual([event['host'] for _, event in self.sent],
+                         ["web2", "web1"])
+        self.assertEqual(self.sent[-1][1]['attributes']['state'], "ok")
+        self.assertEqual(len(coalescer), 1)
+
+    def test_daemon_coalesces(self):
+        posts = []
+        daemon = send_signifai.SignifaiDaemon(
+            "unused.sock", post_kwargs={"httpsconn":
+                                        collector_accepts(posts)},
+            coalesce_kwargs={"window": 60})
+        for state in ("alarm", "ok", "alarm"):
+            daemon.queue.put(("KEY", [self._event("web1", state)]))
+        daemon.shutdown()
+        daemon._sender_loop()
+        [(_, events)] = posts
+        self.assertEqual([event['attributes']['state'] for event in events],
+                         ["alarm"])
+
+
+class TestHostRollup(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.clock = FakeClock()
+
+    def send(self, auth_key, events):
+        self.sent.append((auth_key, events))
+
+    def _event(self, host, state, service=None, value="critical"):
+        event = {"host": host, "value": value, "attributes": {"state": state}}
+        if service:
+            event['application'] = service
+        return event
+
+    def _rollup(self, **kwargs):
+        return send_signifai.HostRollup(self.send, window=10,
+                                        clock=self.clock, **kwargs)
+
+    def test_services_rolled_into_host_down(self):
+        rollup = self._rollup()
+        rollup.add("KEY", [self._event("web1", "alarm", "svc{n}".format(n=n))
+                           for n in range(3)])
+        rollup.add("KEY", [self._event("web1", "alarm", "disk",
+                                       value="medium"),
+                           self._event("web1", "ok", "ntp", value="low"),
+                           self._event("web1", "alarm")])
+        rollup.add("KEY", [self._event("web2", "alarm", "svc0")])
+        self.clock.now += 9
+        rollup.poll()
+        self.assertEqual(self.sent, [])
+        self.clock.now += 1
+        rollup.poll()
+        [(_, web1), (_, web2)] = self.sent
+        # the recovery goes on, the alarms are summarised
+        self.assertEqual([event.get('application') for event in web1],
+                         ["ntp", None])
+        attributes = web1[1]['attributes']
+        self.assertEqual(attributes['alert/rolled_up'], 4)
+        self.assertEqual(attributes['alert/rolled_up_services'],
+                         "disk,svc0,svc1,svc2")
+        self.assertEqual(attributes['alert/rolled_up_values'],
+                         "critical:3,medium:1")
+        # web2 isn't down
+        self.assertEqual(web2[0]['application'], "svc0")
+
+    def test_host_back_up(self):
+        rollup = self._rollup()
+        rollup.add("KEY", [self._event("web1", "alarm"),
+                           self._event("web1", "alarm", "svc"),
+                           self._event("web1", "ok", value="low")])
+        rollup.flush()
+        [(_, events)] = self.sent
+        self.assertEqual(len(events), 3)
+        self.assertNotIn("alert/rolled_up", events[0]['attributes'])
+
+    def test_service_names_capped(self):
+        rollup = self._rollup(max_names=2)
+        rollup.add("KEY", [self._event("web1", "alarm", "svc{n}".format(n=n))
+                           for n in range(5)] + [self._event("web1", "alarm")])
+        rollup.flush()
+        [(_, [host])] = self.sent
+        self.assertEqual(host['attributes']['alert/rolled_up_services'],
+                         "svc0,svc1,...(+3)")
+
+    def test_bounded(self):
+        rollup = self._rollup(max_keys=2)
+        for host in ("a", "b", "c"):
+            rollup.add("KEY", [self._event(host, "alarm", "svc")])
+        self.assertEqual([events[0]['host'] for _, events in self.sent],
+                         ["a"])
+        self.assertEqual(len(rollup), 2)
+
+    def test_daemon_coalesces_then_rolls_up(self):
+        posts = []
+        daemon = send_signifai.SignifaiDaemon(
+            "unused.sock", post_kwargs={"httpsconn":
+                                        collector_accepts(posts)},
+            coalesce_kwargs={"window": 60}, rollup_kwargs={"window": 60})
+        for event in (self._event("web1", "alarm", "http"),
+                      self._event("web1", "alarm", "http"),
+                      self._event("web1", "alarm", "ssh"),
+                      self._event("web1", "alarm")):
+            daemon.queue.put(("KEY", [event]))
+        daemon.shutdown()
+        daemon._sender_loop()
+        [(_, [host])] = posts
+        self.assertEqual(host['attributes']['alert/rolled_up_services'],
+                         "http,ssh")
+        self.assertEqual(host['attributes']['alert/rolled_up'], 2)
+
+
+def collector_accepts(posts):
+    # Connection mock recording every POSTed batch
+    class Accepts(BaseHTTPSConnMock):
+        def request(self, method, uri, body, headers):
+            posts.append((headers['Authorization'],
+                          json.loads(body)['events']))
+
+        def getresponse(self):
+            return BaseHTTPSRespMock(json.dumps({
+                "success": True,
+                "failed_events": []
+            }))
+    return Accepts
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "spool", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = send_signifai.Spool(os.path.join(self.tmpdir, "spool"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _event(self, n):
+        return dict(TestHTTPPost.corpus, event_description=str(n))
+
+    def test_enqueue_in_order(self):
+        names = [self.spool.enqueue("KEY", [self._event(n)])
+                 for n in range(5)]
+        self.assertEqual(self.spool.entries(), names)
+        entry = self.spool.read(names[0])
+        self.assertEqual(entry['auth_key'], "KEY")
+        self.assertEqual(entry['events'][0]['event_description'], "0")
+        # no temporary files left behind
+        self.assertEqual(sorted(os.listdir(self.spool.directory)), names)
+
+    def test_drain_batches_in_order(self):
+        posts = []
+        for n in range(5):
+            self.spool.enqueue("KEY1" if n < 3 else "KEY2",
+                               [self._event(n)])
+        drainer = send_signifai.SpoolDrainer(
+            self.spool, post_kwargs={"httpsconn": collector_accepts(posts)})
+        self.assertEqual(drainer.drain_once(), 5)
+        self.assertEqual(self.spool.entries(), [])
+        self.assertEqual(self.spool.read_index()['entries'], 0)
+        self.assertEqual([auth for auth, _ in posts],
+                         ["Bearer KEY1", "Bearer KEY2"])
+        self.assertEqual([e['event_description']
+                          for _, events in posts for e in events],
+                         ["0", "1", "2", "3", "4"])
+
+    def test_drain_respects_event_cap(self):
+        posts = []
+        for n in range(5):
+            self.spool.enqueue("KEY", [self._event(n)])
+        drainer = send_signifai.SpoolDrainer(
+            self.spool, post_kwargs={"httpsconn": collector_accepts(posts)},
+            max_events=2)
+        drainer.drain_once()
+        self.assertEqual([len(events) for _, events in posts], [2, 2, 1])
+
+    def test_drain_keeps_undelivered(self):
+        class Unreachable(BaseHTTPSConnMock):
+            def connect(self):
+                raise socket.error("connection refused")
+
+        names = [self.spool.enqueue("KEY", [self._event(n)])
+                 for n in range(3)]
+        drainer = send_signifai.SpoolDrainer(
+            self.spool, post_kwargs={"httpsconn": Unreachable})
+        self.assertEqual(drainer.drain_once(), 0)
+        self.assertEqual(self.spool.entries(), names)
+
+    def test_single_drainer(self):
+        self.spool.enqueue("KEY", [self._event(0)])
+        lock = self.spool.lock()
+        self.addCleanup(lock.close)
+        drainer = send_signifai.SpoolDrainer(self.spool)
+        self.assertIsNone(drainer.drain_once())
+        self.assertEqual(len(self.spool.entries()), 1)
+
+    def test_corrupt_entry_moved_aside(self):
+        self.spool.enqueue("KEY", [self._event(0)])
+        name = self.spool.entries()[0]
+        with open(os.path.join(self.spool.directory, name), "w") as f:
+            f.write("{truncated")
+        self.assertIsNone(self.spool.read(name))
+        self.assertEqual(self.spool.entries(), [])
+
+    def test_cli_spools_and_exits(self):
+        result = send_signifai.main(["send_signifai.py", "-H", "fakehost",
+                                     "-s", "DOWN", "-k", "KEY",
+                                     "-o", "output",
+                                     "--spool", self.spool.directory])
+        self.assertEqual(result, 0)
+        entries = self.spool.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(self.spool.read(entries[0])['events'][0]['host'],
+                         "fakehost")
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "daemon", "daemon_client"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "signifai.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _start_daemon(self, httpsconn, **kwargs):
+        daemon = send_signifai.SignifaiDaemon(
+            self.socket_path, post_kwargs={"httpsconn": httpsconn},
+            poll_interval=0.05, batch_kwargs={"max_linger": 0.2}, **kwargs)
+        daemon.bind()
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(daemon.shutdown)
+        return daemon
+
+    def test_daemon_delivers_events(self):
+        # Client returns as soon as the daemon has the event; the
+        # daemon then POSTs it with the client's auth key
+        delivered = []
+        done = threading.Event()
+
+        class Records(BaseHTTPSConnMock):
+            def request(self, method, uri, body, headers):
+                delivered.append((headers['Authorization'],
+                                  json.loads(body)))
+
+            def getresponse(self):
+                done.set()
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        self._start_daemon(Records)
+        result = send_signifai.send_to_daemon(self.socket_path, "KEY",
+                                              TestHTTPPost.events)
+        self.assertTrue(result)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(delivered[0][0], "Bearer KEY")
+        self.assertEqual(delivered[0][1]['events'],
+                         json.loads(json.dumps(TestHTTPPost.events))['events'])
+
+    def test_daemon_batches_clients(self):
+        # Events from several notifications go out in one POST
+        posts = []
+        done = threading.Event()
+
+        class Records(BaseHTTPSConnMock):
+            def request(self, method, uri, body, headers):
+                posts.append(json.loads(body)['events'])
+
+            def getresponse(self):
+                done.set()
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        self._start_daemon(Records)
+        for _ in range(3):
+            self.assertTrue(send_signifai.send_to_daemon(
+                self.socket_path, "KEY", TestHTTPPost.events))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(len(posts[0]), 3)
+
+    def test_daemon_rejects_malformed(self):
+        self._start_daemon(BaseHTTPSConnMock)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket_path)
+        client.sendall(b"not json")
+        client.shutdown(socket.SHUT_WR)
+        reply = client.recv(4096)
+        client.close()
+        self.assertTrue(reply.startswith(b"ERR"))
+
+    def test_daemon_rejects_events_not_objects(self):
+        self._start_daemon(BaseHTTPSConnMock)
+        for events in ('"oops"', '["oops"]', '[{}, 1]'):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(self.socket_path)
+            client.sendall('{{"auth_key": "k", "events": {events}}}'
+                           .format(events=events).encode("utf-8"))
+            client.shutdown(socket.SHUT_WR)
+            reply = client.recv(4096)
+            client.close()
+            self.assertTrue(reply.startswith(b"ERR"), events)
+
+    def test_sender_survives_bad_message(self):
+        # a message that breaks a stage is logged and skipped; later
+        # ones are still delivered
+        done = threading.Event()
+
+        class Records(BaseHTTPSConnMock):
+            def getresponse(self):
+                done.set()
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        daemon = self._start_daemon(Records,
+                                    coalesce_kwargs={"window": 0.1})
+        daemon.queue.put(("KEY", ["oops"]))
+        self.assertTrue(send_signifai.send_to_daemon(
+            self.socket_path, "KEY", TestHTTPPost.events))
+        self.assertTrue(done.wait(5))
+        self.assertTrue(daemon.sender.is_alive())
+
+    def test_client_without_daemon(self):
+        # Should return False, NOT throw, so the caller can fall back
+        result = send_signifai.send_to_daemon(self.socket_path, "KEY",
+                                              TestHTTPPost.events)
+        self.assertFalse(result)
+
+    def test_daemon_mode_options(self):
+        opts, _ = send_signifai.parse_opts(["--daemon",
+                                            "--socket", self.socket_path])
+        self.assertTrue(opts.daemon)
+        self.assertEqual(send_signifai.parse_opts(["--daemon"]),
+                         (None, None))
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+
+    def _counting_conn(self):
+        class Counts(BaseHTTPSConnMock):
+            instances = 0
+            closed = 0
+
+            def __init__(self, *args, **kwargs):
+                super(Counts, self).__init__(*args, **kwargs)
+                self.__class__.instances += 1
+
+            def close(self):
+                self.__class__.closed += 1
+
+            def getresponse(self):
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+        return Counts
+
+    def test_connection_reused(self):
+        conn = self._counting_conn()
+        pool = send_signifai.ConnectionPool()
+        for _ in range(3):
+            self.assertTrue(send_signifai.POST_data(
+                auth_key="", data=TestHTTPPost.events, httpsconn=conn,
+                pool=pool))
+        self.assertEqual(conn.instances, 1)
+        self.assertEqual(conn.closed, 0)
+
+    def test_no_pool_closes(self):
+        conn = self._counting_conn()
+        send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                httpsconn=conn)
+        self.assertEqual(conn.closed, 1)
+
+    def test_stale_connection_reconnects(self):
+        base = self._counting_conn()
+
+        class StaleAfterFirst(base):
+            def request(self, *args, **kwargs):
+                if getattr(self, "used", False):
+                    raise http_client.BadStatusLine("gone")
+                self.used = True
+
+        pool = send_signifai.ConnectionPool()
+        for _ in range(2):
+            self.assertTrue(send_signifai.POST_data(
+                auth_key="", data=TestHTTPPost.events,
+                httpsconn=StaleAfterFirst, pool=pool))
+        self.assertEqual(StaleAfterFirst.instances, 2)
+
+    def test_failure_not_pooled(self):
+        class BadStatus(BaseHTTPSConnMock):
+            def getresponse(self):
+                raise http_client.HTTPException()
+
+        pool = send_signifai.ConnectionPool()
+        self.assertFalse(send_signifai.POST_data(
+            auth_key="", data=TestHTTPPost.events, httpsconn=BadStatus,
+            pool=pool))
+        self.assertEqual(pool.idle, {})
+
+    def test_pool_size_capped(self):
+        conn = self._counting_conn()
+        pool = send_signifai.ConnectionPool(maxsize=2)
+        for _ in range(3):
+            pool.release("key", conn())
+        self.assertEqual(len(pool.idle["key"]), 2)
+        self.assertEqual(conn.closed, 1)
+
+    def test_idle_timeout(self):
+        clock = FakeClock()
+        conn = self._counting_conn()
+        pool = send_signifai.ConnectionPool(max_idle=10, clock=clock)
+        pool.release("key", conn())
+        clock.now += 11
+        self.assertIsNone(pool.acquire("key"))
+        self.assertEqual(conn.closed, 1)
+
+    def test_closed_socket_unhealthy(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        conn = BaseHTTPSConnMock()
+        conn.sock = ours
+        pool = send_signifai.ConnectionPool()
+        pool.release("key", conn)
+        self.assertIs(pool.acquire("key"), conn)
+        pool.release("key", conn)
+        # server hangs up while the connection sits idle
+        theirs.close()
+        self.assertIsNone(pool.acquire("key"))
+
+
+def have_openssl():
+    try:
+        subprocess.check_output(["openssl", "version"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+@unittest.skipUnless(have_openssl(), "needs openssl to make a test cert")
+class TestTLSSessionCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            raise unittest.SkipTest("python3 only")
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.tmpdir, "cert.pem")
+        key = os.path.join(cls.tmpdir, "key.pem")
+        subprocess.check_output(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+             "-subj", "/CN=localhost", "-days", "1", "-keyout", key,
+             "-out", cls.cert, "-addext", "subjectAltName=DNS:localhost"],
+            stderr=subprocess.STDOUT)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = json.dumps({"success": True,
+                                   "failed_events": []}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cls.cert, key)
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        cls.server.socket = context.wrap_socket(cls.server.socket,
+                                                server_side=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmpdir)
+
+    def _connection_class(self, session_cache):
+        base = send_signifai.connection_class(session_cache)
+        context = ssl.create_default_context(cafile=self.cert)
+        port = self.server.server_address[1]
+        made = []
+
+        class LocalCollector(base):
+            def __init__(self, host, port, timeout):
+                base.__init__(self, host="localhost", port=port,
+                              timeout=timeout, context=context)
+                made.append(self)
+
+            def connect(self):
+                # resolve "localhost" to the address we bound to
+                self.host = "localhost"
+                base.connect(self)
+
+        return LocalCollector, made, port
+
+    def _post(self, conn, port):
+        return send_signifai.POST_data(auth_key="KEY",
+                                       data=TestHTTPPost.events,
+                                       signifai_host="localhost",
+                                       signifai_port=port, httpsconn=conn)
+
+    def test_session_resumed(self):
+        cache = send_signifai.TLSSessionCache()
+        conn, made, port = self._connection_class(cache)
+        self.assertTrue(self._post(conn, port))
+        self.assertTrue(self._post(conn, port))
+        self.assertFalse(made[0].session_reused)
+        self.assertTrue(made[1].session_reused)
+        self.assertGreater(made[0].handshake_time, 0)
+
+    def test_no_cache_full_handshakes(self):
+        conn, made, port = self._connection_class(None)
+        self.assertTrue(self._post(conn, port))
+        self.assertTrue(self._post(conn, port))
+        self.assertFalse(made[1].session_reused)
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        cache = send_signifai.TLSSessionCache(ttl=60, clock=clock)
+
+        class Session(object):
+            time = clock.now
+            timeout = 7200
+
+        cache.put("key", Session)
+        self.assertIs(cache.get("key"), Session)
+        clock.now += 61
+        self.assertIsNone(cache.get("key"))
+
+
+class TestDNSCache(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger("http_post").setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "dns.json")
+        self.clock = FakeClock()
+        self.resolved = []
+        self.cache = send_signifai.DNSCache(self.path, ttl=60,
+                                            clock=self.clock)
+        self.cache.resolve = self._resolve
+        self.fail_resolve = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _resolve(self, host, port):
+        if self.fail_resolve:
+            raise socket.gaierror("resolver down")
+        self.resolved.append(host)
+        return [[socket.AF_INET, ["127.0.0.1", port]]]
+
+    def test_cached_across_instances(self):
+        self.cache.lookup("collector", 443)
+        # a later invocation reads the same file
+        other = send_signifai.DNSCache(self.path, ttl=60, clock=self.clock)
+        other.resolve = self._resolve
+        self.assertEqual(other.lookup("collector", 443),
+                         [(socket.AF_INET, ("127.0.0.1", 443))])
+        self.assertEqual(self.resolved, ["collector"])
+
+    def test_ttl_expiry(self):
+        self.cache.lookup("collector", 443)
+        self.clock.now += 61
+        self.cache.lookup("collector", 443)
+        self.assertEqual(self.resolved, ["collector", "collector"])
+
+    def test_stale_on_resolver_failure(self):
+        self.cache.lookup("collector", 443)
+        self.clock.now += 61
+        self.fail_resolve = True
+        self.assertEqual(self.cache.lookup("collector", 443),
+                         [(socket.AF_INET, ("127.0.0.1", 443))])
+
+    def test_miss_and_failure_raises(self):
+        self.fail_resolve = True
+        self.assertRaises(socket.gaierror, self.cache.lookup,
+                          "collector", 443)
+
+    def test_connect_uses_cached_address(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        port = listener.getsockname()[1]
+
+        conn_class = send_signifai.connection_class(dns_cache=self.cache)
+        # never resolvable, so the address can only come from the cache
+        conn = conn_class(host="collector.invalid", port=port, timeout=1)
+        sock = conn.create_connection(("collector.invalid", port), 1)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getpeername(), ("127.0.0.1", port))
+        self.assertEqual(self.resolved, ["collector.invalid"])
+
+    def test_timeout_tries_next_address(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        port = listener.getsockname()[1]
+        blackholed = ("192.0.2.1", port)
+        real_socket = socket.socket
+
+        class Blackholed(real_socket):
+            def connect(self, sockaddr):
+                if sockaddr == blackholed:
+                    raise socket.timeout("timed out")
+                return real_socket.connect(self, sockaddr)
+
+        def getaddrinfo(host, port, *args):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", sockaddr)
+                    for sockaddr in (blackholed, ("127.0.0.1", port))]
+
+        real_getaddrinfo = socket.getaddrinfo
+        socket.socket, socket.getaddrinfo = Blackholed, getaddrinfo
+        try:
+            conn_class = send_signifai.connection_class()
+            conn = conn_class(host="collector", port=port, timeout=1)
+            sock = conn.create_connection(("collector", port), 1)
+        finally:
+            socket.socket, socket.getaddrinfo = real_socket, real_getaddrinfo
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getpeername(), ("127.0.0.1", port))
+
+    def test_addresses_share_deadline(self):
+        # each blackholed address waits out its whole timeout, but all
+        # of them together no longer than the delivery deadline
+        blackholed = [("192.0.2.{n}".format(n=n), 443) for n in range(4)]
+        real_socket = socket.socket
+
+        class Blackholed(real_socket):
+            def connect(self, sockaddr):
+                time.sleep(self.gettimeout())
+                raise socket.timeout("timed out")
+
+        def getaddrinfo(host, port, *args):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", sockaddr)
+                    for sockaddr in blackholed]
+
+        real_getaddrinfo = socket.getaddrinfo
+        socket.socket, socket.getaddrinfo = Blackholed, getaddrinfo
+        report = {}
+        start = time.time()
+        try:
+            result = send_signifai.POST_data(
+                "KEY", {"events": [{"host": "h"}]}, signifai_host="collector",
+                httpsconn=send_signifai.connection_class(tls=False),
+                deadline=0.5, report=report)
+        finally:
+            socket.socket, socket.getaddrinfo = real_socket, real_getaddrinfo
+        self.assertFalse(result)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(report['error'], "deadline")
+
+    def test_dead_cached_address_kept(self):
+        # a collector refusing connections is no reason to resolve again
+        dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dead.bind(("127.0.0.1", 0))
+        dead_port = dead.getsockname()[1]
+        dead.close()
+
+        conn_class = send_signifai.connection_class(dns_cache=self.cache)
+        for _ in range(2):
+            conn = conn_class(host="collector", port=dead_port, timeout=1)
+            self.assertRaises(socket.error, conn.create_connection,
+                              ("collector", dead_port), 1)
+        self.assertEqual(self.resolved, ["collector"])
+        self.assertIn("collector:{port}".format(port=dead_port),
+                      self.cache.load())
+
+
+class TestDeadline(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "spool", "bugsnag_unattached_notify",
+                     "option_parser"):
+            logging.getLogger(name).setLevel(100)
+
+    def test_deadline_bounds_connect_retries(self):
+        class SlowTimeout(BaseHTTPSConnMock):
+            timeouts = []
+
+            def connect(self):
+                self.__class__.timeouts.append(self.kwargs['timeout'])
+                time.sleep(0.05)
+                raise socket.timeout
+
+        report = {}
+        start = time.time()
+        result = send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                         attempts=1000, deadline=0.3,
+                                         httpsconn=SlowTimeout, report=report)
+        self.assertFalse(result)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(report['error'], "deadline")
+        self.assertLess(len(SlowTimeout.timeouts), 1000)
+        self.assertLessEqual(max(SlowTimeout.timeouts), 0.3)
+
+    def test_deadline_covers_request_and_response(self):
+        class SlowRequest(BaseHTTPSConnMock):
+            responses = 0
+
+            def request(self, *args, **kwargs):
+                time.sleep(0.2)
+
+            def getresponse(self):
+                self.__class__.responses += 1
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        report = {}
+        result = send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                         deadline=0.1, httpsconn=SlowRequest,
+                                         report=report)
+        self.assertFalse(result)
+        self.assertEqual(report['error'], "deadline")
+        self.assertEqual(SlowRequest.responses, 0)
+
+    def test_phase_timeout_is_remaining_budget(self):
+        seen = []
+
+        class Records(BaseHTTPSConnMock):
+            def request(self, *args, **kwargs):
+                seen.append(self.timeout)
+
+            def getresponse(self):
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        self.assertTrue(send_signifai.POST_data(
+            auth_key="", data=TestHTTPPost.events, timeout=5, deadline=2,
+            httpsconn=Records))
+        self.assertLessEqual(seen[0], 2)
+
+    def test_rejected_status(self):
+        class Status(BaseHTTPSConnMock):
+            status = 400
+
+            def getresponse(self):
+                return BaseHTTPSRespMock("bad", status=self.status)
+
+        report = {}
+        send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                httpsconn=Status, report=report)
+        self.assertEqual(report['status'], 400)
+        self.assertTrue(send_signifai.rejected(report))
+        Status.status = 503
+        send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                httpsconn=Status, report=report)
+        self.assertFalse(send_signifai.rejected(report))
+
+    def test_policy_requires_spool(self):
+        self.assertEqual(send_signifai.parse_opts(
+            ["-H", "fakehost", "-s", "DOWN", "-k", "KEY",
+             "--deadline-policy", "spool"]), (None, None))
+
+    def test_spool_policy_spools_undelivered(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        posts = []
+
+        def fails(auth_key, data, report=None, **kwargs):
+            posts.append(kwargs['deadline'])
+            report['error'] = "deadline"
+            return False
+
+        original = send_signifai.POST_data
+        send_signifai.POST_data = fails
+        self.addCleanup(setattr, send_signifai, "POST_data", original)
+
+        result = send_signifai.main(["send_signifai.py", "-H", "fakehost",
+                                     "-s", "DOWN", "-k", "KEY",
+                                     "--deadline", "2",
+                                     "--deadline-policy", "spool",
+                                     "--spool", tmpdir])
+        self.assertEqual(result, 0)
+        # tried to deliver first, then spooled
+        self.assertEqual(posts, [2.0])
+        self.assertEqual(len(send_signifai.Spool(tmpdir).entries()), 1)
+
+    def test_drainer_sets_rejected_aside(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        spool = send_signifai.Spool(tmpdir)
+        spool.enqueue("BADKEY", [TestHTTPPost.corpus])
+        spool.enqueue("KEY", [TestHTTPPost.corpus])
+
+        class RejectsBadKey(BaseHTTPSConnMock):
+            def request(self, method, uri, body, headers):
+                self.auth = headers['Authorization']
+
+            def getresponse(self):
+                if self.auth == "Bearer BADKEY":
+                    return BaseHTTPSRespMock("unauthorized", status=401)
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        drainer = send_signifai.SpoolDrainer(
+            spool, post_kwargs={"httpsconn": RejectsBadKey})
+        self.assertEqual(drainer.drain_once(), 1)
+        self.assertEqual(spool.entries(), [])
+        self.assertEqual(len([name for name in os.listdir(tmpdir)
+                              if name.endswith(".rejected")]), 1)
+
+    def test_drainer_rejects_only_bad_entry(self):
+        # a refused batch is retried entry by entry; only the entry
+        # refused on its own is set aside
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        spool = send_signifai.Spool(tmpdir)
+        for host in ("good1", "bad", "good2"):
+            spool.enqueue("KEY", [{"host": host, "value": "critical",
+                                   "attributes": {}}])
+        posts = []
+
+        class RejectsBadHost(BaseHTTPSConnMock):
+            def request(self, method, uri, body, headers):
+                self.hosts = [event['host']
+                              for event in json.loads(body)['events']]
+                posts.append(self.hosts)
+
+            def getresponse(self):
+                if "bad" in self.hosts:
+                    return BaseHTTPSRespMock("bad request", status=400)
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        drainer = send_signifai.SpoolDrainer(
+            spool, post_kwargs={"httpsconn": RejectsBadHost})
+        self.assertEqual(drainer.drain_once(), 2)
+        self.assertEqual(posts, [["good1", "bad", "good2"], ["good1"],
+                                 ["bad"], ["good2"]])
+        self.assertEqual(spool.entries(), [])
+        self.assertEqual(len([name for name in os.listdir(tmpdir)
+                              if name.endswith(".rejected")]), 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "breaker.json")
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _breaker(self):
+        return send_signifai.CircuitBreaker(self.path, threshold=3,
+                                            reset_timeout=30,
+                                            clock=self.clock)
+
+    def _unreachable(self):
+        class Unreachable(BaseHTTPSConnMock):
+            connects = 0
+
+            def connect(self):
+                self.__class__.connects += 1
+                raise socket.error("connection refused")
+        return Unreachable
+
+    def test_opens_after_threshold(self):
+        conn = self._unreachable()
+        breaker = self._breaker()
+        reports = []
+        for _ in range(5):
+            report = {}
+            self.assertFalse(send_signifai.POST_data(
+                auth_key="", data=TestHTTPPost.events, httpsconn=conn,
+                breaker=breaker, report=report))
+            reports.append(report['error'])
+        # the network is skipped entirely once the circuit is open
+        self.assertEqual(conn.connects, 3)
+        self.assertEqual(reports[3:], ["circuit_open", "circuit_open"])
+
+    def test_shared_between_processes(self):
+        for _ in range(3):
+            self._breaker().record_failure()
+        self.assertFalse(self._breaker().allow())
+
+    def test_half_open_single_probe(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            breaker.record_failure()
+        self.clock.now += 31
+        self.assertTrue(self._breaker().allow())
+        # everyone else keeps failing fast while the probe is out
+        self.assertFalse(self._breaker().allow())
+
+    def test_probe_success_closes(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            breaker.record_failure()
+        self.clock.now += 31
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_probe_failure_reopens(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            breaker.record_failure()
+        self.clock.now += 31
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.clock.now += 31
+        self.assertTrue(breaker.allow())
+
+    def test_refusal_is_not_failure(self):
+        # A collector answering 4xx is up, just unhappy with us
+        class Refuses(BaseHTTPSConnMock):
+            def getresponse(self):
+                return BaseHTTPSRespMock("bad request", status=400)
+
+        breaker = self._breaker()
+        for _ in range(5):
+            send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                    httpsconn=Refuses, breaker=breaker)
+        self.assertTrue(breaker.allow())
+
+    def test_server_errors_are_failures(self):
+        class Fails(BaseHTTPSConnMock):
+            def getresponse(self):
+                return BaseHTTPSRespMock("oops", status=502)
+
+        breaker = self._breaker()
+        for _ in range(3):
+            send_signifai.POST_data(auth_key="", data=TestHTTPPost.events,
+                                    httpsconn=Fails, breaker=breaker)
+        self.assertFalse(breaker.allow())
+
+
+class TestPOSTRetries(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        opts, _ = send_signifai.parse_opts(["-H", "fakehost", "-s", "UNKNOWN",
+                                            "-S", "fakesvc", "-k", "KEY"])
+        self.events = send_signifai.generate_REST_payload(opts)
+
+    def _flaky(self, failures, exc=socket.timeout):
+        class Flaky(BaseHTTPSConnMock):
+            requests = []
+
+            def request(self, method, uri, body, headers):
+                self.__class__.requests.append((body, headers))
+                if len(self.__class__.requests) <= failures:
+                    raise exc()
+
+            def getresponse(self):
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+        return Flaky
+
+    def test_event_ids(self):
+        ids = [event['attributes'][send_signifai.EVENT_ID_ATTRIBUTE]
+               for event in self.events['events']]
+        self.assertEqual(len(ids), 2)
+        self.assertNotEqual(ids[0], ids[1])
+
+    def test_retry_resends_same_events(self):
+        conn = self._flaky(2)
+        result = send_signifai.POST_data(auth_key="", data=self.events,
+                                         httpsconn=conn, post_attempts=3,
+                                         backoff=0.01)
+        self.assertTrue(result)
+        self.assertEqual(len(conn.requests), 3)
+        bodies = set(body for body, _ in conn.requests)
+        keys = set(headers['Idempotency-Key'] for _, headers in conn.requests)
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(len(keys), 1)
+
+    def test_retries_bounded(self):
+        conn = self._flaky(10, exc=http_client.HTTPException)
+        report = {}
+        result = send_signifai.POST_data(auth_key="", data=self.events,
+                                         httpsconn=conn, post_attempts=3,
+                                         backoff=0.01, report=report)
+        self.assertFalse(result)
+        self.assertEqual(len(conn.requests), 3)
+        self.assertEqual(report['error'], "request")
+
+    def test_response_phase_retried(self):
+        class ResponseTimesOut(BaseHTTPSConnMock):
+            responses = 0
+
+            def getresponse(self):
+                self.__class__.responses += 1
+                if self.__class__.responses == 1:
+                    raise socket.timeout
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True,
+                    "failed_events": []
+                }))
+
+        self.assertTrue(send_signifai.POST_data(
+            auth_key="", data=self.events, httpsconn=ResponseTimesOut,
+            post_attempts=2, backoff=0.01))
+
+    def test_no_retry_without_budget(self):
+        conn = self._flaky(10)
+        start = time.time()
+        send_signifai.POST_data(auth_key="", data=self.events,
+                                httpsconn=conn, post_attempts=10,
+                                backoff=10, deadline=0.5)
+        self.assertLess(time.time() - start, 1)
+
+    def test_refusal_not_retried(self):
+        class Refuses(BaseHTTPSConnMock):
+            requests = 0
+
+            def request(self, *args, **kwargs):
+                self.__class__.requests += 1
+
+            def getresponse(self):
+                return BaseHTTPSRespMock("bad request", status=400)
+
+        send_signifai.POST_data(auth_key="", data=self.events,
+                                httpsconn=Refuses, post_attempts=3,
+                                backoff=0.01)
+        self.assertEqual(Refuses.requests, 1)
+
+    def test_no_key_without_ids(self):
+        self.assertIsNone(send_signifai.idempotency_key(TestHTTPPost.events))
+        self.assertEqual(send_signifai.idempotency_key(self.events),
+                         send_signifai.idempotency_key(
+                             json.loads(json.dumps(self.events))))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.events = {"events": [{"host": "h", "value": "critical",
+                                   "attributes": {}}]}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _limiter(self, path=None, rate=2, **kwargs):
+        return send_signifai.RateLimiter(path, rate=rate, clock=self.clock,
+                                         **kwargs)
+
+    def test_token_bucket(self):
+        limiter = self._limiter(burst=2)
+        self.assertEqual([limiter.acquire("KEY") for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.acquire("KEY"), 0.5)
+        # every key has its own bucket
+        self.assertEqual(limiter.acquire("OTHER"), 0)
+        self.clock.now += 0.5
+        self.assertEqual(limiter.acquire("KEY"), 0)
+
+    def test_shared_between_processes(self):
+        path = os.path.join(self.tmpdir, "rate")
+        first, second = self._limiter(path), self._limiter(path)
+        self.assertEqual(first.acquire("KEY"), 0)
+        self.assertEqual(second.acquire("KEY"), 0)
+        self.assertGreater(first.acquire("KEY"), 0)
+        # the key itself isn't written down
+        with open(path) as state:
+            self.assertNotIn("KEY", state.read())
+
+    def test_backs_off_and_recovers(self):
+        limiter = self._limiter(rate=16)
+        limiter.record_overload("KEY", retry_after=30)
+        self.assertAlmostEqual(limiter.acquire("KEY"), 30)
+        self.clock.now += 30
+        self.assertEqual(limiter.acquire("KEY"), 0)
+        # half the rate after one overload, never below a sixteenth
+        for _ in range(10):
+            limiter.record_overload("KEY", retry_after=0)
+        self.assertAlmostEqual(limiter.acquire("KEY"), 1)
+        # a success wins back a tenth of the rate: 1 + 1.6 a second
+        limiter.record_success("KEY")
+        self.clock.now += 1
+        self.assertEqual([limiter.acquire("KEY") for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.acquire("KEY"), 0.4 / 2.6)
+
+    def test_parse_retry_after(self):
+        parse = send_signifai.parse_retry_after
+        self.assertEqual(parse("120"), 120)
+        self.assertIsNone(parse(None))
+        self.assertIsNone(parse("soon"))
+        self.assertEqual(parse("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        later = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                              time.gmtime(time.time() + 60))
+        self.assertAlmostEqual(parse(later), 60, delta=2)
+
+    def _collector(self, statuses):
+        class Overloaded(BaseHTTPSConnMock):
+            requests = []
+
+            def request(self, method, uri, body, headers):
+                self.__class__.requests.append(body)
+
+            def getresponse(self):
+                status = statuses[len(self.__class__.requests) - 1]
+                if status == 200:
+                    return BaseHTTPSRespMock(json.dumps({
+                        "success": True, "failed_events": []}))
+                return BaseHTTPSRespMock("slow down", status=status,
+                                         headers={"Retry-After": "0"})
+        return Overloaded
+
+    def test_POST_retried_when_limiter_allows(self):
+        conn = self._collector([429, 503, 200])
+        limiter = send_signifai.RateLimiter(rate=1000)
+        result = send_signifai.POST_data("KEY", self.events, httpsconn=conn,
+                                         limiter=limiter, post_attempts=3)
+        self.assertTrue(result)
+        self.assertEqual(len(conn.requests), 3)
+
+    def test_overload_without_limiter_not_retried(self):
+        conn = self._collector([429, 200])
+        report = {}
+        result = send_signifai.POST_data("KEY", self.events, httpsconn=conn,
+                                         post_attempts=3, report=report)
+        self.assertFalse(result)
+        self.assertEqual(report['retry_after'], 0)
+        self.assertEqual(len(conn.requests), 1)
+
+    def test_throttled_past_deadline(self):
+        conn = self._collector([200])
+        limiter = send_signifai.RateLimiter(rate=1)
+        limiter.record_overload("KEY", retry_after=60)
+        report = {}
+        result = send_signifai.POST_data("KEY", self.events, httpsconn=conn,
+                                         limiter=limiter, deadline=1,
+                                         report=report)
+        self.assertFalse(result)
+        self.assertEqual(report['error'], "throttled")
+        self.assertEqual(conn.requests, [])
+        # so with --deadline-policy spool it's queued, not dropped
+        self.assertFalse(send_signifai.rejected(report))
+
+    def test_long_retry_after_fails_fast(self):
+        # without a deadline, a long Retry-After mustn't block the
+        # notification (or the daemon's sender) for that long
+        conn = self._collector([200])
+        limiter = send_signifai.RateLimiter(rate=1, max_wait=5)
+        limiter.record_overload("KEY", retry_after=3600)
+        report = {}
+        start = time.time()
+        result = send_signifai.POST_data("KEY", self.events, httpsconn=conn,
+                                         limiter=limiter, report=report)
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(result)
+        self.assertEqual(report['error'], "throttled")
+        self.assertEqual(conn.requests, [])
+        # a wait within max_wait is still waited out
+        limiter = self._limiter(rate=10, max_wait=5)
+        limiter.record_overload("KEY", retry_after=4)
+        self.assertFalse(send_signifai.throttled(limiter, 4, None, {}))
+        self.assertTrue(send_signifai.throttled(limiter, 6, None, {}))
+
+    def test_throttled_events_spooled(self):
+        # even under --deadline-policy drop, events the limiter held
+        # back go to the spool when there is one
+        spool_dir = os.path.join(self.tmpdir, "spool")
+        options, _ = send_signifai.parse_opts(
+            ["-H", "h", "-s", "DOWN", "-k", "KEY", "--rate-limit", "5",
+             "--spool", spool_dir])
+        report = {"error": "throttled", "status": None}
+        self.assertTrue(send_signifai.spool_undelivered(
+            options, self.events, False, report))
+        # but not events that failed otherwise
+        self.assertFalse(send_signifai.spool_undelivered(
+            options, self.events, False, {"error": "connect",
+                                          "status": None}))
+        spool = send_signifai.Spool(spool_dir)
+        self.assertEqual(len(spool.entries()), 1)
+
+        daemon = send_signifai.SignifaiDaemon(None, spool=spool)
+        self.assertFalse(daemon.handle_result("KEY", self.events, False,
+                                              report))
+        self.assertEqual(len(spool.entries()), 2)
+
+    def test_max_wait_option(self):
+        options, _ = send_signifai.parse_opts(
+            ["-H", "h", "-s", "DOWN", "-k", "KEY", "--rate-limit", "5",
+             "--rate-max-wait", "2"])
+        self.assertEqual(send_signifai.rate_limiter(options).max_wait, 2)
+        self.assertEqual(send_signifai.parse_opts(
+            ["-H", "h", "-s", "DOWN", "-k", "KEY", "--rate-max-wait", "-1"]),
+            (None, None))
+
+
+def collector_fails(predicate):
+    # Connection mock listing the events matching predicate in
+    # failed_events, the way the collector does
+    class PartialFailure(BaseHTTPSConnMock):
+        posts = []
+
+        def request(self, method, uri, body, headers):
+            self.events = json.loads(body)['events']
+            self.__class__.posts.append(self.events)
+
+        def getresponse(self):
+            failed = [{"event": event, "error": "invalid"}
+                      for event in self.events if predicate(event)]
+            return BaseHTTPSRespMock(json.dumps({
+                "success": not failed,
+                "failed_events": failed
+            }))
+    return PartialFailure
+
+
+class TestPartialFailures(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "spool", "daemon",
+                     "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.events = []
+        for host in ("good1", "bad", "good2"):
+            opts, _ = send_signifai.parse_opts(["-H", host, "-s", "DOWN",
+                                                "-k", "KEY"])
+            self.events.append(
+                send_signifai.generate_REST_payload(opts)['events'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_failed_indexes_by_id(self):
+        events = [e for events in self.events for e in events]
+        failed = [{"event": json.loads(json.dumps(events[1])),
+                   "error": "invalid"}]
+        self.assertEqual(send_signifai.failed_indexes(events, failed), {1})
+
+    def test_failed_indexes_by_content(self):
+        events = [dict(TestHTTPPost.corpus, host=str(n)) for n in range(3)]
+        self.assertEqual(send_signifai.failed_indexes(events, [events[2]]),
+                         {2})
+
+    def test_unmatched_means_all(self):
+        events = [dict(TestHTTPPost.corpus, host=str(n)) for n in range(3)]
+        self.assertEqual(send_signifai.failed_indexes(events, []),
+                         {0, 1, 2})
+
+    def test_partial_failure_reported(self):
+        conn = collector_fails(lambda event: event['host'] == "bad")
+        report = {}
+        data = {"events": [e for events in self.events for e in events]}
+        self.assertIsNone(send_signifai.POST_data(
+            auth_key="", data=data, httpsconn=conn, report=report))
+        self.assertEqual(len(report['failed_events']), 1)
+
+    def test_drainer_resends_only_failed(self):
+        spool = send_signifai.Spool(self.tmpdir)
+        for events in self.events:
+            spool.enqueue("KEY", events)
+        conn = collector_fails(lambda event: event['host'] == "bad")
+        drainer = send_signifai.SpoolDrainer(
+            spool, post_kwargs={"httpsconn": conn}, event_retries=2)
+
+        drainer.drain_once()
+        entries = spool.entries()
+        self.assertEqual(len(entries), 1)
+        entry = spool.read(entries[0])
+        self.assertEqual([e['host'] for e in entry['events']], ["bad"])
+        self.assertEqual(entry['attempts'], 1)
+
+        drainer.drain_once()
+        self.assertEqual([[e['host'] for e in post] for post in conn.posts],
+                         [["good1", "bad", "good2"], ["bad"]])
+        drainer.drain_once()
+        # out of retries: set aside, not resent forever
+        self.assertEqual(spool.entries(), [])
+        self.assertEqual(len(conn.posts), 3)
+
+    def test_daemon_requeues_only_failed(self):
+        conn = collector_fails(lambda event: event['host'] == "bad")
+        daemon = send_signifai.SignifaiDaemon(
+            os.path.join(self.tmpdir, "sock"),
+            post_kwargs={"httpsconn": conn}, event_retries=1)
+        data = {"events": [e for events in self.events for e in events]}
+        self.assertIsNone(daemon.deliver("KEY", data))
+        auth_key, retry = daemon.queue.get_nowait()
+        self.assertEqual([e['host'] for e in retry], ["bad"])
+
+        self.assertIsNone(daemon.deliver("KEY", {"events": retry}))
+        # out of retries
+        self.assertTrue(daemon.queue.empty())
+        self.assertEqual(daemon.event_tries, {})
+
+    def test_daemon_forgets_superseded_events(self):
+        posts = []
+        daemon = send_signifai.SignifaiDaemon(
+            os.path.join(self.tmpdir, "sock"),
+            post_kwargs={"httpsconn": collector_accepts(posts)},
+            coalesce_kwargs={"window": 60}, rollup_kwargs={"window": 60})
+        opts, _ = send_signifai.parse_opts(["-H", "bad", "-S", "disk", "-s",
+                                            "CRITICAL", "-k", "KEY"])
+        service_events = send_signifai.generate_REST_payload(opts)['events']
+        daemon.requeue("KEY", service_events + self.events[1])
+        self.assertEqual(len(daemon.event_tries), 2)
+        # a newer DOWN replaces the resent one, and the service alarm
+        # is rolled up into it
+        opts, _ = send_signifai.parse_opts(["-H", "bad", "-s", "DOWN",
+                                            "-k", "KEY"])
+        daemon.queue.put(("KEY", send_signifai.generate_REST_payload(
+            opts)['events']))
+        daemon.shutdown()
+        daemon._sender_loop()
+        [(_, events)] = posts
+        self.assertEqual(len(events), 1)
+        self.assertEqual(daemon.event_tries, {})
+
+    def test_daemon_forgets_undelivered_events(self):
+        class Down(BaseHTTPSConnMock):
+            def connect(self):
+                raise socket.timeout
+
+        daemon = send_signifai.SignifaiDaemon(
+            os.path.join(self.tmpdir, "sock"),
+            post_kwargs={"httpsconn": Down, "attempts": 1})
+        daemon.requeue("KEY", self.events[1])
+        auth_key, retry = daemon.queue.get_nowait()
+        # the collector is down by the time it's resent; it's dropped
+        self.assertFalse(daemon.deliver(auth_key, {"events": retry}))
+        self.assertEqual(daemon.event_tries, {})
+
+
+class TestBulkMode(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "option_parser", "spool",
+                     "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.options, _ = send_signifai.parse_opts(["-k", "KEY",
+                                                    "--bulk", "-"])
+
+    def _run(self, records, conn, **options):
+        for name, value in options.items():
+            setattr(self.options, name, value)
+        lines = [record if isinstance(record, str) else json.dumps(record)
+                 for record in records]
+        return send_signifai.run_bulk(self.options, lines, httpsconn=conn)
+
+    def test_records_batched(self):
+        posts = []
+        records = [{"hostname": "host{n}".format(n=n), "state": "DOWN"}
+                   for n in range(5)]
+        result = self._run(records, collector_accepts(posts),
+                           batch_events=2)
+        self.assertEqual(result, 0)
+        self.assertEqual([len(events) for _, events in posts], [2, 2, 1])
+        self.assertEqual(posts[0][0], "Bearer KEY")
+
+    def test_same_validation_as_cli(self):
+        # states are translated exactly as on the command line
+        posts = []
+        records = [
+            {"hostname": "h", "service": "svc", "state": 2, "output": "o"},
+            {"hostname": "h", "state": "WARNING"},
+            {"hostname": "h", "service": "svc", "state": "UNKNOWN",
+             "unknown_is_critical": True},
+            {"hostname": "h", "service": "svc", "state": "UNKNOWN"}
+        ]
+        self.assertEqual(self._run(records, collector_accepts(posts)), 0)
+        events = posts[0][1]
+        self.assertEqual([e['value'] for e in events],
+                         ["critical", "critical", "low", "low", "low"])
+        self.assertEqual(events[0]['application'], "svc")
+        self.assertEqual(events[0]['event_description'], "o")
+        self.assertEqual(events[1]['event_description'], "")
+        # the UNKNOWN without -U adds the monitoring host's event
+        self.assertEqual(events[3]['application'], "icinga")
+
+    def test_invalid_records_skipped(self):
+        posts = []
+        records = ["not json", {"state": "DOWN"},
+                   {"hostname": "h", "state": "BEEPBOOP"},
+                   {"hostname": ["h"], "state": "DOWN"},
+                   {"hostname": "good", "state": "DOWN"}, ""]
+        result = self._run(records, collector_accepts(posts))
+        self.assertEqual(result, 1)
+        self.assertEqual([e['host'] for e in posts[0][1]], ["good"])
+
+    def test_failed_batch_fails_run(self):
+        class Unreachable(BaseHTTPSConnMock):
+            def connect(self):
+                raise socket.error("connection refused")
+
+        self.assertEqual(self._run([{"hostname": "h", "state": "DOWN"}],
+                                   Unreachable), 1)
+
+    def test_bulk_requires_key(self):
+        self.assertEqual(send_signifai.parse_opts(["--bulk", "-"]),
+                         (None, None))
+
+
+class TestColdStart(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "option_parser", "spool",
+                     "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _loaded_after(self, argv):
+        # Modules the command line loaded, run in a fresh interpreter
+        script = ("import sys, send_signifai\n"
+                  "status = send_signifai.main(['send_signifai.py'] + "
+                  "sys.argv[1:])\n"
+                  "sys.stdout.write('\\n' + ' '.join(sys.modules))\n"
+                  "sys.exit(status)\n")
+        here = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output(
+            [sys.executable, "-c", script] + argv, cwd=here,
+            stderr=subprocess.STDOUT)
+        # logging goes to stdout too; the modules come last
+        return set(output.decode("utf-8").splitlines()[-1].split())
+
+    def test_spool_path_skips_http(self):
+        loaded = self._loaded_after(
+            ["-H", "h", "-s", "DOWN", "-k", "KEY",
+             "--spool", os.path.join(self.tmpdir, "spool")])
+        self.assertIn("send_signifai", loaded)
+        heavy = ["http.client", "ssl", "bugsnag", "hashlib"]
+        if sys.version_info[0] >= 3:
+            # python2's optparse imports copy itself
+            heavy.append("copy")
+        for module in heavy:
+            self.assertNotIn(module, loaded)
+
+    def test_parse_collector(self):
+        parse = send_signifai.parse_collector
+        self.assertEqual(parse("https://collectors.signifai.io"),
+                         (True, "collectors.signifai.io", 443))
+        self.assertEqual(parse("http://127.0.0.1:8080/"),
+                         (False, "127.0.0.1", 8080))
+        for url in ("collectors.signifai.io", "ftp://host", "https://",
+                    "https://host/v1", "https://host:port"):
+            self.assertRaises(ValueError, parse, url)
+        self.assertEqual(send_signifai.parse_opts(
+            ["-H", "h", "-s", "DOWN", "-k", "KEY",
+             "--collector", "collectors.signifai.io"]), (None, None))
+
+    def test_default_connection_class_is_shared(self):
+        # the pool keys connections by class
+        self.assertIs(send_signifai.default_connection_class(),
+                      send_signifai.default_connection_class())
+        options, _ = send_signifai.parse_opts(["-H", "h", "-s", "DOWN",
+                                               "-k", "KEY"])
+        kwargs = send_signifai.post_kwargs(options)
+        self.assertIs(kwargs['httpsconn'],
+                      send_signifai.default_connection_class())
+        self.assertEqual(kwargs['signifai_host'], "collectors.signifai.io")
+
+    def test_connection_classes_work(self):
+        # python2's HTTPSConnection is a classic class, so the mixin
+        # mustn't rely on super() reaching it
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(2)
+        self.addCleanup(listener.close)
+        port = listener.getsockname()[1]
+        dns_cache = send_signifai.DNSCache(os.path.join(self.tmpdir, "dns"))
+        for tls in (True, False):
+            conn_class = send_signifai.connection_class(
+                session_cache=send_signifai.TLSSessionCache(),
+                dns_cache=dns_cache, tls=tls)
+            conn = conn_class("127.0.0.1", port, timeout=1)
+            self.assertEqual((conn.host, conn.port), ("127.0.0.1", port))
+            conn.sock = conn.create_connection(("127.0.0.1", port), 1)
+            conn.close()
+            self.assertIsNone(conn.sock)
+
+    def test_plain_http_collector(self):
+        from fake_collector import FakeCollector
+        collector = FakeCollector()
+        collector.start()
+        try:
+            options, _ = send_signifai.parse_opts(
+                ["-H", "h", "-s", "DOWN", "-k", "KEY",
+                 "--collector", collector.url])
+            data = send_signifai.generate_REST_payload(options)
+            self.assertTrue(send_signifai.deliver(options, data))
+        finally:
+            collector.stop()
+        self.assertEqual((collector.posts, collector.events), (1, 1))
+
+
+def counting_shard(index, queue, sent):
+    # ShardedSender target counting the events it takes off its queue
+    Empty = send_signifai.import_queue().Empty
+    while True:
+        try:
+            auth_key, events = queue.get(timeout=1)
+        except Empty:
+            continue
+        with sent.get_lock():
+            sent.value += len(events)
+
+
+class TestShardedSender(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "option_parser", "spool", "daemon",
+                     "daemon_client", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shard_index(self):
+        event = {"host": "web1", "application": "http"}
+        index = send_signifai.shard_index(event, 4)
+        self.assertEqual(send_signifai.shard_index(dict(event), 4), index)
+        shards = set(send_signifai.shard_index(
+            {"host": "host{n}".format(n=n), "application": "http"}, 4)
+            for n in range(100))
+        self.assertEqual(shards, set(range(4)))
+        # host events have no application
+        self.assertIn(send_signifai.shard_index({"host": "web1"}, 4),
+                      range(4))
+
+    def test_full_queue_queues_nothing(self):
+        # the client sends all of a refused notification itself, so no
+        # shard may have queued part of it
+        shards = send_signifai.ShardedSender(2, None, queue_size=1)
+        events = [{"host": "host{n}".format(n=n)} for n in range(20)]
+        self.assertEqual(len(set(send_signifai.shard_index(event, 2)
+                                 for event in events)), 2)
+        full = send_signifai.shard_index(events[0], 2)
+        shards.queues[full].put_nowait(("KEY", []))
+        self.assertFalse(shards.put("KEY", events))
+        self.assertFalse(shards.queues[1 - full].full())
+
+    def test_shard_by_host_for_rollup(self):
+        # a host's DOWN event and its service alarms share a worker
+        events = [{"host": "web1"}] + [
+            {"host": "web1", "application": "svc{n}".format(n=n)}
+            for n in range(20)]
+        self.assertGreater(len(set(send_signifai.shard_index(event, 4)
+                                   for event in events)), 1)
+        self.assertEqual(len(set(send_signifai.shard_index(event, 4, True)
+                                 for event in events)), 1)
+        shards = send_signifai.ShardedSender(4, None, by_host=True)
+        self.assertTrue(shards.put("KEY", events))
+        index = send_signifai.shard_index(events[0], 4)
+        self.assertEqual(shards.queues[index].get(timeout=5),
+                         ("KEY", events))
+
+    def test_workers_need_blocking_sends(self):
+        self.assertEqual(send_signifai.parse_opts(
+            ["--daemon", "--socket", "s", "--workers", "2",
+             "--concurrency", "4"]), (None, None))
+
+    def test_idle_worker_killed(self):
+        # killed waiting in get(), the worker holds its queue's lock
+        # for good; its successor must still get what's left and what
+        # comes next
+        shards = send_signifai.ShardedSender(1, counting_shard,
+                                             stats_interval=0)
+        shards.start()
+        self.addCleanup(shards.stop, 5)
+        self.assertTrue(shards.put("KEY", [{"host": "before"}]))
+        deadline = time.time() + 10
+        while shards.sent[0].value < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        # idle again, so almost certainly inside get()
+        time.sleep(0.2)
+        os.kill(shards.processes[0].pid, 9)
+        shards.processes[0].join(5)
+        self.assertTrue(shards.put("KEY", [{"host": "left"}]))
+        shards.supervise()
+        self.assertEqual(shards.restarts, [1])
+        self.assertTrue(shards.put("KEY", [{"host": "after"}]))
+        while shards.sent[0].value < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(shards.sent[0].value, 3)
+
+    def test_order_kept_across_restart(self):
+        from fake_collector import FakeCollector
+        collector = FakeCollector()
+        collector.start()
+        socket_path = os.path.join(self.tmpdir, "signifai.sock")
+        options, _ = send_signifai.parse_opts(
+            ["--daemon", "--socket", socket_path, "--workers", "2",
+             "--batch-linger", "0.05", "--stats-interval", "0",
+             "--collector", collector.url])
+        shards = send_signifai.ShardedSender(2, send_signifai.run_shard,
+                                             args=(options,),
+                                             stats_interval=0)
+        daemon = send_signifai.SignifaiDaemon(socket_path, poll_interval=0.05,
+                                              shards=shards)
+        daemon.bind()
+        server = threading.Thread(target=daemon.serve_forever)
+        server.start()
+        try:
+            def send(step):
+                for host in range(6):
+                    data = {"events": [{"host": "host{n}".format(n=host),
+                                        "application": "svc",
+                                        "event_description": str(step)}]}
+                    self.assertTrue(send_signifai.send_to_daemon(
+                        socket_path, "KEY", data))
+
+            for step in range(5):
+                send(step)
+            # a worker crashes; it's restarted and takes over its queue
+            os.kill(shards.processes[0].pid, 9)
+            deadline = time.time() + 10
+            while not shards.restarts[0] and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(shards.restarts, [1, 0])
+            for step in range(5, 10):
+                send(step)
+            while (len([event for event in collector.received
+                        if event['event_description'] == "9"]) < 6 and
+                   time.time() < deadline):
+                time.sleep(0.05)
+        finally:
+            daemon.shutdown()
+            server.join()
+            collector.stop()
+
+        steps = {}
+        for event in collector.received:
+            steps.setdefault(event['host'], []).append(
+                int(event['event_description']))
+        self.assertEqual(len(steps), 6)
+        for host_steps in steps.values():
+            # whatever the dead worker had taken may be lost, but
+            # nothing arrives out of order
+            self.assertEqual(host_steps, sorted(host_steps))
+            self.assertEqual(host_steps[-5:], list(range(5, 10)))
+        self.assertEqual(sum(worker['sent'] for worker in shards.stats()),
+                         len(collector.received))
+
+
+class CannedCollector(object):
+    # Local HTTP server answering each POST with the next of replies,
+    # (raw response, close connection afterwards) pairs, after delay
+    # seconds; keeps connections open between requests otherwise
+    def __init__(self, replies, delay=0):
+        self.replies = list(replies)
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error:
+                return
+            with self.lock:
+                self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        buf = b""
+        try:
+            while True:
+                while b"\r\n\r\n" not in buf:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        return
+                    buf += chunk
+                head, buf = buf.split(b"\r\n\r\n", 1)
+                if b"transfer-encoding: chunked" in head.lower():
+                    body, buf = self.read_chunked(conn, buf)
+                else:
+                    length = [int(line.split(b":")[1])
+                              for line in head.split(b"\r\n")
+                              if line.lower().startswith(b"content-length:")
+                              ][0]
+                    while len(buf) < length:
+                        buf += conn.recv(65536)
+                    body, buf = buf[:length], buf[length:]
+                if b"content-encoding: gzip" in head.lower():
+                    body = zlib.decompress(body, 31)
+                with self.lock:
+                    self.requests.append((head, json.loads(body)))
+                    reply, close = self.replies.pop(0)
+                time.sleep(self.delay)
+                conn.sendall(reply)
+                if close:
+                    return
+        finally:
+            conn.close()
+
+    def read_chunked(self, conn, buf):
+        # (body, what's left of buf) for a chunked request body
+        body = b""
+        while True:
+            while b"\r\n" not in buf:
+                buf += conn.recv(65536)
+            size, buf = buf.split(b"\r\n", 1)
+            size = int(size, 16)
+            while len(buf) < size + 2:
+                buf += conn.recv(65536)
+            body, buf = body + buf[:size], buf[size + 2:]
+            if size == 0:
+                return body, buf
+
+    def close(self):
+        self.listener.close()
+
+
+def http_reply(body, status="200 OK", headers=()):
+    body = json.dumps(body).encode("utf-8")
+    head = ["HTTP/1.1 " + status,
+            "Content-Length: {0}".format(len(body))] + list(headers)
+    return ("\r\n".join(head) + "\r\n\r\n").encode("ascii") + body
+
+
+ACCEPTED = http_reply({"success": True, "failed_events": []})
+
+
+@unittest.skipIf(signifai_async is None, "asyncio engine needs Python 3")
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "option_parser", "spool", "daemon",
+                     "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.collector = None
+        self.engine = None
+
+    def tearDown(self):
+        if self.engine is not None:
+            self.engine.close()
+        if self.collector is not None:
+            self.collector.close()
+
+    def _engine(self, replies, delay=0, **kwargs):
+        self.collector = CannedCollector(replies, delay)
+        self.engine = signifai_async.AsyncEngine(
+            signifai_host="127.0.0.1", signifai_port=self.collector.port,
+            tls=False, **kwargs)
+        return self.engine
+
+    def _data(self, n=1):
+        return {"events": [{"host": "h{n}".format(n=i), "value": "low",
+                            "attributes": {
+                                send_signifai.EVENT_ID_ATTRIBUTE:
+                                "id{n}".format(n=i)}}
+                           for i in range(n)]}
+
+    def test_concurrent_over_bounded_connections(self):
+        engine = self._engine([(ACCEPTED, False)] * 12, delay=0.2,
+                              max_connections=6)
+        start = time.time()
+        delivered = engine.post_many([("KEY", self._data())] * 6)
+        self.assertEqual([result for result, _ in delivered], [True] * 6)
+        # one after the other would take 1.2s
+        self.assertLess(time.time() - start, 1.0)
+        # the connections are kept for the next round
+        engine.post_many([("KEY", self._data())] * 6)
+        self.assertEqual(self.collector.connections, 6)
+        self.assertEqual(len(self.collector.requests), 12)
+
+    def test_connections_bounded(self):
+        engine = self._engine([(ACCEPTED, False)] * 8, max_connections=2)
+        delivered = engine.post_many([("KEY", self._data())] * 8)
+        self.assertTrue(all(result for result, _ in delivered))
+        self.assertLessEqual(self.collector.connections, 2)
+
+    def test_same_request_as_POST_data(self):
+        engine = self._engine([(ACCEPTED, False)])
+        data = self._data(2)
+        engine.post_many([("KEY", data)])
+        head, body = self.collector.requests[0]
+        self.assertEqual(body, data)
+        self.assertIn(b"POST /v1/incidents HTTP/1.1", head)
+        self.assertIn(b"Authorization: Bearer KEY", head)
+        self.assertIn(("Idempotency-Key: " +
+                       send_signifai.idempotency_key(data)).encode("ascii"),
+                      head)
+
+    def test_failed_events(self):
+        chunked = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                   b"b\r\n{\"success\":\r\n"
+                   b"1e\r\n false, \"failed_events\": [{}]}\r\n0\r\n\r\n")
+        engine = self._engine([(chunked, False)])
+        [(result, report)] = engine.post_many([("KEY", self._data())])
+        self.assertIsNone(result)
+        self.assertEqual(report['error'], "failed_events")
+        self.assertEqual(report['failed_events'], [{}])
+
+    def test_error_status(self):
+        engine = self._engine([(http_reply({"success": False},
+                                           "503 Service Unavailable",
+                                           ["Connection: close"]), True)])
+        [(result, report)] = engine.post_many([("KEY", self._data())])
+        self.assertFalse(result)
+        self.assertEqual((report['error'], report['status']),
+                         ("status", 503))
+
+    def test_response_timeout(self):
+        engine = self._engine([(ACCEPTED, True)], delay=1, timeout=0.2)
+        [(result, report)] = engine.post_many([("KEY", self._data())])
+        self.assertFalse(result)
+        self.assertEqual(report['error'], "response_timeout")
+
+    def test_retries_with_same_events(self):
+        # the first response never comes; the retry goes through
+        engine = self._engine([(b"", True), (ACCEPTED, False)],
+                              post_attempts=2, backoff=0)
+        [(result, report)] = engine.post_many([("KEY", self._data())])
+        self.assertTrue(result)
+        self.assertEqual(self.collector.requests[0][1],
+                         self.collector.requests[1][1])
+
+    def test_stale_connection_reconnects(self):
+        # the collector drops the idle connection between the two
+        engine = self._engine([(ACCEPTED, True), (ACCEPTED, False)])
+        engine.post_many([("KEY", self._data())])
+        [(result, report)] = engine.post_many([("KEY", self._data())])
+        self.assertTrue(result)
+        self.assertEqual(self.collector.connections, 2)
+
+    def test_overload_slows_down(self):
+        overloaded = http_reply({"success": False}, "429 Too Many Requests",
+                                ["Retry-After: 0"])
+        limiter = send_signifai.RateLimiter(rate=1000)
+        engine = self._engine([(overloaded, False), (ACCEPTED, False)],
+                              post_attempts=2, limiter=limiter)
+        [(result, report)] = engine.post_many([("KEY", self._data())])
+        self.assertTrue(result)
+        self.assertEqual(len(self.collector.requests), 2)
+        self.assertLess(limiter.state.popitem()[1]['rate'], 1000)
+
+    def test_connect_refused(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        self.engine = signifai_async.AsyncEngine(
+            signifai_host="127.0.0.1", signifai_port=port, tls=False)
+        [(result, report)] = self.engine.post_many([("KEY", self._data())])
+        self.assertFalse(result)
+        self.assertEqual(report['error'], "connect")
+
+    def test_daemon_sends_concurrently(self):
+        engine = self._engine([(ACCEPTED, False)] * 4, delay=0.2,
+                              max_connections=4)
+        daemon = send_signifai.SignifaiDaemon(
+            "unused.sock", batch_kwargs={"max_events": 1}, engine=engine)
+        for n in range(4):
+            daemon.queue.put(("KEY{n}".format(n=n), self._data()['events']))
+        daemon.shutdown()
+        start = time.time()
+        daemon._sender_loop()
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(len(self.collector.requests), 4)
+
+    def test_bulk_concurrency(self):
+        engine = self._engine([(ACCEPTED, False)] * 3, max_connections=2)
+        options, _ = send_signifai.parse_opts(["-k", "KEY", "--bulk", "-",
+                                               "--batch-events", "2"])
+        records = [json.dumps({"hostname": "h{n}".format(n=n),
+                               "state": "DOWN"}) for n in range(5)]
+        self.assertEqual(send_signifai.run_bulk(options, records, engine), 0)
+        self.assertEqual([len(body['events'])
+                          for _, body in self.collector.requests],
+                         [2, 2, 1])
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        send_signifai.GZIP_REFUSED.clear()
+        self.data = {"events": [{"host": "h", "value": "critical",
+                                 "attributes": {"text": "x" * 500}}]}
+
+    def tearDown(self):
+        send_signifai.GZIP_REFUSED.clear()
+
+    def _collector(self, accepts_gzip=True):
+        class Collector(BaseHTTPSConnMock):
+            requests = []
+
+            def request(self, method, uri, body, headers):
+                self.__class__.requests.append((headers, body))
+                self.refuse = (not accepts_gzip and
+                               "Content-Encoding" in headers)
+
+            def getresponse(self):
+                if self.refuse:
+                    return BaseHTTPSRespMock("no gzip here", status=415)
+                return BaseHTTPSRespMock(json.dumps({
+                    "success": True, "failed_events": []}))
+        return Collector
+
+    def test_small_body_sent_plain(self):
+        conn = self._collector()
+        self.assertTrue(send_signifai.POST_data("KEY", self.data,
+                                                httpsconn=conn,
+                                                gzip_min=10000))
+        headers, body = conn.requests[0]
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(json.loads(body), self.data)
+
+    def test_large_body_gzipped(self):
+        conn = self._collector()
+        self.assertTrue(send_signifai.POST_data("KEY", self.data,
+                                                httpsconn=conn,
+                                                gzip_min=100))
+        headers, body = conn.requests[0]
+        self.assertEqual(headers['Content-Encoding'], "gzip")
+        self.assertLess(len(body), len(json.dumps(self.data)))
+        self.assertEqual(json.loads(zlib.decompress(body, 31).decode("utf-8")),
+                         self.data)
+
+    def test_refused_gzip_resent_plain(self):
+        conn = self._collector(accepts_gzip=False)
+        report = {}
+        self.assertTrue(send_signifai.POST_data("KEY", self.data,
+                                                httpsconn=conn, gzip_min=0,
+                                                report=report))
+        self.assertEqual(["Content-Encoding" in headers
+                          for headers, _ in conn.requests], [True, False])
+        self.assertEqual(json.loads(conn.requests[1][1]), self.data)
+        # and isn't tried again with this collector
+        self.assertTrue(send_signifai.POST_data("KEY", self.data,
+                                                httpsconn=conn, gzip_min=0))
+        self.assertEqual(len(conn.requests), 3)
+        self.assertNotIn("Content-Encoding", conn.requests[2][0])
+
+    @unittest.skipIf(signifai_async is None, "asyncio engine needs Python 3")
+    def test_async_engine(self):
+        refused = http_reply({"success": False}, "415 Unsupported Media Type")
+        collector = CannedCollector([(ACCEPTED, False), (refused, False),
+                                     (ACCEPTED, False), (ACCEPTED, False)])
+        engine = signifai_async.AsyncEngine(
+            signifai_host="127.0.0.1", signifai_port=collector.port,
+            tls=False, gzip_min=0)
+        try:
+            for _ in range(3):
+                [(result, _)] = engine.post_many([("KEY", self.data)])
+                self.assertTrue(result)
+        finally:
+            engine.close()
+            collector.close()
+        encodings = [b"content-encoding: gzip" in head.lower()
+                     for head, _ in collector.requests]
+        self.assertEqual(encodings, [True, True, False, False])
+        self.assertTrue(all(body == self.data
+                            for _, body in collector.requests))
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        send_signifai.STREAM_REFUSED.clear()
+        send_signifai.GZIP_REFUSED.clear()
+        self.collector = None
+        # well over one chunk
+        self.data = {"events": [{"host": "h{n}".format(n=n),
+                                 "value": "critical",
+                                 "attributes": {"text": "x" * 500}}
+                                for n in range(300)]}
+
+    def tearDown(self):
+        send_signifai.STREAM_REFUSED.clear()
+        send_signifai.GZIP_REFUSED.clear()
+        if self.collector is not None:
+            self.collector.close()
+
+    def _post(self, replies, **kwargs):
+        self.collector = CannedCollector(replies)
+        return send_signifai.POST_data(
+            "KEY", self.data, signifai_host="127.0.0.1",
+            signifai_port=self.collector.port,
+            httpsconn=send_signifai.connection_class(tls=False),
+            stream=True, **kwargs)
+
+    def _chunked(self):
+        return [b"transfer-encoding: chunked" in head.lower()
+                for head, _ in self.collector.requests]
+
+    def test_pieces_make_up_json_dumps(self):
+        pieces = list(send_signifai.json_pieces(self.data))
+        self.assertEqual(len(pieces), 300 + 4)
+        self.assertEqual("".join(pieces), json.dumps(self.data))
+        self.assertEqual("".join(send_signifai.json_pieces({})), "{}")
+
+    def test_small_body_sent_whole(self):
+        headers = {}
+        data = {"events": self.data['events'][:1]}
+        self.assertEqual(send_signifai.stream_body(data, headers),
+                         json.dumps(data))
+        self.assertEqual(headers, {})
+
+    def test_chunks_bounded(self):
+        headers = {}
+        chunks = list(send_signifai.stream_body(self.data, headers,
+                                                chunk_size=4096))
+        self.assertEqual(headers['Transfer-Encoding'], "chunked")
+        self.assertTrue(all(len(chunk) < 4096 + 600 for chunk in chunks))
+        self.assertEqual(json.loads(b"".join(chunks).decode("utf-8")),
+                         self.data)
+
+    def test_streamed_POST(self):
+        self.assertTrue(self._post([(ACCEPTED, False)]))
+        self.assertEqual(self._chunked(), [True])
+        self.assertEqual(self.collector.requests[0][1], self.data)
+
+    def test_streamed_and_gzipped(self):
+        self.assertTrue(self._post([(ACCEPTED, False)], gzip_min=1024))
+        head = self.collector.requests[0][0].lower()
+        self.assertIn(b"content-encoding: gzip", head)
+        self.assertEqual(self._chunked(), [True])
+        self.assertEqual(self.collector.requests[0][1], self.data)
+
+    def test_length_required_resent_whole(self):
+        refused = http_reply({"success": False}, "411 Length Required")
+        self.assertTrue(self._post([(refused, False), (ACCEPTED, False)]))
+        self.assertEqual(self._chunked(), [True, False])
+        self.assertEqual(self.collector.requests[1][1], self.data)
+        self.assertIn(("127.0.0.1", self.collector.port),
+                      send_signifai.STREAM_REFUSED)
+
+    @unittest.skipIf(signifai_async is None, "asyncio engine needs Python 3")
+    def test_async_engine(self):
+        refused = http_reply({"success": False}, "411 Length Required")
+        self.collector = CannedCollector([(ACCEPTED, False),
+                                          (refused, False),
+                                          (ACCEPTED, False)])
+        engine = signifai_async.AsyncEngine(
+            signifai_host="127.0.0.1", signifai_port=self.collector.port,
+            tls=False, stream=True, gzip_min=1024)
+        try:
+            for _ in range(2):
+                [(result, _)] = engine.post_many([("KEY", self.data)])
+                self.assertTrue(result)
+        finally:
+            engine.close()
+        self.assertEqual(self._chunked(), [True, True, False])
+        self.assertTrue(all(body == self.data
+                            for _, body in self.collector.requests))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "option_parser",
+                     "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "stats.json")
+        self.data = {"events": [{"host": "h", "value": "critical",
+                                 "attributes": {}}] * 2}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _stats(self):
+        with open(self.path) as stats:
+            return json.load(stats)
+
+    def test_phases_timed(self):
+        collector = CannedCollector([(ACCEPTED, False)])
+        metrics = send_signifai.Metrics(self.path)
+        try:
+            self.assertTrue(send_signifai.POST_data(
+                "KEY", self.data, signifai_host="127.0.0.1",
+                signifai_port=collector.port,
+                httpsconn=send_signifai.connection_class(tls=False),
+                metrics=metrics))
+        finally:
+            collector.close()
+        metrics.flush()
+        stats = self._stats()
+        self.assertEqual(sorted(stats['phases']),
+                         ["connect", "delivery", "dns", "parse", "read",
+                          "request", "response"])
+        self.assertEqual(stats['counters']['deliveries'], 1)
+        self.assertEqual(stats['counters']['events_sent'], 2)
+        self.assertEqual(stats['failures'], {})
+        delivery = stats['phases']['delivery']
+        self.assertEqual(sum(delivery['buckets']), delivery['count'])
+
+    def test_failures_and_retries_counted(self):
+        class Refused(BaseHTTPSConnMock):
+            def request(self, *args, **kwargs):
+                raise socket.error("connection reset")
+
+        metrics = send_signifai.Metrics(self.path)
+        self.assertFalse(send_signifai.POST_data(
+            "KEY", self.data, httpsconn=Refused, post_attempts=3,
+            backoff=0, metrics=metrics))
+        metrics.flush()
+        stats = self._stats()
+        self.assertEqual(stats['failures'], {"request": 3})
+        self.assertEqual(stats['counters']['attempts'], 3)
+        self.assertEqual(stats['counters']['retries'], 2)
+        self.assertEqual(stats['counters']['deliveries_failed'], 1)
+        self.assertEqual(stats['counters']['events_failed'], 2)
+
+    def test_added_up_across_invocations(self):
+        for n in range(3):
+            metrics = send_signifai.Metrics(self.path)
+            metrics.count("events_sent", 5)
+            metrics.observe("delivery", 0.02)
+            metrics.flush()
+        stats = self._stats()
+        self.assertEqual(stats['counters']['events_sent'], 15)
+        self.assertEqual(stats['phases']['delivery']['count'], 3)
+        # nothing new, nothing written
+        before = os.stat(self.path).st_mtime
+        send_signifai.Metrics(self.path).flush()
+        self.assertEqual(os.stat(self.path).st_mtime, before)
+
+    def test_prometheus_file(self):
+        prom_path = os.path.join(self.tmpdir, "signifai.prom")
+        metrics = send_signifai.Metrics(self.path, prom_path)
+        metrics.count("events_sent", 4)
+        metrics.record_attempt({"error": "connect", "timings": {}})
+        for seconds in (0.001, 0.2, 30):
+            metrics.observe("tls", seconds)
+        metrics.flush()
+        with open(prom_path) as prom:
+            lines = prom.read().splitlines()
+        self.assertIn("signifai_events_sent_total 4", lines)
+        self.assertIn('signifai_post_failures_total{error="connect"} 1',
+                      lines)
+        self.assertIn('signifai_phase_seconds_bucket{phase="tls",le="0.005"}'
+                      ' 1', lines)
+        self.assertIn('signifai_phase_seconds_bucket{phase="tls",le="0.25"}'
+                      ' 2', lines)
+        self.assertIn('signifai_phase_seconds_bucket{phase="tls",le="+Inf"}'
+                      ' 3', lines)
+        self.assertIn('signifai_phase_seconds_count{phase="tls"} 3', lines)
+
+    def test_cli_adds_to_stats_file(self):
+        from fake_collector import FakeCollector
+        collector = FakeCollector()
+        collector.start()
+        prom_path = os.path.join(self.tmpdir, "signifai.prom")
+        try:
+            for _ in range(2):
+                self.assertEqual(send_signifai.main(
+                    ["send_signifai.py", "-H", "h", "-s", "DOWN", "-k", "KEY",
+                     "--collector", collector.url, "--stats-file", self.path,
+                     "--prometheus-file", prom_path]), 0)
+        finally:
+            collector.stop()
+        self.assertEqual(self._stats()['counters']['events_sent'], 2)
+        self.assertTrue(os.path.exists(prom_path))
+
+
+class TestCheckPlugin(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "spool", "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.tmpdir, "spool")
+        self.stats_path = os.path.join(self.tmpdir, "stats.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, *args):
+        import check_signifai
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            status = check_signifai.main(["check_signifai.py"] +
+                                         list(args))
+        finally:
+            sys.stdout = stdout
+        return status, output.getvalue().strip()
+
+    def _deliveries(self, ok, failed, seconds=0.2):
+        metrics = send_signifai.Metrics(self.stats_path)
+        data = {"events": [{"host": "h"}]}
+        for n in range(ok + failed):
+            metrics.record_delivery(data, n < ok, {}, seconds, 1)
+        metrics.flush()
+
+    def test_healthy(self):
+        spool = send_signifai.Spool(self.spool_dir)
+        spool.write_index()
+        self._deliveries(ok=60, failed=0)
+        status, output = self._check("--spool", self.spool_dir,
+                                     "--stats-file", self.stats_path)
+        self.assertEqual(status, 0)
+        self.assertTrue(output.startswith("SIGNIFAI OK - 0 spooled"))
+        perf = output.split(" | ")[1].split()
+        self.assertIn("backlog=0;1000;10000;0", perf)
+        self.assertIn("send_rate=0.2;;;0", perf)
+        self.assertIn("error_rate=0%;5;20;0;100", perf)
+        self.assertIn("p95_latency=0.25s;2;5;0", perf)
+
+    def test_backlog_and_age(self):
+        spool = send_signifai.Spool(self.spool_dir)
+        for _ in range(3):
+            spool.enqueue("KEY", [{"host": "h"}])
+        oldest = spool.entries()[0]
+        os.rename(os.path.join(self.spool_dir, oldest),
+                  os.path.join(self.spool_dir,
+                               "{usec:020d}-0000000001-000001.json".format(
+                                   usec=int((time.time() - 600) * 1e6))))
+        spool.write_index()
+        status, output = self._check("--spool", self.spool_dir,
+                                     "--backlog-warning", "2")
+        self.assertEqual(status, 1)
+        self.assertIn("3 spooled", output)
+        self.assertIn("oldest 600s old", output)
+        status, _ = self._check("--spool", self.spool_dir,
+                                "--age-critical", "500")
+        self.assertEqual(status, 2)
+
+    def test_index_only_rewritten_on_change(self):
+        clock = FakeClock()
+        spool = send_signifai.Spool(self.spool_dir, clock=clock)
+        spool.write_index()
+        clock.now += 30
+        spool.write_index()
+        self.assertEqual(spool.read_index()['updated'], 1000)
+        spool.enqueue("KEY", [{"host": "h"}])
+        spool.write_index()
+        self.assertEqual(spool.read_index()['entries'], 1)
+
+    def test_stale_index(self):
+        clock = FakeClock()
+        clock.now = time.time() - 3600
+        send_signifai.Spool(self.spool_dir, clock=clock).write_index()
+        status, output = self._check("--spool", self.spool_dir)
+        self.assertEqual(status, 2)
+        self.assertIn("is the drainer running?", output)
+
+    def test_error_rate(self):
+        self._deliveries(ok=9, failed=1, seconds=7)
+        status, output = self._check("--stats-file", self.stats_path)
+        self.assertEqual(status, 2)
+        self.assertTrue(output.startswith(
+            "SIGNIFAI CRITICAL - 10.0% failed deliveries, p95 delivery 10s"))
+
+    def test_nothing_to_check(self):
+        self.assertEqual(self._check()[0], 3)
+        self.assertEqual(self._check("--stats-file", self.stats_path)[0], 3)
+
+
+class TestLoadHarness(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_post", "option_parser",
+                     "bugsnag_unattached_notify"):
+            logging.getLogger(name).setLevel(100)
+        self.data = {"events": [{"host": "h{n}".format(n=n),
+                                 "value": "critical", "attributes": {}}
+                                for n in range(4)]}
+
+    def _post(self, **behaviour):
+        from fake_collector import FakeCollector
+        collector = FakeCollector(seed=1, **behaviour)
+        collector.start()
+        report = {}
+        try:
+            result = send_signifai.POST_data(
+                "KEY", self.data, signifai_host="127.0.0.1",
+                signifai_port=collector.server_address[1],
+                httpsconn=send_signifai.connection_class(tls=False),
+                report=report)
+        finally:
+            collector.stop()
+        return result, report, collector.stats()
+
+    def test_well_behaved(self):
+        result, _, stats = self._post()
+        self.assertTrue(result)
+        self.assertEqual(stats['events'], 4)
+
+    def test_errors(self):
+        result, report, stats = self._post(error_rate=1)
+        self.assertFalse(result)
+        self.assertEqual(report['status'], 503)
+        self.assertEqual((stats['errors'], stats['events']), (1, 0))
+
+    def test_dropped_connection(self):
+        result, report, stats = self._post(drop_rate=1)
+        self.assertFalse(result)
+        self.assertEqual(report['error'], "response")
+        self.assertEqual(stats['dropped'], 1)
+
+    def test_partial_failure(self):
+        result, report, stats = self._post(failed_rate=0.5)
+        self.assertIsNone(result)
+        failed = send_signifai.failed_indexes(self.data['events'],
+                                              report['failed_events'])
+        self.assertEqual(len(failed), stats['failed'])
+        self.assertEqual(stats['events'] + stats['failed'], 4)
+
+    def test_latency(self):
+        start = time.time()
+        self.assertTrue(self._post(latency=0.2)[0])
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_bulk_run(self):
+        import load_test
+        result = load_test.LoadTest("bulk", 20, rate=200, settle=5).run()
+        self.assertEqual((result['delivered'], result['lost'],
+                          result['duplicates']), (20, 0, 0))
+        self.assertEqual(result['failed_processes'], 0)
+        self.assertLessEqual(result['p50_ms'], result['max_ms'])
+
+
+class TestPayloadBench(unittest.TestCase):
+    def test_cases_build(self):
+        import bench_payload
+        for case in bench_payload.CASES:
+            options = bench_payload.parsed_options(case)
+            self.assertIsNotNone(options, case)
+            json.dumps(send_signifai.generate_REST_payload(options))
+
+    def test_run_and_compare(self):
+        import bench_payload
+        results = bench_payload.run_benchmarks(
+            ["generate_REST_payload/mix", "event/mix"], repeat=1,
+            min_time=0)
+        self.assertEqual(sorted(results),
+                         ["event/mix", "generate_REST_payload/mix"])
+        baseline = dict((name, {"median_us": result['median_us'] / 2})
+                        for name, result in results.items())
+        slower = bench_payload.regressions(results, baseline, 0.25,
+                                           key="median_us")
+        self.assertEqual([name for name, _, _ in slower], sorted(results))
+        self.assertEqual(bench_payload.regressions(results, results, 0,
+                                                   key="median_us"), [])
+
+
 class TestOptionParse(unittest.TestCase):
     def _do_test_envs(self, option_name, base_args, *envs):
         test_str = "TEST_STRING"
@@ -603,6 +3256,57 @@ class TestPayloadGeneration(unittest.TestCase):
                 "-k", "fake_key", "-s", "UNKNOWN", "-o", "fake_output",
                 "-U"]
 
+    def _assert_built(self, builder, expected, *args):
+        # builder's events, with the event IDs replaced by their
+        # position, are expected (JSON); key order included where
+        # dicts keep it
+        events = builder.events(self._generate_options(*args))
+        for number, event in enumerate(events):
+            self.assertEqual(len(event['attributes']['alert/event_id']), 32)
+            event['attributes']['alert/event_id'] = number
+        self.assertEqual(events, json.loads(expected))
+        if sys.version_info >= (3, 7):
+            self.assertEqual(json.dumps(events), expected)
+
+    def test_builder_payloads(self):
+        builder = send_signifai.EventBuilder(monitoring_host="monitor",
+                                             clock=lambda: 1500000000.5)
+        self._assert_built(
+            builder,
+            '[{"event_source": "icinga", "timestamp": 1500000000, '
+            '"host": "monitor", "event_description": "fake_output", '
+            '"attributes": {"application/target/host/name": "fakehost", '
+            '"state": "alarm", "application/target/application/name": '
+            '"fakesvc", "application/target/service/name": "fakesvc", '
+            '"alert/event_id": 0}, "application": "icinga", '
+            '"value": "low"}, '
+            '{"event_source": "icinga", "timestamp": 1500000000, '
+            '"host": "fakehost", "event_description": "fake_output", '
+            '"attributes": {"state": "alarm", "alert/monitoring_host": '
+            '"monitor", "alert/event_id": 1}, "application": "fakesvc", '
+            '"value": "low"}]',
+            "-H", "fakehost", "-S", "fakesvc", "-k", "fake_key", "-s",
+            "UNKNOWN", "-o", "fake_output")
+        self._assert_built(
+            builder,
+            '[{"event_source": "icinga", "timestamp": 1500000000, '
+            '"host": "fakehost", "event_description": "fake_output", '
+            '"attributes": {"state": "ok", "alert/monitoring_host": '
+            '"monitor", "alert/event_id": 0}, "value": "low"}]',
+            "-H", "fakehost", "-k", "fake_key", "-s", "UP", "-o",
+            "fake_output")
+
+    def test_builder_events_are_fresh(self):
+        builder = send_signifai.EventBuilder()
+        options = self._generate_options("-H", "fakehost", "-S", "fakesvc",
+                                         "-k", "fake_key", "-s", "UNKNOWN")
+        first, second = builder.events(options), builder.events(options)
+        self.assertEqual(first[0]['host'], socket.gethostname())
+        for a, b in zip(first, second):
+            self.assertIsNot(a['attributes'], b['attributes'])
+            self.assertNotEqual(a['attributes']['alert/event_id'],
+                                b['attributes']['alert/event_id'])
+
 
 if __name__ == "__main__":
     unittest.main()